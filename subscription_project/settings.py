@@ -38,6 +38,7 @@ MIDDLEWARE = [
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'subscriptions.middleware.StripeCallerMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -108,6 +109,94 @@ STRIPE_PUBLISHABLE_KEY = config('STRIPE_PUBLISHABLE_KEY', default='')
 STRIPE_SECRET_KEY = config('STRIPE_SECRET_KEY', default='')
 STRIPE_WEBHOOK_SECRET = config('STRIPE_WEBHOOK_SECRET', default='')
 
+# Serve the Stripe-bound endpoints with native async views; enable when running
+# under an ASGI server (see docker-compose.asgi.yml)
+SUBSCRIPTIONS_ASYNC_VIEWS = config('SUBSCRIPTIONS_ASYNC_VIEWS', default=False, cast=bool)
+
+# Stripe API endpoint; point it at `manage.py run_fake_stripe` for load tests
+STRIPE_API_BASE = config('STRIPE_API_BASE', default='https://api.stripe.com')
+
+# Stripe API HTTP client: each process keeps a pool of up to
+# STRIPE_HTTP_POOL_SIZE keep-alive connections shared by its threads
+STRIPE_CONNECT_TIMEOUT = config('STRIPE_CONNECT_TIMEOUT', default=5.0, cast=float)
+STRIPE_READ_TIMEOUT = config('STRIPE_READ_TIMEOUT', default=30.0, cast=float)
+STRIPE_HTTP_POOL_SIZE = config('STRIPE_HTTP_POOL_SIZE', default=10, cast=int)
+
+# Stripe bulkhead and circuit breaker: at most STRIPE_MAX_CONCURRENT_CALLS calls
+# in flight per process (waiting up to STRIPE_BULKHEAD_TIMEOUT seconds for a
+# slot), and after STRIPE_CIRCUIT_FAILURE_THRESHOLD consecutive failures calls
+# fail fast for STRIPE_CIRCUIT_RESET_TIMEOUT seconds before a probe is let through
+STRIPE_MAX_CONCURRENT_CALLS = config('STRIPE_MAX_CONCURRENT_CALLS', default=10, cast=int)
+STRIPE_BULKHEAD_TIMEOUT = config('STRIPE_BULKHEAD_TIMEOUT', default=0.5, cast=float)
+STRIPE_CIRCUIT_FAILURE_THRESHOLD = config('STRIPE_CIRCUIT_FAILURE_THRESHOLD', default=5, cast=int)
+STRIPE_CIRCUIT_RESET_TIMEOUT = config('STRIPE_CIRCUIT_RESET_TIMEOUT', default=30.0, cast=float)
+
+# Stripe rate limit: a token bucket refilled at STRIPE_RATE_LIMIT calls per
+# second (0 disables it) holding up to STRIPE_RATE_LIMIT_BURST tokens, shared
+# by every process through Redis when STRIPE_RATE_LIMIT_REDIS_URL is set.
+# Interactive and webhook calls wait at most the given seconds for a token;
+# batch jobs wait as long as needed
+STRIPE_RATE_LIMIT = config('STRIPE_RATE_LIMIT', default=80.0, cast=float)
+STRIPE_RATE_LIMIT_BURST = config('STRIPE_RATE_LIMIT_BURST', default=0.0, cast=float)
+STRIPE_RATE_LIMIT_REDIS_URL = config('STRIPE_RATE_LIMIT_REDIS_URL', default='')
+STRIPE_RATE_LIMIT_INTERACTIVE_WAIT = config('STRIPE_RATE_LIMIT_INTERACTIVE_WAIT', default=2.0, cast=float)
+STRIPE_RATE_LIMIT_WEBHOOK_WAIT = config('STRIPE_RATE_LIMIT_WEBHOOK_WAIT', default=30.0, cast=float)
+
+# Create each new user's Stripe customer in the background right after
+# registration; run `manage.py provision_stripe_customers` to process the queue
+STRIPE_PREPROVISION_CUSTOMERS = config('STRIPE_PREPROVISION_CUSTOMERS', default=False, cast=bool)
+
+# Webhook ingestion: when enabled the webhook view only verifies and stores
+# events, and `manage.py process_webhook_events` dispatches them
+STRIPE_WEBHOOK_ASYNC = config('STRIPE_WEBHOOK_ASYNC', default=False, cast=bool)
+
+# Events for one subscription arriving within WEBHOOK_COALESCE_WINDOW seconds of
+# each other are applied together, delaying none by more than the max delay
+WEBHOOK_COALESCE_WINDOW = config('WEBHOOK_COALESCE_WINDOW', default=1.0, cast=float)
+WEBHOOK_COALESCE_MAX_DELAY = config('WEBHOOK_COALESCE_MAX_DELAY', default=5.0, cast=float)
+
+# Webhook payload storage: 'full' keeps every event's data as received,
+# 'trimmed' keeps only fields the handlers use and 'compressed' stores the
+# trimmed data compressed ('zlib', or 'zstd' with the zstandard package)
+WEBHOOK_PAYLOAD_STORAGE = config('WEBHOOK_PAYLOAD_STORAGE', default='full')
+WEBHOOK_PAYLOAD_COMPRESSION = config('WEBHOOK_PAYLOAD_COMPRESSION', default='zlib')
+
+# Event log retention: prune_event_log archives rows older than these many
+# days to gzipped JSONL files in EVENT_LOG_ARCHIVE_DIR and deletes them
+WEBHOOK_EVENT_RETENTION_DAYS = config('WEBHOOK_EVENT_RETENTION_DAYS', default=90, cast=int)
+SUBSCRIPTION_HISTORY_RETENTION_DAYS = config('SUBSCRIPTION_HISTORY_RETENTION_DAYS', default=730, cast=int)
+EVENT_LOG_ARCHIVE_DIR = config('EVENT_LOG_ARCHIVE_DIR', default=str(BASE_DIR / 'archive'))
+
+# Webhook deduplication: recently stored event ids are kept in a per-process
+# LRU and, if a Redis URL is set, shared across workers for WEBHOOK_DEDUP_TTL seconds
+WEBHOOK_DEDUP_CACHE_SIZE = config('WEBHOOK_DEDUP_CACHE_SIZE', default=10000, cast=int)
+WEBHOOK_DEDUP_REDIS_URL = config('WEBHOOK_DEDUP_REDIS_URL', default='')
+WEBHOOK_DEDUP_TTL = config('WEBHOOK_DEDUP_TTL', default=259200, cast=int)
+
+# Stripe subscription cache: retrieved subscriptions are cached per process and,
+# if a Redis URL is set, across workers for STRIPE_SUBSCRIPTION_CACHE_TTL seconds
+# (0 disables caching); webhooks invalidate their subscription's entry
+STRIPE_SUBSCRIPTION_CACHE_SIZE = config('STRIPE_SUBSCRIPTION_CACHE_SIZE', default=10000, cast=int)
+STRIPE_SUBSCRIPTION_CACHE_REDIS_URL = config('STRIPE_SUBSCRIPTION_CACHE_REDIS_URL', default='')
+STRIPE_SUBSCRIPTION_CACHE_TTL = config('STRIPE_SUBSCRIPTION_CACHE_TTL', default=300, cast=int)
+
+# Plan catalog: plans are kept in memory per process. Saving a plan bumps a
+# version key in Redis when PLAN_CATALOG_REDIS_URL is set, which every process
+# checks once a second; otherwise copies are reloaded every PLAN_CATALOG_TTL seconds
+PLAN_CATALOG_REDIS_URL = config('PLAN_CATALOG_REDIS_URL', default='')
+PLAN_CATALOG_TTL = config('PLAN_CATALOG_TTL', default=60, cast=int)
+
+# Entitlement checks: answers are cached per process and, if a Redis URL is
+# set, across workers for up to ENTITLEMENT_CACHE_TTL seconds (0 disables
+# caching). Other services call the entitlement endpoint with
+# ENTITLEMENT_API_TOKEN as a bearer token; it is disabled while the token is empty
+ENTITLEMENT_CACHE_SIZE = config('ENTITLEMENT_CACHE_SIZE', default=100000, cast=int)
+ENTITLEMENT_CACHE_REDIS_URL = config('ENTITLEMENT_CACHE_REDIS_URL', default='')
+ENTITLEMENT_CACHE_TTL = config('ENTITLEMENT_CACHE_TTL', default=60, cast=int)
+ENTITLEMENT_API_TOKEN = config('ENTITLEMENT_API_TOKEN', default='')
+# Most user ids one bulk entitlement request may ask about
+ENTITLEMENT_BULK_MAX_IDS = config('ENTITLEMENT_BULK_MAX_IDS', default=50000, cast=int)
+
 # Django REST Framework
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
@@ -1,5 +1,8 @@
 from django.contrib import admin
-from .models import SubscriptionPlan, UserSubscription, SubscriptionHistory, StripeWebhookEvent
+from .models import (
+    SubscriptionPlan, UserSubscription, StripeCustomer, CustomerCreationKey, CustomerProvisioningJob, CheckoutSession,
+    SubscriptionHistory, StripeWebhookEvent,
+)
 
 
 @admin.register(SubscriptionPlan)
@@ -29,7 +32,7 @@ class UserSubscriptionAdmin(admin.ModelAdmin):
             'fields': ('user', 'plan', 'status')
         }),
         ('Stripe Information', {
-            'fields': ('stripe_subscription_id', 'stripe_customer_id')
+            'fields': ('stripe_subscription_id', 'stripe_subscription_item_id', 'stripe_customer_id')
         }),
         ('Trial Information', {
             'fields': ('trial_start_date', 'trial_end_date', 'is_trial_active', 'days_remaining_in_trial')
@@ -43,6 +46,40 @@ class UserSubscriptionAdmin(admin.ModelAdmin):
     )
 
 
+@admin.register(StripeCustomer)
+class StripeCustomerAdmin(admin.ModelAdmin):
+    list_display = ['user', 'stripe_customer_id', 'created_at']
+    search_fields = ['user__username', 'user__email', 'stripe_customer_id']
+    readonly_fields = ['created_at']
+    raw_id_fields = ['user']
+
+
+@admin.register(CustomerCreationKey)
+class CustomerCreationKeyAdmin(admin.ModelAdmin):
+    list_display = ['user', 'token', 'created_at']
+    search_fields = ['user__username', 'user__email']
+    readonly_fields = ['token', 'created_at']
+    raw_id_fields = ['user']
+
+
+@admin.register(CustomerProvisioningJob)
+class CustomerProvisioningJobAdmin(admin.ModelAdmin):
+    list_display = ['user', 'created_at', 'provisioned_at', 'attempts', 'next_attempt_at']
+    list_filter = ['provisioned_at']
+    search_fields = ['user__username', 'user__email', 'last_error']
+    readonly_fields = ['created_at', 'provisioned_at', 'attempts', 'last_error', 'locked_by', 'locked_until']
+    raw_id_fields = ['user']
+
+
+@admin.register(CheckoutSession)
+class CheckoutSessionAdmin(admin.ModelAdmin):
+    list_display = ['user', 'plan', 'status', 'stripe_session_id', 'expires_at', 'created_at']
+    list_filter = ['status', 'plan']
+    search_fields = ['user__username', 'user__email', 'stripe_session_id']
+    readonly_fields = ['created_at', 'updated_at']
+    raw_id_fields = ['user']
+
+
 @admin.register(SubscriptionHistory)
 class SubscriptionHistoryAdmin(admin.ModelAdmin):
     list_display = ['subscription', 'event_type', 'description', 'created_at']
@@ -54,7 +91,10 @@ class SubscriptionHistoryAdmin(admin.ModelAdmin):
 
 @admin.register(StripeWebhookEvent)
 class StripeWebhookEventAdmin(admin.ModelAdmin):
-    list_display = ['stripe_event_id', 'event_type', 'processed', 'created_at']
+    list_display = ['stripe_event_id', 'event_type', 'processed', 'attempts', 'created_at', 'processed_at']
     list_filter = ['event_type', 'processed', 'created_at']
-    search_fields = ['stripe_event_id', 'event_type']
-    readonly_fields = ['created_at']
\ No newline at end of file
+    search_fields = ['stripe_event_id', 'event_type', 'stripe_subscription_id']
+    readonly_fields = [
+        'created_at', 'processed_at', 'attempts', 'last_error', 'locked_by', 'locked_until',
+        'data_encoding', 'payload'
+    ]
\ No newline at end of file
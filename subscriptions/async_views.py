@@ -0,0 +1,183 @@
+"""Native async versions of the Stripe-bound endpoints
+
+Served instead of the DRF views in views.py when SUBSCRIPTIONS_ASYNC_VIEWS is
+enabled and the project runs under an ASGI server: while one request waits on
+Stripe the worker's event loop keeps serving others, so concurrency is no
+longer capped by the number of worker threads. DRF 3.14 has no async view
+support, so these are plain Django views reusing the DRF serializers and
+answering with the same bodies and status codes.
+"""
+from asgiref.sync import sync_to_async
+from django.http import HttpResponseNotAllowed, JsonResponse
+from functools import wraps
+from rest_framework.authentication import CSRFCheck
+import json
+import logging
+
+from .models import SubscriptionPlan, UserSubscription
+from .plan_catalog import plan_catalog
+from .serializers import CreateSubscriptionSerializer, ChangePlanSerializer, UserSubscriptionSerializer
+from .resilience import StripeUnavailable, unavailable_response
+from .services import AsyncCheckoutService, AsyncSubscriptionService
+from .views import receive_stripe_webhook
+
+logger = logging.getLogger(__name__)
+
+
+def _authenticate(request):
+    """The session user and any CSRF failure reason, checked like DRF's SessionAuthentication"""
+    # Evaluating request.user loads the session and user from the database
+    user = request.user
+    if not user.is_authenticated:
+        return None, None
+    check = CSRFCheck(lambda request: None)
+    check.process_request(request)
+    return user, check.process_view(request, None, (), {})
+
+
+def async_api_view(view):
+    """POST-only, authenticated async view called as view(request, user)"""
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        user, csrf_failure = await sync_to_async(_authenticate)(request)
+        if user is None:
+            return JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=403)
+        if csrf_failure:
+            return JsonResponse({'detail': f'CSRF Failed: {csrf_failure}'}, status=403)
+        return await view(request, user, *args, **kwargs)
+    # As with DRF views, only authenticated session requests are CSRF-checked
+    wrapper.csrf_exempt = True
+    return wrapper
+
+
+def request_data(request):
+    """Parsed JSON or form body of a request"""
+    if request.content_type == 'application/json':
+        try:
+            return json.loads(request.body or b'{}')
+        except ValueError:
+            return {}
+    return request.POST
+
+
+async def validate(serializer):
+    """Run a serializer's (database-backed) validation off the event loop"""
+    return await sync_to_async(serializer.is_valid)()
+
+
+async def serialize_subscription(subscription):
+    """Serialize a subscription, loading its plan off the event loop"""
+    return await sync_to_async(lambda: UserSubscriptionSerializer(subscription).data)()
+
+
+async def get_user_subscription(user):
+    """The user's subscription, or None"""
+    return await UserSubscription.objects.select_related('plan').filter(user=user).afirst()
+
+
+@async_api_view
+async def create_subscription(request, user):
+    """Create a new subscription with trial"""
+    serializer = CreateSubscriptionSerializer(data=request_data(request))
+
+    if await validate(serializer):
+        try:
+            subscription = await AsyncSubscriptionService.create_trial_subscription(
+                user,
+                serializer.validated_data['plan_lookup_key']
+            )
+            return JsonResponse(await serialize_subscription(subscription), status=201)
+
+        except StripeUnavailable as e:
+            return unavailable_response(e)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse(serializer.errors, status=400)
+
+
+@async_api_view
+async def cancel_subscription(request, user):
+    """Cancel user's subscription"""
+    subscription = await get_user_subscription(user)
+    if subscription is None:
+        return JsonResponse({'error': 'No subscription found'}, status=404)
+
+    try:
+        await AsyncSubscriptionService.cancel_subscription(subscription)
+        return JsonResponse(await serialize_subscription(subscription))
+    except StripeUnavailable as e:
+        return unavailable_response(e)
+    except Exception as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+
+@async_api_view
+async def change_plan(request, user):
+    """Change user's subscription plan"""
+    serializer = ChangePlanSerializer(data=request_data(request))
+
+    if await validate(serializer):
+        subscription = await get_user_subscription(user)
+        if subscription is None:
+            return JsonResponse({'error': 'No subscription found'}, status=404)
+
+        try:
+            await AsyncSubscriptionService.change_plan(
+                subscription,
+                serializer.validated_data['new_plan_lookup_key']
+            )
+            return JsonResponse(await serialize_subscription(subscription))
+        except StripeUnavailable as e:
+            return unavailable_response(e)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse(serializer.errors, status=400)
+
+
+@async_api_view
+async def create_checkout_session(request, user):
+    """Create Stripe checkout session for subscription"""
+    serializer = CreateSubscriptionSerializer(data=request_data(request))
+
+    if await validate(serializer):
+        try:
+            plan = await plan_catalog.aget_by_lookup_key(serializer.validated_data['plan_lookup_key'])
+
+            # Reuse the user's open session for this plan, creating one if needed
+            checkout_session = await AsyncCheckoutService.get_or_create_session(
+                user,
+                plan,
+                success_url=request.build_absolute_uri('/checkout/success/'),
+                cancel_url=request.build_absolute_uri('/checkout/canceled/'),
+            )
+
+            return JsonResponse({
+                'checkout_url': checkout_session.url,
+                'session_id': checkout_session.stripe_session_id
+            })
+
+        except SubscriptionPlan.DoesNotExist:
+            return JsonResponse({'error': 'Invalid plan'}, status=400)
+        except StripeUnavailable as e:
+            return unavailable_response(e)
+        except Exception as e:
+            return JsonResponse({'error': str(e)}, status=400)
+
+    return JsonResponse(serializer.errors, status=400)
+
+
+async def stripe_webhook(request):
+    """Handle Stripe webhook events"""
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    body, status_code = await sync_to_async(receive_stripe_webhook)(
+        request.body, request.META.get('HTTP_STRIPE_SIGNATURE')
+    )
+    return JsonResponse(body, status=status_code)
+
+
+stripe_webhook.csrf_exempt = True
@@ -0,0 +1,130 @@
+from contextlib import contextmanager
+from django.db import transaction
+import logging
+
+from .models import UserSubscription, SubscriptionHistory
+from .state_machine import can_transition, transition
+
+logger = logging.getLogger(__name__)
+
+
+class SubscriptionChangeBatch:
+    """Collects subscription changes and history entries and writes them once
+
+    Webhook handlers record their changes here instead of saving directly.
+    When several events for one subscription are processed together they all
+    mutate the same in-memory UserSubscription, so flush() performs a single
+    save of the changed columns and one bulk history insert. Status changes
+    are collapsed to the final status and applied on flush by one
+    transition(), conditional on the status the batch started from, so a
+    concurrent change wins and the batch's status history is dropped. The
+    save leaves status alone.
+    """
+
+    def __init__(self):
+        self.subscriptions = {}
+        self.dirty = []
+        self.history = []
+        self.transitions = []
+
+    def get(self, stripe_subscription_id):
+        """Return the subscription for a Stripe id, loading it once per batch"""
+        user_subscription = self.subscriptions.get(stripe_subscription_id)
+        if user_subscription is None:
+            user_subscription = UserSubscription.objects.get(
+                stripe_subscription_id=stripe_subscription_id
+            )
+            self.subscriptions[stripe_subscription_id] = user_subscription
+        return user_subscription
+
+    def add(self, user_subscription):
+        """Track a subscription loaded or created outside the batch"""
+        if user_subscription.stripe_subscription_id:
+            self.subscriptions[user_subscription.stripe_subscription_id] = user_subscription
+
+    def save(self, user_subscription):
+        """Mark a subscription to be saved on flush"""
+        if not any(pending is user_subscription for pending in self.dirty):
+            self.dirty.append(user_subscription)
+
+    def transition(self, user_subscription, new_status, event_type, description='', metadata=None, **fields):
+        """Queue a status transition, returning whether the table allows it from the batch's status
+
+        fields are written with the status on flush, and its history entry
+        only if the transition is applied.
+        """
+        if not can_transition(user_subscription.status, new_status):
+            return False
+        pending = next((pending for pending in self.transitions if pending['subscription'] is user_subscription), None)
+        if pending is None:
+            pending = {
+                'subscription': user_subscription,
+                'from_status': user_subscription.status,
+                'fields': {},
+                'previous': {},
+                'history': [],
+            }
+            self.transitions.append(pending)
+        for name, value in fields.items():
+            pending['previous'].setdefault(name, getattr(user_subscription, name))
+            setattr(user_subscription, name, value)
+        pending['fields'].update(fields)
+        user_subscription.status = new_status
+        pending['history'].append(self.log(user_subscription, event_type, description, metadata))
+        return True
+
+    def log(self, user_subscription, event_type, description='', metadata=None):
+        """Queue a history entry to be written on flush"""
+        entry = SubscriptionHistory(
+            subscription=user_subscription,
+            event_type=event_type,
+            description=description,
+            metadata=metadata or {},
+        )
+        self.history.append(entry)
+        return entry
+
+    def _apply_transition(self, pending):
+        """Write a subscription's queued status changes as one transition to the final status"""
+        user_subscription = pending['subscription']
+        new_status = user_subscription.status
+        if new_status == pending['from_status']:
+            # Back where it started, so the fields are saved like any other change
+            if pending['fields']:
+                self.save(user_subscription)
+            return
+        user_subscription.status = pending['from_status']
+        applied = transition(
+            user_subscription, new_status, None, only_from=(pending['from_status'],), log=False, **pending['fields']
+        )
+        if not applied:
+            for name, value in pending['previous'].items():
+                setattr(user_subscription, name, value)
+            self.history = [entry for entry in self.history if not any(entry is lost for lost in pending['history'])]
+
+    def flush(self):
+        """Write all pending transitions, saves and history entries"""
+        with transaction.atomic():
+            for pending in self.transitions:
+                self._apply_transition(pending)
+            for user_subscription in self.dirty:
+                # Only the columns the handlers changed; status only changes through transition()
+                update_fields = user_subscription.dirty_update_fields(exclude=('status',))
+                if update_fields:
+                    user_subscription.save(update_fields=update_fields)
+            if self.history:
+                SubscriptionHistory.objects.bulk_create(self.history)
+        self.dirty = []
+        self.history = []
+        self.transitions = []
+
+
+@contextmanager
+def batch_changes(batch=None):
+    """Use the caller's batch, or a fresh one that is flushed on exit"""
+    if batch is not None:
+        yield batch
+        return
+    batch = SubscriptionChangeBatch()
+    yield batch
+    batch.flush()
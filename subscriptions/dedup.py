@@ -0,0 +1,122 @@
+from django.conf import settings
+from django.db import connection
+import logging
+
+from . import metrics
+from .cache import LRUCache, get_redis_client
+from .models import StripeWebhookEvent
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookDeduplicator:
+    """Answers "have we stored this Stripe event already?" without the database
+
+    Stored event ids are remembered in a bounded in-process LRU and, when
+    configured, in Redis with a TTL so every web worker shares them. Only ids
+    that miss both layers reach the database, where a single
+    INSERT ... ON CONFLICT DO NOTHING settles any remaining race.
+    """
+
+    REDIS_KEY_PREFIX = 'stripe:webhook:seen:'
+
+    def __init__(self, maxsize, redis_url='', ttl=259200):
+        self.ttl = ttl
+        self.redis_url = redis_url
+        self.local = LRUCache(maxsize=maxsize, ttl=ttl)
+
+    @property
+    def redis(self):
+        return get_redis_client(self.redis_url)
+
+    def is_duplicate(self, event_id):
+        """Check the LRU and Redis for an event id"""
+        if event_id in self.local:
+            metrics.increment('webhook_dedup.lru_hits')
+            return True
+
+        client = self.redis
+        if client is not None:
+            try:
+                if client.exists(self.REDIS_KEY_PREFIX + event_id):
+                    metrics.increment('webhook_dedup.redis_hits')
+                    self.local.set(event_id, True)
+                    return True
+            except Exception as e:
+                logger.warning(f"Webhook dedup Redis lookup failed: {str(e)}")
+
+        metrics.increment('webhook_dedup.misses')
+        return False
+
+    def remember(self, event_id):
+        """Record an event id once its row is safely stored"""
+        self.local.set(event_id, True)
+        client = self.redis
+        if client is not None:
+            try:
+                client.set(self.REDIS_KEY_PREFIX + event_id, 1, ex=self.ttl)
+            except Exception as e:
+                logger.warning(f"Webhook dedup Redis write failed: {str(e)}")
+
+    def store(self, webhook_event):
+        """Insert a new webhook event row, returning False if it already existed"""
+        created = insert_ignoring_conflict(webhook_event)
+        if not created:
+            metrics.increment('webhook_dedup.db_conflicts')
+        self.remember(webhook_event.stripe_event_id)
+        return created
+
+    def clear(self):
+        """Forget locally remembered event ids"""
+        self.local.clear()
+
+
+def insert_ignoring_conflict(webhook_event):
+    """INSERT a webhook event row with ON CONFLICT (stripe_event_id) DO NOTHING
+
+    Sets the primary key on the instance and returns True when the row was
+    inserted. Backends that cannot return ids from an upsert fall back to
+    get_or_create.
+    """
+    if not connection.features.can_return_columns_from_insert or connection.vendor not in ('postgresql', 'sqlite'):
+        existing, created = StripeWebhookEvent.objects.get_or_create(
+            stripe_event_id=webhook_event.stripe_event_id,
+            defaults={
+                field.attname: getattr(webhook_event, field.attname)
+                for field in StripeWebhookEvent._meta.concrete_fields
+                if not field.primary_key and field.name != 'stripe_event_id'
+            }
+        )
+        webhook_event.pk = existing.pk
+        webhook_event._state.adding = False
+        return created
+
+    meta = StripeWebhookEvent._meta
+    quote = connection.ops.quote_name
+    fields = [field for field in meta.concrete_fields if not field.primary_key]
+    values = [
+        field.get_db_prep_save(field.pre_save(webhook_event, add=True), connection)
+        for field in fields
+    ]
+    sql = (
+        f"INSERT INTO {quote(meta.db_table)} ({', '.join(quote(field.column) for field in fields)}) "
+        f"VALUES ({', '.join(['%s'] * len(fields))}) "
+        f"ON CONFLICT ({quote(meta.get_field('stripe_event_id').column)}) DO NOTHING "
+        f"RETURNING {quote(meta.pk.column)}"
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, values)
+        row = cursor.fetchone()
+
+    if row is None:
+        return False
+    webhook_event.pk = row[0]
+    webhook_event._state.adding = False
+    return True
+
+
+webhook_deduplicator = WebhookDeduplicator(
+    maxsize=settings.WEBHOOK_DEDUP_CACHE_SIZE,
+    redis_url=settings.WEBHOOK_DEDUP_REDIS_URL,
+    ttl=settings.WEBHOOK_DEDUP_TTL,
+)
@@ -0,0 +1,198 @@
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+import json
+import logging
+
+from . import metrics
+from .cache import LRUCache, get_redis_client
+from .models import UserSubscription
+from .plan_catalog import plan_catalog
+
+logger = logging.getLogger(__name__)
+
+# Subscription fields an entitlement is computed from; saves touching any of
+# them invalidate the user's cached entitlement
+ENTITLEMENT_FIELDS = {'status', 'trial_end_date', 'current_period_end', 'plan'}
+
+
+# User ids resolved per query by compute_entitlement_chunks, kept below SQLite's
+# bound parameter limit
+BULK_CHUNK_SIZE = 500
+
+
+def build_entitlement(user_id, subscription, plan, now):
+    """Entitlement of a user from their subscription's values, or None without one
+
+    Mirrors UserSubscription.is_subscription_active: trial and active
+    subscriptions grant access while the trial or the paid period runs.
+    expires_at is when access ends if nothing changes, None without access.
+    """
+    ends = []
+    if subscription and subscription['status'] in ('trial', 'active'):
+        if subscription['status'] == 'trial' and subscription['trial_end_date'] > now:
+            ends.append(subscription['trial_end_date'])
+        if subscription['current_period_end'] and subscription['current_period_end'] > now:
+            ends.append(subscription['current_period_end'])
+
+    return {
+        'user_id': user_id,
+        'active': bool(ends),
+        'status': subscription['status'] if subscription else None,
+        'plan': plan,
+        'expires_at': max(ends).isoformat() if ends else None,
+    }
+
+
+def compute_entitlement(user_id, now=None):
+    """Whether a user may use paid features, and until when, read from the database"""
+    subscription = UserSubscription.objects.filter(user_id=user_id).values(
+        'status', 'trial_end_date', 'current_period_end', 'plan_id'
+    ).first()
+    plan = plan_catalog.get(subscription['plan_id']).lookup_key if subscription else None
+    return build_entitlement(user_id, subscription, plan, now or timezone.now())
+
+
+def compute_entitlement_chunks(user_ids, chunk_size=BULK_CHUNK_SIZE, now=None):
+    """Entitlements of many users in the order given, as one list per chunk of ids and query
+
+    A generator, so callers can stream the results while only one chunk is in
+    memory. The per-user cache is bypassed: bulk reads would only evict the
+    entries hot single checks rely on.
+    """
+    now = now or timezone.now()
+    for start in range(0, len(user_ids), chunk_size):
+        chunk = user_ids[start:start + chunk_size]
+        subscriptions = {
+            subscription['user_id']: subscription
+            for subscription in UserSubscription.objects.filter(user_id__in=chunk).values(
+                'user_id', 'status', 'trial_end_date', 'current_period_end', 'plan__lookup_key'
+            )
+        }
+        entitlements = []
+        for user_id in chunk:
+            subscription = subscriptions.get(user_id)
+            plan = subscription['plan__lookup_key'] if subscription else None
+            entitlements.append(build_entitlement(user_id, subscription, plan, now))
+        yield entitlements
+
+
+def compute_entitlements(user_ids, chunk_size=BULK_CHUNK_SIZE, now=None):
+    """Entitlements of many users in the order given, with one query per chunk of ids"""
+    for entitlements in compute_entitlement_chunks(user_ids, chunk_size, now):
+        yield from entitlements
+
+
+class EntitlementCache:
+    """Read-through cache of entitlements keyed by user id
+
+    Entries live in a per-process LRU and, when configured, in Redis so every
+    worker shares them. No entry outlives its expires_at, and changes to a
+    subscription's status, plan or dates invalidate its user's entry. With
+    Redis the local copy is kept for at most local_ttl seconds, since
+    invalidations from other processes only reach Redis.
+    """
+
+    REDIS_KEY_PREFIX = 'subscriptions:entitlement:'
+
+    def __init__(self, maxsize, redis_url='', ttl=60, local_ttl=5):
+        self.ttl = ttl
+        self.redis_url = redis_url
+        self.local = LRUCache(maxsize=maxsize, ttl=min(ttl, local_ttl) if redis_url else ttl)
+
+    @property
+    def redis(self):
+        return get_redis_client(self.redis_url)
+
+    def get(self, user_id):
+        """The user's entitlement, from cache when possible"""
+        if not self.ttl:
+            return compute_entitlement(user_id)
+
+        entitlement = self.local.get(user_id)
+        if entitlement is not None and not self._expired(entitlement):
+            metrics.increment('entitlements.lru_hits')
+            return entitlement
+
+        client = self.redis
+        if client is not None:
+            try:
+                raw = client.get(self.REDIS_KEY_PREFIX + str(user_id))
+            except Exception as e:
+                logger.warning(f"Entitlement cache Redis lookup failed: {str(e)}")
+                raw = None
+            if raw is not None:
+                entitlement = json.loads(raw)
+                if not self._expired(entitlement):
+                    metrics.increment('entitlements.redis_hits')
+                    self.local.set(user_id, entitlement, ttl=self._ttl_for(entitlement, self.local.ttl))
+                    return entitlement
+
+        metrics.increment('entitlements.misses')
+        entitlement = compute_entitlement(user_id)
+        self.set(entitlement)
+        return entitlement
+
+    def set(self, entitlement):
+        """Store a freshly computed entitlement"""
+        user_id = entitlement['user_id']
+        self.local.set(user_id, entitlement, ttl=self._ttl_for(entitlement, self.local.ttl))
+        client = self.redis
+        if client is not None:
+            try:
+                client.set(
+                    self.REDIS_KEY_PREFIX + str(user_id), json.dumps(entitlement),
+                    ex=max(1, int(self._ttl_for(entitlement, self.ttl))),
+                )
+            except Exception as e:
+                logger.warning(f"Entitlement cache Redis write failed: {str(e)}")
+
+    def invalidate(self, user_id):
+        """Drop a user's entitlement from every cache layer"""
+        self.local.delete(user_id)
+        client = self.redis
+        if client is not None:
+            try:
+                client.delete(self.REDIS_KEY_PREFIX + str(user_id))
+            except Exception as e:
+                logger.warning(f"Entitlement cache Redis invalidation failed: {str(e)}")
+        metrics.increment('entitlements.invalidations')
+
+    def subscription_changed(self, user_id):
+        """Invalidate now, and again once the current transaction commits"""
+        self.local.delete(user_id)
+        # A read between now and the commit may cache the old state again
+        transaction.on_commit(lambda: self.invalidate(user_id))
+
+    def clear(self):
+        """Forget locally cached entitlements"""
+        self.local.clear()
+
+    def _ttl_for(self, entitlement, ttl):
+        # Never keep an entitlement past the moment it runs out
+        if entitlement['expires_at'] is None:
+            return ttl
+        remaining = (parse_datetime(entitlement['expires_at']) - timezone.now()).total_seconds()
+        return max(0, min(ttl, remaining))
+
+    def _expired(self, entitlement):
+        return entitlement['expires_at'] is not None and parse_datetime(entitlement['expires_at']) <= timezone.now()
+
+
+entitlement_cache = EntitlementCache(
+    maxsize=settings.ENTITLEMENT_CACHE_SIZE,
+    redis_url=settings.ENTITLEMENT_CACHE_REDIS_URL,
+    ttl=settings.ENTITLEMENT_CACHE_TTL,
+)
+
+
+def get_entitlement(user_id):
+    """Access status, plan and access expiry of a user, served from cache"""
+    # A copy, so callers cannot change the cached entry
+    return dict(entitlement_cache.get(user_id))
+
+
+def has_access(user_id):
+    """Whether a user has an active paid or trial subscription right now"""
+    return entitlement_cache.get(user_id)['active']
@@ -0,0 +1,380 @@
+"""A local stand-in for the parts of the Stripe API this app uses
+
+Serves Customer.create/list, Subscription.create/modify/retrieve/list and
+checkout.Session.create from memory, with configurable latency, error and
+rate-limit injection, and can deliver signed webhooks for the changes it makes
+back to stripe_webhook. Run it with `manage.py run_fake_stripe`, or from a
+test or pytest fixture:
+
+    with fake_stripe(latency_ms=50, error_rate=0.01) as server:
+        StripeService.create_customer(user)
+"""
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+import json
+import logging
+import random
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+
+import stripe
+
+from .loadtest import build_event, build_subscription, dumps_event, sign_webhook_payload
+
+logger = logging.getLogger(__name__)
+
+LATENCY_DISTRIBUTIONS = ['fixed', 'uniform', 'exponential', 'lognormal']
+
+
+def decode_form(body):
+    """Decode Stripe's bracketed form encoding (items[0][price]=...) into nested data"""
+    data = {}
+    for key, value in parse_qsl(body, keep_blank_values=True):
+        parts = key.replace(']', '').split('[')
+        target = data
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+        target[parts[-1]] = {'true': True, 'false': False}.get(value, value)
+    return _listify(data)
+
+
+def _listify(value):
+    """Turn dicts keyed by consecutive indexes into lists"""
+    if not isinstance(value, dict):
+        return value
+    value = {key: _listify(item) for key, item in value.items()}
+    if value and all(key.isdigit() for key in value):
+        return [value[key] for key in sorted(value, key=int)]
+    return value
+
+
+def new_id(prefix):
+    """A Stripe-style object id"""
+    return f'{prefix}_{uuid.uuid4().hex[:24]}'
+
+
+class FakeStripeError(Exception):
+    """An error response in Stripe's format"""
+
+    def __init__(self, status, error_type, message, code=None):
+        super().__init__(message)
+        self.status = status
+        self.body = {'error': {'type': error_type, 'message': message, 'code': code}}
+
+
+class FakeStripeServer(ThreadingHTTPServer):
+    """Threaded HTTP server holding the fake Stripe account state"""
+
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency_ms=0, latency_distribution='fixed',
+                 error_rate=0.0, rate_limit_rate=0.0, webhook_url=None, webhook_secret=None, seed=None):
+        super().__init__((host, port), FakeStripeHandler)
+        if latency_distribution not in LATENCY_DISTRIBUTIONS:
+            raise ValueError(f"Unknown latency distribution: {latency_distribution}")
+        self.latency_ms = latency_ms
+        self.latency_distribution = latency_distribution
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.webhook_url = webhook_url
+        self.webhook_secret = webhook_secret
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.customers = {}
+        self.idempotent_customers = {}
+        self.subscriptions = {}
+        self.checkout_sessions = {}
+        self.requests = []
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """Serve requests on a background thread"""
+        self._thread = threading.Thread(target=self.serve_forever, name='fake-stripe', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving and close the socket"""
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
+
+    def sample_latency(self):
+        """Seconds to delay the next response by"""
+        if not self.latency_ms:
+            return 0
+        with self.lock:
+            if self.latency_distribution == 'uniform':
+                value = self.random.uniform(0, 2 * self.latency_ms)
+            elif self.latency_distribution == 'exponential':
+                value = self.random.expovariate(1 / self.latency_ms)
+            elif self.latency_distribution == 'lognormal':
+                # latency_ms is the median; sigma 0.5 gives p99 around 3.2x the median
+                value = self.latency_ms * self.random.lognormvariate(0, 0.5)
+            else:
+                value = self.latency_ms
+        return value / 1000
+
+    def injected_failure(self):
+        """An error to answer with instead of handling the request, if any"""
+        with self.lock:
+            roll = self.random.random()
+        if roll < self.rate_limit_rate:
+            return FakeStripeError(429, 'invalid_request_error', 'Too many requests', 'rate_limit')
+        if roll < self.rate_limit_rate + self.error_rate:
+            return FakeStripeError(500, 'api_error', 'Injected failure')
+        return None
+
+    def send_webhook(self, event_type, stripe_object):
+        """Deliver a signed event for a change to the configured webhook URL"""
+        if not (self.webhook_url and self.webhook_secret):
+            return
+        payload = dumps_event(build_event(event_type, stripe_object))
+        threading.Thread(target=self._post_webhook, args=(payload,), daemon=True).start()
+
+    def _post_webhook(self, payload):
+        request = urllib.request.Request(
+            self.webhook_url,
+            data=payload.encode('utf-8'),
+            headers={
+                'Content-Type': 'application/json',
+                'Stripe-Signature': sign_webhook_payload(payload, self.webhook_secret),
+            },
+            method='POST',
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+        except (urllib.error.URLError, OSError) as e:
+            logger.error(f"Error delivering fake Stripe webhook to {self.webhook_url}: {str(e)}")
+
+    # Resources
+
+    def create_customer(self, params, idempotency_key=None):
+        with self.lock:
+            if idempotency_key in self.idempotent_customers:
+                return self.idempotent_customers[idempotency_key]
+        customer = {
+            'id': new_id('cus'),
+            'object': 'customer',
+            'email': params.get('email'),
+            'name': params.get('name'),
+            'metadata': params.get('metadata') or {},
+            'created': int(time.time()),
+            'livemode': False,
+        }
+        with self.lock:
+            # Stripe replays the first response for a repeated idempotency key
+            if idempotency_key:
+                customer = self.idempotent_customers.setdefault(idempotency_key, customer)
+            self.customers[customer['id']] = customer
+        return customer
+
+    def list_customers(self, params):
+        limit = int(params.get('limit') or 10)
+        customers = list(self.customers.values())
+        if params.get('starting_after'):
+            ids = [customer['id'] for customer in customers]
+            customers = customers[ids.index(params['starting_after']) + 1:]
+        return {
+            'object': 'list',
+            'url': '/v1/customers',
+            'has_more': len(customers) > limit,
+            'data': customers[:limit],
+        }
+
+    def create_subscription(self, params):
+        customer_id = params.get('customer')
+        if customer_id not in self.customers:
+            raise FakeStripeError(400, 'invalid_request_error', f"No such customer: '{customer_id}'", 'resource_missing')
+        items = params.get('items') or []
+        if not items or not items[0].get('price'):
+            raise FakeStripeError(400, 'invalid_request_error', 'Missing required param: items.', 'parameter_missing')
+
+        trial_days = int(params.get('trial_period_days') or 0)
+        subscription = build_subscription(
+            new_id('sub'), customer_id,
+            status='trialing' if trial_days else 'active',
+            price_id=items[0]['price'],
+            metadata=params.get('metadata'),
+        )
+        if trial_days:
+            subscription['trial_end'] = subscription['current_period_start'] + trial_days * 24 * 60 * 60
+        subscription['latest_invoice'] = new_id('in')
+        with self.lock:
+            self.subscriptions[subscription['id']] = subscription
+        self.send_webhook('customer.subscription.created', subscription)
+        return subscription
+
+    def get_subscription(self, subscription_id):
+        subscription = self.subscriptions.get(subscription_id)
+        if subscription is None:
+            raise FakeStripeError(
+                404, 'invalid_request_error', f"No such subscription: '{subscription_id}'", 'resource_missing'
+            )
+        return subscription
+
+    def modify_subscription(self, subscription_id, params):
+        with self.lock:
+            subscription = self.get_subscription(subscription_id)
+            for item in params.get('items') or []:
+                for existing in subscription['items']['data']:
+                    if existing['id'] == item.get('id') and item.get('price'):
+                        existing['price'] = {'id': item['price'], 'object': 'price'}
+            if 'cancel_at_period_end' in params:
+                subscription['cancel_at_period_end'] = params['cancel_at_period_end']
+            subscription['metadata'].update(params.get('metadata') or {})
+        self.send_webhook('customer.subscription.updated', subscription)
+        return subscription
+
+    def list_subscriptions(self, params):
+        limit = int(params.get('limit') or 10)
+        subscriptions = [
+            subscription for subscription in self.subscriptions.values()
+            if params.get('customer') in (None, subscription['customer'])
+            and params.get('status') in (None, 'all', subscription['status'])
+        ]
+        if params.get('starting_after'):
+            ids = [subscription['id'] for subscription in subscriptions]
+            subscriptions = subscriptions[ids.index(params['starting_after']) + 1:]
+        return {
+            'object': 'list',
+            'url': '/v1/subscriptions',
+            'has_more': len(subscriptions) > limit,
+            'data': subscriptions[:limit],
+        }
+
+    def create_checkout_session(self, params):
+        session_id = new_id('cs_test')
+        session = {
+            'id': session_id,
+            'object': 'checkout.session',
+            'customer': params.get('customer'),
+            'mode': params.get('mode'),
+            'status': 'open',
+            'line_items': params.get('line_items') or [],
+            'metadata': params.get('metadata') or {},
+            'success_url': params.get('success_url'),
+            'cancel_url': params.get('cancel_url'),
+            'subscription': None,
+            'expires_at': int(params.get('expires_at') or time.time() + 24 * 60 * 60),
+            'url': f'{self.url}/checkout/{session_id}',
+            'livemode': False,
+        }
+        with self.lock:
+            self.checkout_sessions[session_id] = session
+        return session
+
+    def complete_checkout_session(self, session_id):
+        """Simulate the customer paying: create the subscription and emit checkout.session.completed"""
+        session = self.checkout_sessions.get(session_id)
+        if session is None:
+            raise FakeStripeError(404, 'invalid_request_error', f"No such checkout session: '{session_id}'", 'resource_missing')
+        subscription = self.create_subscription({
+            'customer': session['customer'],
+            'items': [{'price': item.get('price')} for item in session['line_items']],
+            'metadata': session['metadata'],
+        })
+        session.update({'status': 'complete', 'subscription': subscription['id']})
+        self.send_webhook('checkout.session.completed', session)
+        return session
+
+
+    def expire_checkout_session(self, session_id):
+        """Simulate an open session lapsing: emit checkout.session.expired"""
+        session = self.checkout_sessions.get(session_id)
+        if session is None:
+            raise FakeStripeError(404, 'invalid_request_error', f"No such checkout session: '{session_id}'", 'resource_missing')
+        session.update({'status': 'expired', 'url': None})
+        self.send_webhook('checkout.session.expired', session)
+        return session
+
+
+class FakeStripeHandler(BaseHTTPRequestHandler):
+    """Routes Stripe API requests to the server's fake resources"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_api_request('GET')
+
+    def do_POST(self):
+        self.handle_api_request('POST')
+
+    def handle_api_request(self, method):
+        url = urlsplit(self.path)
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf-8') if length else ''
+        params = decode_form(url.query if method == 'GET' else body)
+        server = self.server
+        server.requests.append((method, url.path))
+
+        time.sleep(server.sample_latency())
+        try:
+            error = server.injected_failure()
+            if error is not None:
+                raise error
+            status, result = 200, self.route(method, url.path.rstrip('/').split('/')[1:], params)
+        except FakeStripeError as e:
+            status, result = e.status, e.body
+        self.respond(status, result)
+
+    def route(self, method, parts, params):
+        server = self.server
+        if parts == ['v1', 'customers']:
+            if method == 'POST':
+                return server.create_customer(params, self.headers.get('Idempotency-Key'))
+            return server.list_customers(params)
+        if parts == ['v1', 'subscriptions']:
+            return server.create_subscription(params) if method == 'POST' else server.list_subscriptions(params)
+        if parts[:2] == ['v1', 'subscriptions'] and len(parts) == 3:
+            if method == 'POST':
+                return server.modify_subscription(parts[2], params)
+            return server.get_subscription(parts[2])
+        if parts == ['v1', 'checkout', 'sessions'] and method == 'POST':
+            return server.create_checkout_session(params)
+        if parts[:3] == ['v1', 'checkout', 'sessions'] and parts[4:] == ['expire'] and method == 'POST':
+            return server.expire_checkout_session(parts[3])
+        if parts[:3] == ['_fake', 'checkout', 'sessions'] and parts[4:] == ['complete'] and method == 'POST':
+            return server.complete_checkout_session(parts[3])
+        if parts[:3] == ['_fake', 'checkout', 'sessions'] and parts[4:] == ['expire'] and method == 'POST':
+            return server.expire_checkout_session(parts[3])
+        raise FakeStripeError(404, 'invalid_request_error', f"Unrecognized request URL ({method}: /{'/'.join(parts)})")
+
+    def respond(self, status, result):
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Request-Id', new_id('req'))
+        if status == 429:
+            self.send_header('Stripe-Should-Retry', 'true')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        logger.debug(f"{self.address_string()} {format % args}")
+
+
+@contextmanager
+def fake_stripe(**options):
+    """Run a FakeStripeServer and point the stripe library at it for the duration"""
+    server = FakeStripeServer(**options).start()
+    previous = stripe.api_base, stripe.api_key
+    stripe.api_base = server.url
+    stripe.api_key = stripe.api_key or 'sk_test_fake'
+    try:
+        yield server
+    finally:
+        stripe.api_base, stripe.api_key = previous
+        server.stop()
@@ -0,0 +1,154 @@
+"""Per-operation instrumentation of outbound Stripe calls
+
+Every StripeService method that calls Stripe is wrapped with instrument(),
+which records for each (caller, operation) pair the number of calls, errors
+by exception class, HTTP retries and a latency histogram. Lookups answered
+from a cache are not wrapped, so they never count as calls. The caller is the view or management
+command the call was made from, carried in a contextvar set by
+StripeCallerMiddleware and StripeCommand. The metrics endpoint exposes
+stripe_call_stats() and commands print stripe_call_summary() when they finish.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import threading
+import time
+
+from .metrics import Histogram
+
+_caller = ContextVar('stripe_caller', default='unknown')
+_current_call = ContextVar('stripe_call', default=None)
+
+
+def current_caller():
+    """Name of the view or command Stripe calls are attributed to"""
+    return _caller.get()
+
+
+def set_caller(name):
+    """Attribute Stripe calls in the current context to name, returning a reset token"""
+    return _caller.set(name)
+
+
+@contextmanager
+def stripe_caller(name):
+    """Attribute Stripe calls made in the block to name"""
+    token = _caller.set(name)
+    try:
+        yield
+    finally:
+        _caller.reset(token)
+
+
+class CallStats:
+    """Counts, errors, retries and latency of one operation from one caller"""
+
+    def __init__(self):
+        self.errors = Counter()
+        self.retries = 0
+        self.latency = Histogram()
+
+
+_stats = {}
+_stats_lock = threading.Lock()
+
+
+def record_call(caller, operation, elapsed_ms, error=None, retries=0):
+    """Record the outcome of one Stripe operation"""
+    with _stats_lock:
+        stats = _stats.get((caller, operation))
+        if stats is None:
+            stats = _stats[(caller, operation)] = CallStats()
+        if error:
+            stats.errors[error] += 1
+        stats.retries += retries
+    stats.latency.observe(elapsed_ms)
+
+
+def record_http_attempt():
+    """Note an HTTP request sent for the operation in progress, so resends count as retries"""
+    call = _current_call.get()
+    if call is not None:
+        call['attempts'] += 1
+
+
+def instrument(operation):
+    """Decorate a function making a Stripe call so each call is recorded under operation"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            call = {'attempts': 0}
+            token = _current_call.set(call)
+            started = time.perf_counter()
+            error = None
+            try:
+                return func(*args, **kwargs)
+            except Exception as e:
+                error = type(e).__name__
+                raise
+            finally:
+                _current_call.reset(token)
+                record_call(
+                    current_caller(),
+                    operation,
+                    (time.perf_counter() - started) * 1000,
+                    error=error,
+                    retries=max(call['attempts'] - 1, 0),
+                )
+        return wrapper
+    return decorator
+
+
+def _summarize(stats_list):
+    latency = Histogram()
+    errors = Counter()
+    retries = 0
+    for stats in stats_list:
+        errors.update(stats.errors)
+        retries += stats.retries
+        latency.merge(stats.latency)
+    return {
+        'count': latency.count,
+        'errors': dict(errors),
+        'retries': retries,
+        'latency_ms': latency.snapshot(),
+    }
+
+
+def stripe_call_stats(caller=None):
+    """Stats per operation, and per caller and operation, optionally for one caller only"""
+    with _stats_lock:
+        items = [(key, stats) for key, stats in _stats.items() if caller in (None, key[0])]
+
+    operations = {}
+    for (_, operation), stats in items:
+        operations.setdefault(operation, []).append(stats)
+
+    by_caller = {}
+    for (call_caller, operation), stats in sorted(items):
+        by_caller.setdefault(call_caller, {})[operation] = _summarize([stats])
+
+    return {
+        'operations': {operation: _summarize(stats) for operation, stats in sorted(operations.items())},
+        'by_caller': by_caller,
+    }
+
+
+def stripe_call_summary(caller=None):
+    """One line per operation describing the Stripe calls made, for command output"""
+    lines = []
+    for operation, stats in stripe_call_stats(caller)['operations'].items():
+        latency = stats['latency_ms']
+        errors = sum(stats['errors'].values())
+        lines.append(
+            f'{operation}: {stats["count"]} calls, p50 {latency["p50"]}ms p95 {latency["p95"]}ms '
+            f'p99 {latency["p99"]}ms max {latency["max"]}ms, {errors} errors, {stats["retries"]} retries'
+        )
+    return lines
+
+
+def reset():
+    """Forget all recorded calls"""
+    with _stats_lock:
+        _stats.clear()
@@ -0,0 +1,165 @@
+"""Helpers for generating and signing Stripe webhook traffic in benchmarks"""
+from contextlib import contextmanager
+import hashlib
+import hmac
+import json
+import random
+import threading
+import time
+import uuid
+
+import stripe
+
+
+def sign_webhook_payload(payload, secret, timestamp=None):
+    """Build a Stripe-Signature header for a payload exactly as Stripe does"""
+    timestamp = int(timestamp if timestamp is not None else time.time())
+    signed = f'{timestamp}.{payload}'.encode('utf-8')
+    signature = hmac.new(secret.encode('utf-8'), signed, hashlib.sha256).hexdigest()
+    return f't={timestamp},v1={signature}'
+
+
+def build_subscription(subscription_id, customer_id, status='active', price_id='price_basic_monthly',
+                       metadata=None, now=None):
+    """A Stripe subscription object shaped like the API's"""
+    now = int(now or time.time())
+    return {
+        'id': subscription_id,
+        'object': 'subscription',
+        'customer': customer_id,
+        'status': status,
+        'cancel_at_period_end': False,
+        'created': now,
+        'current_period_start': now,
+        'current_period_end': now + 30 * 24 * 60 * 60,
+        'trial_end': now + 14 * 24 * 60 * 60 if status == 'trialing' else None,
+        'metadata': metadata or {},
+        'items': {
+            'object': 'list',
+            'data': [{
+                'id': f'si_{uuid.uuid4().hex[:14]}',
+                'object': 'subscription_item',
+                'price': {'id': price_id, 'object': 'price'},
+                'quantity': 1,
+            }],
+        },
+        'livemode': False,
+    }
+
+
+def build_invoice(subscription_id, customer_id, paid=True, now=None):
+    """A Stripe invoice object shaped like the API's"""
+    now = int(now or time.time())
+    return {
+        'id': f'in_{uuid.uuid4().hex[:14]}',
+        'object': 'invoice',
+        'customer': customer_id,
+        'subscription': subscription_id,
+        'status': 'paid' if paid else 'open',
+        'paid': paid,
+        'amount_due': 1500,
+        'amount_paid': 1500 if paid else 0,
+        'currency': 'usd',
+        'billing_reason': 'subscription_cycle',
+        'created': now,
+        'lines': {'object': 'list', 'data': []},
+        'livemode': False,
+    }
+
+
+def build_event(event_type, stripe_object, now=None):
+    """Wrap a Stripe object in an event envelope"""
+    return {
+        'id': f'evt_{uuid.uuid4().hex[:24]}',
+        'object': 'event',
+        'api_version': stripe.api_version or '2023-10-16',
+        'created': int(now or time.time()),
+        'type': event_type,
+        'livemode': False,
+        'pending_webhooks': 1,
+        'data': {'object': stripe_object},
+    }
+
+
+# Relative frequency of each event type in generated traffic
+EVENT_MIX = [
+    ('customer.subscription.updated', 40),
+    ('invoice.payment_succeeded', 35),
+    ('invoice.payment_failed', 10),
+    ('customer.subscription.created', 10),
+    ('customer.subscription.deleted', 5),
+]
+
+
+def generate_events(subscriptions, count, seed=None):
+    """Yield realistic webhook events for (subscription_id, customer_id, metadata, price_id) tuples"""
+    rng = random.Random(seed)
+    event_types = [event_type for event_type, _ in EVENT_MIX]
+    weights = [weight for _, weight in EVENT_MIX]
+
+    for _ in range(count):
+        subscription_id, customer_id, metadata, price_id = rng.choice(subscriptions)
+        event_type = rng.choices(event_types, weights)[0]
+        if event_type.startswith('invoice.'):
+            stripe_object = build_invoice(subscription_id, customer_id, paid=event_type.endswith('succeeded'))
+        else:
+            status = {
+                'customer.subscription.created': 'trialing',
+                'customer.subscription.deleted': 'canceled',
+            }.get(event_type, rng.choice(['active', 'active', 'past_due']))
+            stripe_object = build_subscription(
+                subscription_id, customer_id, status=status, price_id=price_id, metadata=metadata
+            )
+        yield build_event(event_type, stripe_object)
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(pct / 100 * len(ordered))) - 1))
+    return ordered[index]
+
+
+def latency_summary(latencies):
+    """p50/p95/p99/max of latencies in seconds, reported in milliseconds"""
+    return {
+        name: round(value * 1000, 3) if value is not None else None
+        for name, value in [
+            ('p50', percentile(latencies, 50)),
+            ('p95', percentile(latencies, 95)),
+            ('p99', percentile(latencies, 99)),
+            ('max', max(latencies) if latencies else None),
+        ]
+    }
+
+
+class StripeCallCounter:
+    """Counts outbound Stripe API requests made through the stripe library"""
+
+    def __init__(self):
+        self.count = 0
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def patch(self):
+        requestor = stripe.api_requestor.APIRequestor
+        original = requestor.request_raw
+        counter = self
+
+        def counting_request_raw(self, *args, **kwargs):
+            with counter._lock:
+                counter.count += 1
+            return original(self, *args, **kwargs)
+
+        requestor.request_raw = counting_request_raw
+        try:
+            yield self
+        finally:
+            requestor.request_raw = original
+
+
+def dumps_event(event):
+    """Serialize an event the way Stripe sends it"""
+    return json.dumps(event, separators=(',', ':'))
@@ -0,0 +1,41 @@
+from contextlib import contextmanager
+from django.core.management.base import BaseCommand
+
+from subscriptions.instrumentation import stripe_call_summary, stripe_caller
+from subscriptions.rate_limit import INTERACTIVE, stripe_priority
+
+
+class StripeCommand(BaseCommand):
+    """Base for commands that call Stripe
+
+    Their Stripe calls are attributed to the command, made at
+    rate_limit_priority, and summarised per operation when the command ends.
+    """
+
+    # Bulk commands set this to BATCH so they yield to live traffic
+    rate_limit_priority = INTERACTIVE
+
+    @property
+    def stripe_caller_name(self):
+        return f'command:{self.__module__.rsplit(".", 1)[-1]}'
+
+    @contextmanager
+    def stripe_context(self):
+        """Tag and prioritise Stripe calls; threads started by the command must enter it again"""
+        with stripe_caller(self.stripe_caller_name), stripe_priority(self.rate_limit_priority):
+            yield
+
+    def execute(self, *args, **options):
+        with self.stripe_context():
+            try:
+                return super().execute(*args, **options)
+            finally:
+                self.write_stripe_summary()
+
+    def write_stripe_summary(self):
+        """Print counts, latency percentiles, errors and retries of the Stripe calls made"""
+        lines = stripe_call_summary(self.stripe_caller_name)
+        if lines:
+            self.stdout.write('Stripe calls:')
+            for line in lines:
+                self.stdout.write(f'  {line}')
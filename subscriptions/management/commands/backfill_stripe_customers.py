@@ -0,0 +1,99 @@
+from django.contrib.auth.models import User
+from subscriptions.management.base import StripeCommand
+from subscriptions.models import StripeCustomer, UserSubscription
+from subscriptions.rate_limit import BATCH
+from subscriptions.services import StripeService
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class Command(StripeCommand):
+    help = 'Fill in the user to Stripe customer mapping from subscriptions and existing Stripe customers'
+    rate_limit_priority = BATCH
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--local-only',
+            action='store_true',
+            help='Only use customer ids stored on subscriptions, without listing Stripe customers',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of rows inserted per query',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show how many users would be mapped without writing',
+        )
+
+    def handle(self, *args, **options):
+        """Backfill Stripe customer mappings"""
+        dry_run = options['dry_run']
+        if dry_run:
+            self.stdout.write(self.style.WARNING('DRY RUN MODE - No changes will be made'))
+
+        missing = set(User.objects.filter(stripe_customer__isnull=True).values_list('id', flat=True))
+        self.stdout.write(f'Found {len(missing)} users without a Stripe customer mapping')
+        if not missing:
+            return
+
+        # Customer ids already on subscriptions are authoritative
+        found = dict(
+            UserSubscription.objects.filter(user_id__in=missing).exclude(stripe_customer_id__isnull=True).exclude(
+                stripe_customer_id=''
+            ).values_list('user_id', 'stripe_customer_id')
+        )
+        from_subscriptions = len(found)
+
+        duplicates = 0
+        if not options['local_only'] and len(found) < len(missing):
+            from_stripe, duplicates = self.list_customers(missing - set(found))
+            found.update(from_stripe)
+
+        # Never map a customer that already belongs to another user
+        taken = set(StripeCustomer.objects.filter(stripe_customer_id__in=found.values()).values_list(
+            'stripe_customer_id', flat=True
+        ))
+        mappings = [
+            StripeCustomer(user_id=user_id, stripe_customer_id=customer_id)
+            for user_id, customer_id in found.items()
+            if customer_id not in taken
+        ]
+
+        if not dry_run:
+            StripeCustomer.objects.bulk_create(mappings, batch_size=options['batch_size'], ignore_conflicts=True)
+
+        if duplicates:
+            self.stdout.write(
+                self.style.WARNING(f'{duplicates} users have more than one Stripe customer; mapped the oldest')
+            )
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Backfill complete. Mapped: {len(mappings)} '
+                f'(from subscriptions: {from_subscriptions}, from Stripe: {len(found) - from_subscriptions}), '
+                f'Not found: {len(missing) - len(found)}'
+            )
+        )
+
+    def list_customers(self, user_ids):
+        """Page through every customer in the account, matching them to users by metadata.user_id"""
+        customers = {}
+        duplicates = set()
+        for customer in StripeService.list_customers(page_size=100):
+            try:
+                user_id = int((customer.get('metadata') or {}).get('user_id'))
+            except (TypeError, ValueError):
+                continue
+            if user_id not in user_ids:
+                continue
+            if user_id in customers:
+                duplicates.add(user_id)
+                # Keep the oldest, which earlier charges most likely went to
+                if customer.get('created', 0) >= customers[user_id].get('created', 0):
+                    continue
+            customers[user_id] = customer
+        return {user_id: customer.id for user_id, customer in customers.items()}, len(duplicates)
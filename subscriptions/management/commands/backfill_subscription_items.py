@@ -0,0 +1,96 @@
+from subscriptions.management.base import StripeCommand
+from subscriptions.models import UserSubscription
+from subscriptions.rate_limit import BATCH
+from subscriptions.services import StripeService, subscription_item_id
+import logging
+import stripe
+
+logger = logging.getLogger(__name__)
+
+
+class Command(StripeCommand):
+    help = 'Fill in stripe_subscription_item_id for subscriptions created before it was stored'
+    rate_limit_priority = BATCH
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--retrieve',
+            action='store_true',
+            help='Retrieve each missing subscription instead of listing every subscription in the account',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=500,
+            help='Number of rows updated per query',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show how many rows would be filled without writing',
+        )
+
+    def handle(self, *args, **options):
+        """Backfill subscription item ids"""
+        dry_run = options['dry_run']
+        if dry_run:
+            self.stdout.write(self.style.WARNING('DRY RUN MODE - No changes will be made'))
+
+        missing = {
+            subscription.stripe_subscription_id: subscription
+            for subscription in UserSubscription.objects.filter(
+                stripe_subscription_item_id__isnull=True,
+            ).exclude(stripe_subscription_id__isnull=True).exclude(stripe_subscription_id='').only(
+                'id', 'stripe_subscription_id', 'stripe_subscription_item_id'
+            )
+        }
+        self.stdout.write(f'Found {len(missing)} subscriptions without an item id')
+        if not missing:
+            return
+
+        if options['retrieve']:
+            found = self.retrieve_items(missing)
+        else:
+            found = self.list_items(missing)
+
+        filled = []
+        for stripe_subscription_id, item_id in found.items():
+            subscription = missing[stripe_subscription_id]
+            subscription.stripe_subscription_item_id = item_id
+            filled.append(subscription)
+
+        if not dry_run:
+            UserSubscription.objects.bulk_update(
+                filled, ['stripe_subscription_item_id'], batch_size=options['batch_size']
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Backfill complete. Filled: {len(filled)}, Not found in Stripe: {len(missing) - len(filled)}'
+            )
+        )
+
+    def list_items(self, missing):
+        """Page through every subscription in the account, 100 per request"""
+        found = {}
+        for stripe_subscription in StripeService.list_subscriptions(status='all', page_size=100):
+            if stripe_subscription.id in missing:
+                item_id = subscription_item_id(stripe_subscription)
+                if item_id:
+                    found[stripe_subscription.id] = item_id
+                if len(found) == len(missing):
+                    break
+        return found
+
+    def retrieve_items(self, missing):
+        """Retrieve the missing subscriptions one at a time"""
+        found = {}
+        for stripe_subscription_id in missing:
+            try:
+                item_id = subscription_item_id(StripeService.get_subscription(stripe_subscription_id))
+            except stripe.error.StripeError as e:
+                self.stdout.write(self.style.ERROR(f'✗ {stripe_subscription_id}: {str(e)}'))
+                continue
+            if item_id:
+                found[stripe_subscription_id] = item_id
+        return found
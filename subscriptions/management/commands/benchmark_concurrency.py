@@ -0,0 +1,189 @@
+from asgiref.sync import async_to_sync
+from concurrent.futures import ThreadPoolExecutor
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.test import AsyncRequestFactory
+from rest_framework.test import APIRequestFactory, force_authenticate
+from subscriptions import async_views, views
+from subscriptions.fake_stripe import LATENCY_DISTRIBUTIONS, fake_stripe
+from subscriptions.loadtest import latency_summary
+from subscriptions.models import SubscriptionPlan, UserSubscription
+from subscriptions.services import StripeService, subscription_item_id
+import asyncio
+import json
+import time
+
+# Prefix for the users created as benchmark fixtures
+FIXTURE_PREFIX = 'concurrency'
+
+
+class Command(BaseCommand):
+    help = 'Compare requests per worker for the sync and async change_plan views under Stripe latency'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--requests',
+            type=int,
+            default=200,
+            help='Number of change_plan requests per mode',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=50,
+            help='Concurrent requests in flight on the async worker',
+        )
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=1,
+            help='Threads of the sync worker (a gunicorn sync worker has one)',
+        )
+        parser.add_argument(
+            '--users',
+            type=int,
+            default=20,
+            help='Number of fixture users the requests are spread over',
+        )
+        parser.add_argument(
+            '--latency-ms',
+            type=float,
+            default=100,
+            help='Injected Stripe API latency in milliseconds',
+        )
+        parser.add_argument(
+            '--latency-distribution',
+            choices=LATENCY_DISTRIBUTIONS,
+            default='fixed',
+            help='How injected latency varies around --latency-ms',
+        )
+        parser.add_argument(
+            '--mode',
+            choices=['sync', 'async', 'both'],
+            default='both',
+            help='Which views to benchmark',
+        )
+        parser.add_argument(
+            '--output',
+            help='Write the JSON result to this file',
+        )
+
+    def handle(self, *args, **options):
+        """Run the benchmark against the local fake Stripe API"""
+        plans = list(SubscriptionPlan.objects.filter(is_active=True).order_by('id')[:2])
+        if len(plans) < 2:
+            raise CommandError('Need two active subscription plans, run seed_subscription_plans first')
+
+        modes = ['sync', 'async'] if options['mode'] == 'both' else [options['mode']]
+        results = {}
+
+        with fake_stripe() as server:
+            users = self.create_fixtures(options['users'], plans[0])
+            server.latency_ms = options['latency_ms']
+            server.latency_distribution = options['latency_distribution']
+            try:
+                for mode in modes:
+                    plan_keys = [plans[i % 2].lookup_key for i in range(1, options['requests'] + 1)]
+                    if mode == 'sync':
+                        latencies, errors, elapsed = self.run_sync(users, plan_keys, options['threads'])
+                    else:
+                        latencies, errors, elapsed = async_to_sync(self.run_async)(
+                            users, plan_keys, options['concurrency']
+                        )
+                    results[mode] = {
+                        'requests': len(latencies),
+                        'errors': errors,
+                        'elapsed_seconds': round(elapsed, 3),
+                        'throughput': round(len(latencies) / elapsed, 2),
+                        'latency_ms': latency_summary(latencies),
+                    }
+                    self.stdout.write(
+                        self.style.SUCCESS(
+                            f'{mode}: {results[mode]["throughput"]} requests/s per worker, '
+                            f'p50 {results[mode]["latency_ms"]["p50"]}ms, '
+                            f'p99 {results[mode]["latency_ms"]["p99"]}ms, errors {errors}'
+                        )
+                    )
+            finally:
+                self.delete_fixtures()
+
+        if 'sync' in results and 'async' in results:
+            self.stdout.write(
+                f'Async serves {results["async"]["throughput"] / results["sync"]["throughput"]:.1f}x '
+                f'the requests per worker at {options["latency_ms"]}ms Stripe latency'
+            )
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump({
+                    'stripe_latency_ms': options['latency_ms'],
+                    'latency_distribution': options['latency_distribution'],
+                    'concurrency': options['concurrency'],
+                    'threads': options['threads'],
+                    'results': results,
+                }, output_file, indent=2)
+            self.stdout.write(f'Result written to {options["output"]}')
+
+    def create_fixtures(self, count, plan):
+        """Create users with subscriptions in the fake Stripe account"""
+        self.delete_fixtures()
+        users = []
+        for index in range(count):
+            user = User.objects.create_user(
+                username=f'{FIXTURE_PREFIX}-user-{index}',
+                email=f'{FIXTURE_PREFIX}-user-{index}@example.com',
+            )
+            customer = StripeService.create_customer(user)
+            stripe_subscription = StripeService.create_subscription(customer.id, plan.stripe_price_id)
+            UserSubscription.objects.create(
+                user=user,
+                plan=plan,
+                status='trial',
+                stripe_subscription_id=stripe_subscription.id,
+                stripe_customer_id=customer.id,
+                stripe_subscription_item_id=subscription_item_id(stripe_subscription),
+            )
+            users.append(user)
+        return users
+
+    def delete_fixtures(self):
+        """Remove fixture users and their subscriptions"""
+        User.objects.filter(username__startswith=f'{FIXTURE_PREFIX}-user-').delete()
+
+    def run_sync(self, users, plan_keys, threads):
+        """Send the requests through the DRF view on a pool of worker threads"""
+        factory = APIRequestFactory()
+
+        def change_plan(index):
+            request = factory.post('/api/subscriptions/change-plan/', {'new_plan_lookup_key': plan_keys[index]},
+                                   format='json')
+            force_authenticate(request, user=users[index % len(users)])
+            started = time.perf_counter()
+            response = views.change_plan(request)
+            return time.perf_counter() - started, response.status_code
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            samples = list(pool.map(change_plan, range(len(plan_keys))))
+        elapsed = time.perf_counter() - start
+        return [latency for latency, _ in samples], sum(1 for _, code in samples if code >= 400), elapsed
+
+    async def run_async(self, users, plan_keys, concurrency):
+        """Send the requests through the async view, concurrency at a time, on one event loop"""
+        factory = AsyncRequestFactory()
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def change_plan(index):
+            async with semaphore:
+                request = factory.post('/api/subscriptions/change-plan/', {'new_plan_lookup_key': plan_keys[index]},
+                                       content_type='application/json')
+                request.user = users[index % len(users)]
+                request._dont_enforce_csrf_checks = True
+                started = time.perf_counter()
+                response = await async_views.change_plan(request)
+                return time.perf_counter() - started, response.status_code
+
+        start = time.perf_counter()
+        samples = await asyncio.gather(*(change_plan(index) for index in range(len(plan_keys))))
+        elapsed = time.perf_counter() - start
+        return [latency for latency, _ in samples], sum(1 for _, code in samples if code >= 400), elapsed
@@ -0,0 +1,302 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test import Client
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from subscriptions.loadtest import (
+    StripeCallCounter, dumps_event, generate_events, latency_summary, sign_webhook_payload,
+)
+from subscriptions.models import StripeWebhookEvent, SubscriptionPlan, UserSubscription
+import json
+import subprocess
+import threading
+import time
+import urllib.error
+import urllib.request
+
+# Prefix for the users and Stripe ids created as benchmark fixtures
+FIXTURE_PREFIX = 'bench'
+
+
+class Command(BaseCommand):
+    help = 'Measure stripe_webhook throughput with locally generated and signed Stripe events'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--events',
+            type=int,
+            default=1000,
+            help='Number of events to send',
+        )
+        parser.add_argument(
+            '--subscriptions',
+            type=int,
+            default=50,
+            help='Number of fixture subscriptions the events are spread over',
+        )
+        parser.add_argument(
+            '--rate',
+            type=float,
+            default=0,
+            help='Target events per second (0 sends as fast as possible)',
+        )
+        parser.add_argument(
+            '--concurrency',
+            type=int,
+            default=1,
+            help='Number of concurrent senders',
+        )
+        parser.add_argument(
+            '--url',
+            help='Send over HTTP to this webhook URL instead of calling the view in-process',
+        )
+        parser.add_argument(
+            '--secret',
+            help='Webhook signing secret (defaults to STRIPE_WEBHOOK_SECRET)',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            default=0,
+            help='Random seed for the generated event mix',
+        )
+        parser.add_argument(
+            '--output',
+            help='Write the JSON result to this file',
+        )
+        parser.add_argument(
+            '--compare',
+            help='Previous JSON result to compare against',
+        )
+        parser.add_argument(
+            '--force',
+            action='store_true',
+            help='Run even with DEBUG off; fixtures are written to and deleted from the configured database',
+        )
+        parser.add_argument(
+            '--keep-data',
+            action='store_true',
+            help='Leave the fixture subscriptions and stored events in the database',
+        )
+
+    def handle(self, *args, **options):
+        """Run the benchmark"""
+        if not settings.DEBUG and not options['force']:
+            raise CommandError(
+                'The benchmark creates and deletes users and subscriptions; '
+                'run it with DEBUG on against a disposable database, or pass --force'
+            )
+
+        in_process = not options['url']
+        secret = options['secret'] or settings.STRIPE_WEBHOOK_SECRET
+        if not secret:
+            if not in_process:
+                raise CommandError('--secret is required when STRIPE_WEBHOOK_SECRET is not set')
+            # The view runs in this process, so any secret will do
+            secret = 'whsec_benchmark'
+
+        fixtures = self.create_fixtures(options['subscriptions'])
+        events = [dumps_event(event) for event in generate_events(fixtures, options['events'], options['seed'])]
+        self.stdout.write(
+            f'Sending {len(events)} events for {len(fixtures)} subscriptions '
+            f'{"in-process" if in_process else "to " + options["url"]}'
+        )
+
+        try:
+            with override_settings(STRIPE_WEBHOOK_SECRET=secret):
+                samples, stripe_calls, elapsed = self.run(events, secret, options)
+        finally:
+            if not options['keep_data']:
+                self.delete_fixtures()
+
+        result = self.summarize(samples, stripe_calls, elapsed, in_process, options)
+        self.report(result)
+
+        if options['compare']:
+            with open(options['compare']) as compare_file:
+                self.compare(json.load(compare_file), result)
+
+        if options['output']:
+            with open(options['output'], 'w') as output_file:
+                json.dump(result, output_file, indent=2)
+            self.stdout.write(f'Result written to {options["output"]}')
+
+    def create_fixtures(self, count):
+        """Create users with Stripe-backed subscriptions for the events to target"""
+        plan = SubscriptionPlan.objects.filter(is_active=True).first()
+        if plan is None:
+            raise CommandError('No active subscription plan, run seed_subscription_plans first')
+
+        self.delete_fixtures()
+        fixtures = []
+        for index in range(count):
+            user = User.objects.create_user(
+                username=f'{FIXTURE_PREFIX}-user-{index}',
+                email=f'{FIXTURE_PREFIX}-user-{index}@example.com',
+            )
+            subscription = UserSubscription.objects.create(
+                user=user,
+                plan=plan,
+                status='active',
+                stripe_subscription_id=f'sub_{FIXTURE_PREFIX}_{index}',
+                stripe_customer_id=f'cus_{FIXTURE_PREFIX}_{index}',
+            )
+            fixtures.append((
+                subscription.stripe_subscription_id,
+                subscription.stripe_customer_id,
+                {'user_id': str(user.id), 'plan_lookup_key': plan.lookup_key},
+                plan.stripe_price_id,
+            ))
+        return fixtures
+
+    def delete_fixtures(self):
+        """Remove fixture users, their subscriptions and the events sent for them"""
+        StripeWebhookEvent.objects.filter(stripe_subscription_id__startswith=f'sub_{FIXTURE_PREFIX}_').delete()
+        User.objects.filter(username__startswith=f'{FIXTURE_PREFIX}-user-').delete()
+
+    def run(self, events, secret, options):
+        """Send every event, returning per-event samples, Stripe calls and wall time"""
+        rate = options['rate']
+        in_process = not options['url']
+        counter = StripeCallCounter()
+        samples = [None] * len(events)
+        next_index = iter(range(len(events)))
+        index_lock = threading.Lock()
+
+        def sender(own_connection):
+            client = Client(HTTP_HOST=settings.ALLOWED_HOSTS[0]) if in_process else None
+            path = reverse('stripe-webhook')
+            try:
+                while True:
+                    with index_lock:
+                        index = next(next_index, None)
+                    if index is None:
+                        return
+
+                    # Latency is measured from the scheduled send time so a slow
+                    # endpoint cannot hide its queueing delay by delaying the sender
+                    scheduled = start + index / rate if rate else time.perf_counter()
+                    delay = scheduled - time.perf_counter()
+                    if delay > 0:
+                        time.sleep(delay)
+
+                    signature = sign_webhook_payload(events[index], secret)
+                    if in_process:
+                        with CaptureQueriesContext(connection) as queries:
+                            response = client.post(
+                                path, events[index], content_type='application/json',
+                                HTTP_STRIPE_SIGNATURE=signature,
+                            )
+                        samples[index] = (time.perf_counter() - scheduled, response.status_code, len(queries))
+                    else:
+                        status = self.post(options['url'], events[index], signature)
+                        samples[index] = (time.perf_counter() - scheduled, status, None)
+            finally:
+                if in_process and own_connection:
+                    connection.close()
+
+        with counter.patch():
+            start = time.perf_counter()
+            if options['concurrency'] == 1:
+                sender(own_connection=False)
+            else:
+                with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+                    for future in [pool.submit(sender, True) for _ in range(options['concurrency'])]:
+                        future.result()
+            elapsed = time.perf_counter() - start
+
+        return samples, counter.count if in_process else None, elapsed
+
+    def post(self, url, payload, signature):
+        """POST one event over HTTP and return the response status"""
+        request = urllib.request.Request(
+            url,
+            data=payload.encode('utf-8'),
+            headers={'Content-Type': 'application/json', 'Stripe-Signature': signature},
+            method='POST',
+        )
+        try:
+            with urllib.request.urlopen(request, timeout=30) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as e:
+            return e.code
+        except (urllib.error.URLError, OSError):
+            return 0
+
+    def summarize(self, samples, stripe_calls, elapsed, in_process, options):
+        """Build the JSON-serializable benchmark result"""
+        latencies = [latency for latency, _, _ in samples]
+        statuses = {}
+        for _, status, _ in samples:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        count = len(samples)
+
+        return {
+            'commit': self.git_commit(),
+            'timestamp': timezone.now().isoformat(),
+            'mode': 'in-process' if in_process else 'http',
+            'async_ingestion': settings.STRIPE_WEBHOOK_ASYNC,
+            'events': count,
+            'subscriptions': options['subscriptions'],
+            'concurrency': options['concurrency'],
+            'target_rate': options['rate'] or None,
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput': round(count / elapsed, 2) if elapsed else None,
+            'latency_ms': latency_summary(latencies),
+            'status_codes': statuses,
+            'errors': sum(n for status, n in statuses.items() if not status.startswith('2')),
+            'db_queries_per_event': (
+                round(sum(queries for _, _, queries in samples) / count, 2) if in_process and count else None
+            ),
+            'stripe_calls_per_event': round(stripe_calls / count, 3) if stripe_calls is not None and count else None,
+        }
+
+    def git_commit(self):
+        """Short hash of the checked-out commit, if available"""
+        try:
+            return subprocess.run(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                capture_output=True, text=True, check=True, cwd=settings.BASE_DIR,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def report(self, result):
+        """Print the headline numbers"""
+        latency = result['latency_ms']
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Benchmark complete. Events: {result["events"]}, '
+                f'Throughput: {result["throughput"]}/s, '
+                f'p50: {latency["p50"]}ms, p95: {latency["p95"]}ms, p99: {latency["p99"]}ms, '
+                f'Errors: {result["errors"]}'
+            )
+        )
+        if result['db_queries_per_event'] is not None:
+            self.stdout.write(
+                f'DB queries/event: {result["db_queries_per_event"]}, '
+                f'Stripe calls/event: {result["stripe_calls_per_event"]}'
+            )
+
+    def compare(self, baseline, result):
+        """Print the change in each headline metric against a previous result"""
+        self.stdout.write(f'Compared with {baseline.get("commit") or "baseline"}:')
+        metrics = [
+            ('throughput', lambda r: r.get('throughput')),
+            ('p50 ms', lambda r: r.get('latency_ms', {}).get('p50')),
+            ('p95 ms', lambda r: r.get('latency_ms', {}).get('p95')),
+            ('p99 ms', lambda r: r.get('latency_ms', {}).get('p99')),
+            ('db queries/event', lambda r: r.get('db_queries_per_event')),
+            ('stripe calls/event', lambda r: r.get('stripe_calls_per_event')),
+        ]
+        for name, value in metrics:
+            before, after = value(baseline), value(result)
+            if before is None or after is None:
+                continue
+            change = f' ({(after - before) / before * 100:+.1f}%)' if before else ''
+            self.stdout.write(f'  {name}: {before} -> {after}{change}')
@@ -0,0 +1,72 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from subscriptions.models import StripeWebhookEvent
+from subscriptions.webhooks import apply_storage_policy
+import json
+
+
+class Command(BaseCommand):
+    help = 'Rewrite stored webhook payloads under the configured storage policy'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--policy',
+            choices=['trimmed', 'compressed'],
+            default=None,
+            help='Storage policy to apply (defaults to WEBHOOK_PAYLOAD_STORAGE)',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help='Number of rows rewritten per query',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Report the space that would be saved without writing',
+        )
+
+    def handle(self, *args, **options):
+        """Compact stored webhook payloads"""
+        policy = options['policy'] or settings.WEBHOOK_PAYLOAD_STORAGE
+        batch_size = options['batch_size']
+        dry_run = options['dry_run']
+
+        if policy == 'full':
+            self.stdout.write(self.style.WARNING('Storage policy is "full", nothing to compact'))
+            return
+
+        if dry_run:
+            self.stdout.write(self.style.WARNING('DRY RUN MODE - No changes will be made'))
+
+        # Rows already stored compressed are left alone
+        events = StripeWebhookEvent.objects.filter(data_encoding='').order_by('id')
+
+        rewritten = 0
+        bytes_before = 0
+        bytes_after = 0
+        last_id = 0
+
+        while True:
+            batch = list(events.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                break
+            last_id = batch[-1].id
+
+            for webhook_event in batch:
+                bytes_before += len(json.dumps(webhook_event.data))
+                apply_storage_policy(webhook_event, webhook_event.data, policy)
+                bytes_after += len(json.dumps(webhook_event.data)) + len(webhook_event.data_compressed or b'')
+
+            if not dry_run:
+                StripeWebhookEvent.objects.bulk_update(batch, ['data', 'data_compressed', 'data_encoding'])
+            rewritten += len(batch)
+            self.stdout.write(f'Compacted {rewritten} events')
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Compaction complete. Events: {rewritten}, '
+                f'Payload bytes: {bytes_before} -> {bytes_after}'
+            )
+        )
@@ -1,15 +1,18 @@
-from django.core.management.base import BaseCommand
 from django.utils import timezone
 from datetime import timedelta
-from subscriptions.models import UserSubscription, SubscriptionHistory
+from subscriptions.management.base import StripeCommand
+from subscriptions.models import UserSubscription
+from subscriptions.rate_limit import BATCH
 from subscriptions.services import SubscriptionService
+from subscriptions.state_machine import transition
 import logging
 
 logger = logging.getLogger(__name__)
 
 
-class Command(BaseCommand):
+class Command(StripeCommand):
     help = 'Process trial expirations and update subscription statuses'
+    rate_limit_priority = BATCH
 
     def add_arguments(self, parser):
         parser.add_argument(
@@ -46,37 +49,12 @@ class Command(BaseCommand):
                         # Try to sync with Stripe to get latest status
                         try:
                             SubscriptionService.sync_stripe_subscription(subscription.stripe_subscription_id)
-                            
-                            # If still in trial status after sync, mark as canceled
-                            subscription.refresh_from_db()
-                            if subscription.status == 'trial':
-                                subscription.status = 'canceled'
-                                subscription.canceled_at = timezone.now()
-                                subscription.save()
-                                
-                                # Log the event
-                                SubscriptionHistory.objects.create(
-                                    subscription=subscription,
-                                    event_type='trial_ended',
-                                    description="Trial period expired",
-                                )
                         except Exception as e:
                             logger.error(f"Error syncing subscription {subscription.id}: {str(e)}")
-                            subscription.status = 'canceled'
-                            subscription.canceled_at = timezone.now()
-                            subscription.save()
-                    else:
-                        # No Stripe subscription, just mark as canceled
-                        subscription.status = 'canceled'
-                        subscription.canceled_at = timezone.now()
-                        subscription.save()
-                        
-                        # Log the event
-                        SubscriptionHistory.objects.create(
-                            subscription=subscription,
-                            event_type='trial_ended',
-                            description="Trial period expired",
-                        )
+                    
+                    # Cancel only if still in trial, so a payment that
+                    # activated it meanwhile is never overwritten
+                    self.end_trial(subscription)
                 
                 processed_count += 1
                 self.stdout.write(
@@ -116,4 +94,15 @@ class Command(BaseCommand):
             self.style.SUCCESS(
                 f'Processing complete. Processed: {processed_count}, Errors: {error_count}'
             )
-        )
\ No newline at end of file
+        )
+
+    def end_trial(self, subscription):
+        """Cancel an expired trial unless it left the trial status first"""
+        return transition(
+            subscription,
+            'canceled',
+            'trial_ended',
+            "Trial period expired",
+            only_from=('trial',),
+            canceled_at=timezone.now(),
+        )
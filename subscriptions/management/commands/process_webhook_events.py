@@ -0,0 +1,126 @@
+from django.conf import settings
+from subscriptions.management.base import StripeCommand
+from subscriptions.webhooks import claim_webhook_events, pending_webhook_events, process_webhook_batch
+import logging
+import os
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Command(StripeCommand):
+    help = 'Dispatch stored Stripe webhook events that have not been processed yet'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=100,
+            help='Number of events to claim per batch',
+        )
+        parser.add_argument(
+            '--threads',
+            type=int,
+            default=4,
+            help='Number of subscriptions to process concurrently',
+        )
+        parser.add_argument(
+            '--lease-seconds',
+            type=int,
+            default=60,
+            help='Seconds a claimed batch stays leased before other workers may retry it',
+        )
+        parser.add_argument(
+            '--coalesce-window',
+            type=float,
+            default=settings.WEBHOOK_COALESCE_WINDOW,
+            help='Seconds of quiet to wait for before applying a subscription\'s burst of events',
+        )
+        parser.add_argument(
+            '--coalesce-max-delay',
+            type=float,
+            default=settings.WEBHOOK_COALESCE_MAX_DELAY,
+            help='Maximum seconds an event may be held back for coalescing',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Seconds to sleep when the queue is empty',
+        )
+        parser.add_argument(
+            '--max-attempts',
+            type=int,
+            default=5,
+            help='Skip events that have already failed this many times',
+        )
+        parser.add_argument(
+            '--worker-id',
+            default=f'{socket.gethostname()}:{os.getpid()}',
+            help='Identifier recorded on claimed events',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Drain the current backlog and exit instead of polling forever',
+        )
+
+    def handle(self, *args, **options):
+        """Drain unprocessed webhook events"""
+        batch_size = options['batch_size']
+        threads = options['threads']
+        lease_seconds = options['lease_seconds']
+        poll_interval = options['poll_interval']
+        max_attempts = options['max_attempts']
+        worker_id = options['worker_id']
+        once = options['once']
+
+        self.stdout.write(f'Webhook worker {worker_id} started with {threads} threads')
+
+        total_processed = 0
+        total_errors = 0
+        started = time.monotonic()
+
+        while True:
+            batch = claim_webhook_events(
+                worker_id,
+                batch_size=batch_size,
+                lease_seconds=lease_seconds,
+                max_attempts=max_attempts,
+                coalesce_window=options['coalesce_window'],
+                coalesce_max_delay=options['coalesce_max_delay'],
+            )
+
+            if not batch:
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+
+            batch_started = time.monotonic()
+            processed, errors = process_webhook_batch(batch, threads=threads)
+            elapsed = time.monotonic() - batch_started
+
+            lags = [(event.processed_at - event.created_at).total_seconds() for event in processed]
+            total_processed += len(processed)
+            total_errors += errors
+
+            self.stdout.write(
+                f'Processed {len(processed)} events ({errors} errors) in {elapsed:.2f}s, '
+                f'{len(processed) / elapsed if elapsed else 0:.1f} events/s, '
+                f'lag avg {sum(lags) / len(lags) if lags else 0:.2f}s max {max(lags, default=0):.2f}s, '
+                f'backlog {pending_webhook_events().count()}'
+            )
+
+            # In --once mode stop when nothing in the claimed batch could make progress
+            if once and not processed:
+                break
+
+        elapsed = time.monotonic() - started
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Processing complete. Processed: {total_processed}, Errors: {total_errors}, '
+                f'Throughput: {total_processed / elapsed if elapsed else 0:.1f} events/s'
+            )
+        )
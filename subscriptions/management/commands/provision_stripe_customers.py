@@ -0,0 +1,98 @@
+from subscriptions.management.base import StripeCommand
+from subscriptions.provisioning import (
+    MAX_ATTEMPTS, claim_provisioning_jobs, pending_provisioning_jobs, provision_customer, provisioning_lag,
+)
+from subscriptions.rate_limit import BATCH
+import logging
+import os
+import socket
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class Command(StripeCommand):
+    help = 'Create Stripe customers for newly registered users ahead of their first checkout'
+    rate_limit_priority = BATCH
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=50,
+            help='Number of jobs to claim per batch',
+        )
+        parser.add_argument(
+            '--lease-seconds',
+            type=int,
+            default=60,
+            help='Seconds a claimed batch stays leased before other workers may retry it',
+        )
+        parser.add_argument(
+            '--poll-interval',
+            type=float,
+            default=1.0,
+            help='Seconds to sleep when no job is due',
+        )
+        parser.add_argument(
+            '--max-attempts',
+            type=int,
+            default=MAX_ATTEMPTS,
+            help='Give up on jobs that have already failed this many times',
+        )
+        parser.add_argument(
+            '--worker-id',
+            default=f'{socket.gethostname()}:{os.getpid()}',
+            help='Identifier recorded on claimed jobs',
+        )
+        parser.add_argument(
+            '--once',
+            action='store_true',
+            help='Work through the jobs due now and exit instead of polling forever',
+        )
+
+    def handle(self, *args, **options):
+        """Provision queued Stripe customers"""
+        worker_id = options['worker_id']
+        max_attempts = options['max_attempts']
+        self.stdout.write(f'Customer provisioning worker {worker_id} started')
+
+        total_provisioned = 0
+        total_errors = 0
+
+        while True:
+            jobs = claim_provisioning_jobs(
+                worker_id,
+                batch_size=options['batch_size'],
+                lease_seconds=options['lease_seconds'],
+                max_attempts=max_attempts,
+            )
+
+            if not jobs:
+                if options['once']:
+                    break
+                time.sleep(options['poll_interval'])
+                continue
+
+            lags = []
+            errors = 0
+            for job in jobs:
+                try:
+                    provision_customer(job)
+                    lags.append(provisioning_lag(job))
+                except Exception:
+                    errors += 1
+            total_provisioned += len(lags)
+            total_errors += errors
+
+            self.stdout.write(
+                f'Provisioned {len(lags)} customers ({errors} errors), '
+                f'lag avg {sum(lags) / len(lags) if lags else 0:.2f}s max {max(lags, default=0):.2f}s, '
+                f'queue depth {pending_provisioning_jobs(max_attempts).count()}'
+            )
+
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Provisioning complete. Provisioned: {total_provisioned}, Errors: {total_errors}'
+            )
+        )
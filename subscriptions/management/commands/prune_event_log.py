@@ -0,0 +1,175 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import connection, transaction
+from django.utils import timezone
+from datetime import timedelta
+from pathlib import Path
+from subscriptions.models import StripeWebhookEvent, SubscriptionHistory
+import gzip
+import json
+
+
+def month_start(moment):
+    """First instant of the month containing moment"""
+    return moment.replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+
+
+def next_month(moment):
+    """First instant of the month after the one starting at moment"""
+    return (moment + timedelta(days=32)).replace(day=1)
+
+
+def webhook_event_record(webhook_event):
+    """Archive representation of a webhook event, with its payload decoded"""
+    return {
+        'id': webhook_event.id,
+        'stripe_event_id': webhook_event.stripe_event_id,
+        'event_type': webhook_event.event_type,
+        'stripe_subscription_id': webhook_event.stripe_subscription_id,
+        'stripe_created': webhook_event.stripe_created,
+        'created_at': webhook_event.created_at,
+        'processed_at': webhook_event.processed_at,
+        'attempts': webhook_event.attempts,
+        'data': webhook_event.payload,
+    }
+
+
+def history_record(history):
+    """Archive representation of a subscription history row"""
+    return {
+        'id': history.id,
+        'subscription_id': history.subscription_id,
+        'event_type': history.event_type,
+        'description': history.description,
+        'metadata': history.metadata,
+        'created_at': history.created_at,
+    }
+
+
+# Tables managed by the retention job: option name -> (queryset factory,
+# archive serializer, retention setting)
+EVENT_LOG_TABLES = {
+    # Unprocessed webhook events are never pruned
+    'webhook_events': (
+        lambda: StripeWebhookEvent.objects.filter(processed=True),
+        webhook_event_record,
+        'WEBHOOK_EVENT_RETENTION_DAYS',
+    ),
+    'subscription_history': (
+        lambda: SubscriptionHistory.objects.all(),
+        history_record,
+        'SUBSCRIPTION_HISTORY_RETENTION_DAYS',
+    ),
+}
+
+
+class Command(BaseCommand):
+    help = 'Archive and delete webhook events and subscription history past their retention window'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--table',
+            choices=sorted(EVENT_LOG_TABLES) + ['all'],
+            default='all',
+            help='Table to prune',
+        )
+        parser.add_argument(
+            '--days',
+            type=int,
+            help='Retention window in days, overriding the per-table setting',
+        )
+        parser.add_argument(
+            '--archive-dir',
+            default=settings.EVENT_LOG_ARCHIVE_DIR,
+            help='Directory for the gzipped JSONL monthly archives',
+        )
+        parser.add_argument(
+            '--no-archive',
+            action='store_true',
+            help='Delete expired rows without archiving them',
+        )
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=5000,
+            help='Rows archived and deleted per transaction',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Show what would be pruned without making changes',
+        )
+
+    def handle(self, *args, **options):
+        """Prune the event log tables"""
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('DRY RUN MODE - No changes will be made'))
+
+        tables = sorted(EVENT_LOG_TABLES) if options['table'] == 'all' else [options['table']]
+        for table in tables:
+            self.prune_table(table, options)
+
+    def prune_table(self, table, options):
+        """Archive and delete one table's expired rows, a month at a time"""
+        queryset_factory, serialize, retention_setting = EVENT_LOG_TABLES[table]
+        days = options['days'] if options['days'] is not None else getattr(settings, retention_setting)
+        cutoff = timezone.now() - timedelta(days=days)
+        expired = queryset_factory().filter(created_at__lt=cutoff)
+
+        oldest = expired.order_by('created_at').values_list('created_at', flat=True).first()
+        if oldest is None:
+            self.stdout.write(f'{table}: nothing older than {days} days')
+            return
+
+        total = 0
+        month = month_start(oldest)
+        while month < cutoff:
+            end = min(next_month(month), cutoff)
+            rows = expired.filter(created_at__gte=month, created_at__lt=end)
+
+            if options['dry_run']:
+                count = rows.count()
+                if count:
+                    self.stdout.write(f'{table} {month:%Y-%m}: would prune {count} rows')
+                total += count
+            else:
+                total += self.prune_month(table, rows, serialize, month, options)
+            month = next_month(month)
+
+        self.stdout.write(self.style.SUCCESS(f'{table}: pruned {total} rows older than {days} days'))
+
+        if total and not options['dry_run'] and connection.vendor == 'postgresql':
+            # Reclaim the dead tuples now so later scans and vacuums stay cheap
+            model = queryset_factory().model
+            with connection.cursor() as cursor:
+                cursor.execute(f'VACUUM (ANALYZE) {connection.ops.quote_name(model._meta.db_table)}')
+
+    def prune_month(self, table, rows, serialize, month, options):
+        """Archive and delete one month of rows in bounded batches"""
+        archive = None
+        if not options['no_archive']:
+            archive_dir = Path(options['archive_dir'])
+            archive_dir.mkdir(parents=True, exist_ok=True)
+            archive = archive_dir / f'{table}-{month:%Y-%m}.jsonl.gz'
+
+        pruned = 0
+        while True:
+            batch = list(rows.order_by('id')[:options['batch_size']])
+            if not batch:
+                break
+
+            # Rows are only deleted after their archive lines are flushed;
+            # appending adds a new gzip member, which readers handle transparently
+            if archive is not None:
+                with gzip.open(archive, 'at', encoding='utf-8') as archive_file:
+                    for row in batch:
+                        archive_file.write(json.dumps(serialize(row), cls=DjangoJSONEncoder) + '\n')
+
+            with transaction.atomic():
+                rows.model.objects.filter(id__in=[row.id for row in batch]).delete()
+            pruned += len(batch)
+
+        if pruned:
+            self.stdout.write(f'{table} {month:%Y-%m}: pruned {pruned} rows' + (f' to {archive}' if archive else ''))
+        return pruned
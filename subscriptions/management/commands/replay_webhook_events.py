@@ -0,0 +1,203 @@
+from django.core.management.base import CommandError
+from django.db import connection
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from datetime import datetime, time as dt_time
+from subscriptions.management.base import StripeCommand
+from subscriptions.models import StripeWebhookEvent
+from subscriptions.rate_limit import BATCH
+from subscriptions.webhooks import lease_webhook_event, process_webhook_event
+import logging
+import os
+import queue
+import socket
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Sentinel telling a replay thread its queue is drained
+_STOP = object()
+
+
+def parse_moment(value):
+    """Parse an ISO date or datetime option into an aware datetime"""
+    moment = parse_datetime(value)
+    if moment is None:
+        day = parse_date(value)
+        if day is None:
+            raise CommandError(f'Invalid date or datetime: {value}')
+        moment = datetime.combine(day, dt_time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+class Command(StripeCommand):
+    help = 'Re-dispatch stored Stripe webhook events that were never processed or failed'
+    rate_limit_priority = BATCH
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers',
+            type=int,
+            default=4,
+            help='Number of concurrent replay threads',
+        )
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=500,
+            help='Rows fetched per database round trip',
+        )
+        parser.add_argument(
+            '--event-type',
+            action='append',
+            dest='event_types',
+            help='Only replay this event type (may be repeated)',
+        )
+        parser.add_argument(
+            '--since',
+            help='Only replay events received at or after this date/datetime',
+        )
+        parser.add_argument(
+            '--until',
+            help='Only replay events received before this date/datetime',
+        )
+        parser.add_argument(
+            '--failed-only',
+            action='store_true',
+            help='Only replay events whose last attempt raised an error',
+        )
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help='Count matching events without dispatching them',
+        )
+
+    def handle(self, *args, **options):
+        """Replay unprocessed webhook events"""
+        workers = max(1, options['workers'])
+        chunk_size = options['chunk_size']
+
+        events = StripeWebhookEvent.objects.filter(processed=False)
+        if options['event_types']:
+            events = events.filter(event_type__in=options['event_types'])
+        if options['since']:
+            events = events.filter(created_at__gte=parse_moment(options['since']))
+        if options['until']:
+            events = events.filter(created_at__lt=parse_moment(options['until']))
+        if options['failed_only']:
+            events = events.exclude(last_error='')
+
+        self.stdout.write(f'Found {events.count()} events to replay')
+        if options['dry_run']:
+            self.stdout.write(self.style.WARNING('DRY RUN MODE - No events will be dispatched'))
+            return
+
+        self.worker_id = f'replay:{socket.gethostname()}:{os.getpid()}'
+        self.lock = threading.Lock()
+        self.processed_count = 0
+        self.skipped_count = 0
+        self.error_count = 0
+        self.failed_keys = set()
+        self.started = time.monotonic()
+
+        # Each thread owns a bounded queue and every event for a subscription is
+        # routed to the same queue, so per-subscription order is preserved
+        queues = [queue.Queue(maxsize=chunk_size) for _ in range(workers)]
+        threads = []
+        if workers > 1:
+            for work_queue in queues:
+                thread = threading.Thread(target=self.run_worker, args=(work_queue,), daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        stream = events.order_by('created_at', 'id').iterator(chunk_size=chunk_size)
+        for webhook_event in stream:
+            if workers == 1:
+                self.replay(webhook_event)
+                continue
+            index = hash(self.ordering_key(webhook_event)) % workers
+            self.enqueue(queues[index], threads[index], webhook_event)
+
+        for work_queue in queues[:len(threads)]:
+            work_queue.put(_STOP)
+        for thread in threads:
+            thread.join()
+
+        elapsed = time.monotonic() - self.started
+        self.stdout.write(
+            self.style.SUCCESS(
+                f'Replay complete. Processed: {self.processed_count}, Skipped: {self.skipped_count}, '
+                f'Errors: {self.error_count}, '
+                f'Throughput: {self.processed_count / elapsed if elapsed else 0:.1f} events/s'
+            )
+        )
+
+    def enqueue(self, work_queue, thread, webhook_event):
+        """Hand an event to a replay thread, failing instead of waiting on a thread that died"""
+        while True:
+            try:
+                work_queue.put(webhook_event, timeout=1)
+                return
+            except queue.Full:
+                if not thread.is_alive():
+                    raise CommandError(f'Replay thread {thread.name} stopped unexpectedly')
+
+    def run_worker(self, work_queue):
+        """Replay events from a queue until the stop sentinel arrives"""
+        try:
+            # Threads start with a fresh context, so tag and prioritise calls again
+            with self.stripe_context():
+                while True:
+                    webhook_event = work_queue.get()
+                    if webhook_event is _STOP:
+                        break
+                    self.replay(webhook_event)
+        finally:
+            connection.close()
+
+    def ordering_key(self, webhook_event):
+        """Events sharing a key must be applied in order"""
+        return webhook_event.stripe_subscription_id or webhook_event.stripe_event_id
+
+    def replay(self, webhook_event):
+        """Lease and dispatch one event, recording the outcome"""
+        key = self.ordering_key(webhook_event)
+
+        # Later events for a subscription wait until its failed event succeeds
+        with self.lock:
+            blocked = key in self.failed_keys
+            if blocked:
+                self.skipped_count += 1
+        if blocked:
+            return
+
+        # Any error, leasing included, is recorded against the event so the
+        # thread keeps draining its queue
+        try:
+            # Leasing makes repeated or concurrent runs safe: an event that another
+            # replay or worker is handling, or that was processed since, is skipped
+            if not lease_webhook_event(webhook_event, self.worker_id):
+                with self.lock:
+                    self.skipped_count += 1
+                return
+
+            process_webhook_event(webhook_event)
+            with self.lock:
+                self.processed_count += 1
+                done = self.processed_count
+        except Exception as e:
+            logger.error(f"Error replaying webhook event {webhook_event.stripe_event_id}: {str(e)}")
+            with self.lock:
+                self.error_count += 1
+                self.failed_keys.add(key)
+            return
+
+        if done % 1000 == 0:
+            elapsed = time.monotonic() - self.started
+            self.stdout.write(
+                f'Replayed {done} events, {done / elapsed if elapsed else 0:.1f} events/s, '
+                f'{self.error_count} errors'
+            )
@@ -0,0 +1,81 @@
+from django.core.management.base import BaseCommand
+from subscriptions.fake_stripe import LATENCY_DISTRIBUTIONS, FakeStripeServer
+
+
+class Command(BaseCommand):
+    help = 'Serve a local fake Stripe API for load tests (point STRIPE_API_BASE at it)'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--host',
+            default='127.0.0.1',
+            help='Interface to listen on',
+        )
+        parser.add_argument(
+            '--port',
+            type=int,
+            default=12111,
+            help='Port to listen on',
+        )
+        parser.add_argument(
+            '--latency-ms',
+            type=float,
+            default=0,
+            help='Typical response latency in milliseconds',
+        )
+        parser.add_argument(
+            '--latency-distribution',
+            choices=LATENCY_DISTRIBUTIONS,
+            default='fixed',
+            help='How response latency varies around --latency-ms',
+        )
+        parser.add_argument(
+            '--error-rate',
+            type=float,
+            default=0.0,
+            help='Fraction of requests answered with a 500 api_error',
+        )
+        parser.add_argument(
+            '--rate-limit-rate',
+            type=float,
+            default=0.0,
+            help='Fraction of requests answered with a 429 rate limit error',
+        )
+        parser.add_argument(
+            '--webhook-url',
+            help='Deliver signed webhooks for subscription changes to this URL',
+        )
+        parser.add_argument(
+            '--webhook-secret',
+            help='Secret used to sign delivered webhooks (STRIPE_WEBHOOK_SECRET of the app)',
+        )
+        parser.add_argument(
+            '--seed',
+            type=int,
+            help='Random seed for latency and failure injection',
+        )
+
+    def handle(self, *args, **options):
+        """Serve the fake Stripe API until interrupted"""
+        server = FakeStripeServer(
+            host=options['host'],
+            port=options['port'],
+            latency_ms=options['latency_ms'],
+            latency_distribution=options['latency_distribution'],
+            error_rate=options['error_rate'],
+            rate_limit_rate=options['rate_limit_rate'],
+            webhook_url=options['webhook_url'],
+            webhook_secret=options['webhook_secret'],
+            seed=options['seed'],
+        )
+        self.stdout.write(self.style.SUCCESS(f'Fake Stripe API listening on {server.url}'))
+        if options['webhook_url'] and not options['webhook_secret']:
+            self.stdout.write(self.style.WARNING('No --webhook-secret given, webhooks will not be delivered'))
+
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        self.stdout.write('Fake Stripe API stopped')
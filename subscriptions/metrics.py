@@ -0,0 +1,87 @@
+from collections import defaultdict
+import threading
+
+_counters = defaultdict(int)
+_lock = threading.Lock()
+
+# Upper bounds in milliseconds of the latency histogram buckets
+LATENCY_BUCKETS_MS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float('inf'))
+
+
+def increment(name, value=1):
+    """Increment a process-wide counter"""
+    with _lock:
+        _counters[name] += value
+
+
+def get_counters(prefix=''):
+    """Return a snapshot of counters, optionally limited to names with a prefix"""
+    with _lock:
+        return {name: value for name, value in sorted(_counters.items()) if name.startswith(prefix)}
+
+
+def reset():
+    """Clear all counters"""
+    with _lock:
+        _counters.clear()
+
+
+class Histogram:
+    """Fixed-bucket histogram of observed values, cheap enough to update on every call"""
+
+    def __init__(self, bounds=LATENCY_BUCKETS_MS):
+        self.bounds = bounds
+        self.buckets = [0] * len(bounds)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        """Record one value"""
+        with self._lock:
+            for index, bound in enumerate(self.bounds):
+                if value <= bound:
+                    self.buckets[index] += 1
+                    break
+            self.count += 1
+            self.total += value
+            self.max = max(self.max, value)
+
+    def merge(self, other):
+        """Add another histogram's observations to this one"""
+        with other._lock:
+            buckets, count, total, largest = list(other.buckets), other.count, other.total, other.max
+        with self._lock:
+            self.buckets = [mine + theirs for mine, theirs in zip(self.buckets, buckets)]
+            self.count += count
+            self.total += total
+            self.max = max(self.max, largest)
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile, capped at the largest value seen"""
+        if not self.count:
+            return 0
+        rank = q * self.count
+        seen = 0
+        for bound, bucket in zip(self.bounds, self.buckets):
+            seen += bucket
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def snapshot(self):
+        """Count, mean, estimated percentiles and bucket counts"""
+        with self._lock:
+            return {
+                'count': self.count,
+                'mean': round(self.total / self.count, 2) if self.count else 0,
+                'p50': round(self.quantile(0.50), 2),
+                'p95': round(self.quantile(0.95), 2),
+                'p99': round(self.quantile(0.99), 2),
+                'max': round(self.max, 2),
+                'buckets': {
+                    ('+Inf' if bound == float('inf') else str(bound)): bucket
+                    for bound, bucket in zip(self.bounds, self.buckets)
+                },
+            }
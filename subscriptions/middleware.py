@@ -0,0 +1,17 @@
+from django.utils.deprecation import MiddlewareMixin
+
+from .instrumentation import set_caller
+
+
+class StripeCallerMiddleware(MiddlewareMixin):
+    """Attribute Stripe calls made while handling a request to the view handling it"""
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        name = match.view_name if match and match.view_name else getattr(view_func, '__name__', 'unknown')
+        set_caller(f'view:{name}')
+
+    def process_response(self, request, response):
+        # Worker threads serve many requests, so do not leave the tag behind
+        set_caller('unknown')
+        return response
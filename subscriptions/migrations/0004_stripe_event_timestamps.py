@@ -0,0 +1,23 @@
+# Generated by Django 4.2.7 on 2026-10-16 13:39
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0003_webhook_event_claiming'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripewebhookevent',
+            name='stripe_created',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='usersubscription',
+            name='stripe_synced_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
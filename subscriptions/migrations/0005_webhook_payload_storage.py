@@ -0,0 +1,28 @@
+# Generated by Django 4.2.7 on 2026-10-16 13:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0004_stripe_event_timestamps'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='stripewebhookevent',
+            name='data_compressed',
+            field=models.BinaryField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='stripewebhookevent',
+            name='data_encoding',
+            field=models.CharField(blank=True, default='', max_length=10),
+        ),
+        migrations.AlterField(
+            model_name='stripewebhookevent',
+            name='data',
+            field=models.JSONField(blank=True, default=dict),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 4.2.7 on 2026-10-16 13:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0005_webhook_payload_storage'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='stripewebhookevent',
+            index=models.Index(fields=['created_at'], name='webhook_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='subscriptionhistory',
+            index=models.Index(fields=['created_at'], name='history_created_idx'),
+        ),
+    ]
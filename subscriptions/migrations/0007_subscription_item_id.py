@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-16 13:52
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0006_event_log_created_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='usersubscription',
+            name='stripe_subscription_item_id',
+            field=models.CharField(blank=True, max_length=100, null=True),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 4.2.7 on 2026-10-16 18:12
+
+from django.db import migrations, models
+import uuid
+
+
+def generate_tokens(apps, schema_editor):
+    CustomerProvisioningJob = apps.get_model('subscriptions', 'CustomerProvisioningJob')
+    for job in CustomerProvisioningJob.objects.only('id'):
+        job.idempotency_token = uuid.uuid4()
+        job.save(update_fields=['idempotency_token'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('subscriptions', '0010_checkout_session'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customerprovisioningjob',
+            name='idempotency_token',
+            field=models.UUIDField(editable=False, null=True),
+        ),
+        migrations.RunPython(generate_tokens, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='customerprovisioningjob',
+            name='idempotency_token',
+            field=models.UUIDField(default=uuid.uuid4, editable=False),
+        ),
+    ]
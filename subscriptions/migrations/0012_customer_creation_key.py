@@ -0,0 +1,41 @@
+# Generated by Django 4.2.7 on 2026-10-16 15:04
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import uuid
+
+
+def copy_tokens(apps, schema_editor):
+    # Keep the key of users whose customer creation may still be retried
+    CustomerProvisioningJob = apps.get_model('subscriptions', 'CustomerProvisioningJob')
+    CustomerCreationKey = apps.get_model('subscriptions', 'CustomerCreationKey')
+    CustomerCreationKey.objects.bulk_create(
+        CustomerCreationKey(user_id=user_id, token=token)
+        for user_id, token in CustomerProvisioningJob.objects.values_list('user_id', 'idempotency_token')
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('subscriptions', '0011_customer_idempotency_token'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CustomerCreationKey',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('token', models.UUIDField(default=uuid.uuid4, editable=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='customer_creation_key', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.RunPython(copy_tokens, migrations.RunPython.noop),
+        migrations.RemoveField(
+            model_name='customerprovisioningjob',
+            name='idempotency_token',
+        ),
+    ]
@@ -2,6 +2,9 @@ from django.db import models
 from django.contrib.auth.models import User
 from django.utils import timezone
 from datetime import timedelta
+import uuid
+
+from .payloads import decompress_payload
 
 
 class SubscriptionPlan(models.Model):
@@ -35,7 +38,82 @@ class SubscriptionPlan(models.Model):
         return f"{self.name} ({self.billing_period})"
 
 
-class UserSubscription(models.Model):
+class TrackedFieldsMixin:
+    """Remembers the field values a model instance was loaded with
+
+    Saves of loaded instances then write only the fields that changed (plus
+    auto_now fields), and skip the query entirely when nothing did. Signal
+    handlers can compare with loaded_value() instead of reading the row again;
+    during post_save it still returns the value from before the save.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def loaded_value(self, name, default=None):
+        """Value a field had when loaded or last saved"""
+        field = self._meta.get_field(name)
+        return getattr(self, '_loaded_values', {}).get(field.attname, default)
+
+    def changed_fields(self):
+        """Names of loaded fields whose value differs from the loaded one, or None if not loaded"""
+        loaded = getattr(self, '_loaded_values', None)
+        if loaded is None:
+            return None
+        return [
+            field.name for field in self._meta.concrete_fields
+            if field.attname in loaded and getattr(self, field.attname) != loaded[field.attname]
+        ]
+
+    def dirty_update_fields(self, exclude=()):
+        """update_fields covering the changed fields not in exclude, empty if there are none
+
+        Instances not loaded from the database count every field as changed.
+        """
+        changed = self.changed_fields()
+        if changed is None:
+            changed = [field.name for field in self._meta.concrete_fields if not field.primary_key]
+        changed = [name for name in changed if name not in exclude]
+        if not changed:
+            return []
+        auto_now = [
+            field.name for field in self._meta.concrete_fields
+            if getattr(field, 'auto_now', False) and field.name not in changed
+        ]
+        return changed + auto_now
+
+    def reset_changes(self, fields=None):
+        """Treat the current values of fields (default all) as saved"""
+        loaded = self.__dict__.setdefault('_loaded_values', {})
+        deferred = self.get_deferred_fields()
+        for field in self._meta.concrete_fields:
+            if field.attname in deferred:
+                continue
+            if fields is None or field.name in fields or field.attname in fields:
+                loaded[field.attname] = getattr(self, field.attname)
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using=using, fields=fields)
+        self.reset_changes(fields)
+
+    def save(self, *args, **kwargs):
+        tracked = (
+            not self._state.adding and getattr(self, '_loaded_values', None) is not None
+            and not args and kwargs.get('update_fields') is None and not kwargs.get('force_insert')
+        )
+        if tracked:
+            kwargs['update_fields'] = self.dirty_update_fields()
+            if not kwargs['update_fields']:
+                return
+        update_fields = kwargs.get('update_fields')
+        super().save(*args, **kwargs)
+        self.reset_changes(update_fields)
+
+
+class UserSubscription(TrackedFieldsMixin, models.Model):
     """Model representing user subscriptions"""
     
     STATUS_CHOICES = [
@@ -51,15 +129,20 @@ class UserSubscription(models.Model):
     status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='trial')
     stripe_subscription_id = models.CharField(max_length=100, blank=True, null=True)
     stripe_customer_id = models.CharField(max_length=100, blank=True, null=True)
+    # Item holding the plan's price, so plan changes need no retrieve before modify
+    stripe_subscription_item_id = models.CharField(max_length=100, blank=True, null=True)
     
     # Trial management
-    trial_start_date = models.DateTimeField(auto_now_add=True)
+    trial_start_date = models.DateTimeField(default=timezone.now, editable=False)
     trial_end_date = models.DateTimeField()
     
     # Subscription dates
     current_period_start = models.DateTimeField(blank=True, null=True)
     current_period_end = models.DateTimeField(blank=True, null=True)
     
+    # Creation time of the newest Stripe state applied, used to ignore stale webhooks
+    stripe_synced_at = models.DateTimeField(blank=True, null=True)
+    
     # Metadata
     created_at = models.DateTimeField(auto_now_add=True)
     updated_at = models.DateTimeField(auto_now=True)
@@ -98,6 +181,87 @@ class UserSubscription(models.Model):
         return max(0, remaining.days)
 
 
+class StripeCustomer(models.Model):
+    """The Stripe customer belonging to a user, kept so it is only ever created once"""
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='stripe_customer')
+    stripe_customer_id = models.CharField(max_length=100, unique=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.user.username} - {self.stripe_customer_id}"
+
+
+class CustomerCreationKey(models.Model):
+    """Random token in the idempotency key a user's Stripe customer is created with
+
+    Stored once per user and committed before the customer is created, so
+    every attempt for the user sends the same key, while installs sharing a
+    Stripe account never send each other's.
+    """
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='customer_creation_key')
+    token = models.UUIDField(default=uuid.uuid4, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"{self.user.username} - {self.token}"
+
+
+class CustomerProvisioningJob(models.Model):
+    """Creation of a user's Stripe customer, queued ahead of their first checkout or started on first need"""
+
+    user = models.OneToOneField(User, on_delete=models.CASCADE, related_name='customer_provisioning')
+    created_at = models.DateTimeField(auto_now_add=True)
+    provisioned_at = models.DateTimeField(blank=True, null=True)
+
+    # Retry bookkeeping for the provisioning worker
+    attempts = models.PositiveIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    last_error = models.TextField(blank=True, default='')
+    locked_by = models.CharField(max_length=100, blank=True, default='')
+    locked_until = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['provisioned_at', 'next_attempt_at'], name='provisioning_pending_idx'),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {'provisioned' if self.provisioned_at else 'pending'}"
+
+
+class CheckoutSession(models.Model):
+    """A Stripe Checkout Session, reused while open for repeat clicks on the same plan"""
+
+    STATUS_CHOICES = [
+        ('open', 'Open'),
+        ('complete', 'Complete'),
+        ('expired', 'Expired'),
+    ]
+
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='checkout_sessions')
+    plan = models.ForeignKey(SubscriptionPlan, on_delete=models.CASCADE)
+    stripe_session_id = models.CharField(max_length=255, unique=True)
+    url = models.TextField()
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='open')
+    expires_at = models.DateTimeField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ['-created_at']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['user', 'plan'], condition=models.Q(status='open'), name='one_open_checkout_per_plan'
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} - {self.plan.lookup_key} ({self.status})"
+
+
 class SubscriptionHistory(models.Model):
     """Model to track subscription changes and events"""
     
@@ -120,6 +284,9 @@ class SubscriptionHistory(models.Model):
     
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['created_at'], name='history_created_idx'),
+        ]
     
     def __str__(self):
         return f"{self.subscription.user.username} - {self.event_type}"
@@ -131,11 +298,40 @@ class StripeWebhookEvent(models.Model):
     stripe_event_id = models.CharField(max_length=100, unique=True)
     event_type = models.CharField(max_length=100)
     processed = models.BooleanField(default=False)
-    data = models.JSONField()
+    data = models.JSONField(default=dict, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     
+    # Compressed payload used instead of data by the compressed storage policy
+    data_compressed = models.BinaryField(blank=True, null=True)
+    data_encoding = models.CharField(max_length=10, blank=True, default='')
+    
+    # When Stripe created the event, as opposed to when we received it
+    stripe_created = models.DateTimeField(blank=True, null=True)
+    
+    # Stripe subscription the event applies to, used to keep per-subscription ordering
+    stripe_subscription_id = models.CharField(max_length=100, blank=True, default='')
+    
+    # Processing bookkeeping for the webhook worker
+    processed_at = models.DateTimeField(blank=True, null=True)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True, default='')
+    locked_by = models.CharField(max_length=100, blank=True, default='')
+    locked_until = models.DateTimeField(blank=True, null=True)
+    
     class Meta:
         ordering = ['-created_at']
+        indexes = [
+            models.Index(fields=['processed', 'created_at'], name='webhook_pending_idx'),
+            models.Index(fields=['stripe_subscription_id', 'processed'], name='webhook_subscription_idx'),
+            models.Index(fields=['created_at'], name='webhook_created_idx'),
+        ]
     
     def __str__(self):
-        return f"{self.event_type} - {self.stripe_event_id}"
\ No newline at end of file
+        return f"{self.event_type} - {self.stripe_event_id}"
+    
+    @property
+    def payload(self):
+        """Event data, decompressed if it was stored compressed"""
+        if self.data_encoding:
+            return decompress_payload(self.data_compressed, self.data_encoding)
+        return self.data
\ No newline at end of file
@@ -0,0 +1,39 @@
+import json
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover - zstd is optional
+    zstandard = None
+
+
+def compress_payload(data, encoding='zlib'):
+    """Serialize a webhook payload to compressed JSON bytes"""
+    raw = json.dumps(data, separators=(',', ':')).encode('utf-8')
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        return zstandard.ZstdCompressor().compress(raw)
+    if encoding == 'zlib':
+        return zlib.compress(raw, 6)
+    raise ValueError(f"Unknown payload encoding: {encoding}")
+
+
+def decompress_payload(blob, encoding):
+    """Inverse of compress_payload"""
+    blob = bytes(blob)
+    if encoding == 'zstd':
+        if zstandard is None:
+            raise ValueError("zstd compression requires the zstandard package")
+        raw = zstandard.ZstdDecompressor().decompress(blob)
+    elif encoding == 'zlib':
+        raw = zlib.decompress(blob)
+    else:
+        raise ValueError(f"Unknown payload encoding: {encoding}")
+    return json.loads(raw)
+
+
+def trim_payload(data, fields):
+    """Keep only the listed fields of the event's data object"""
+    stripe_object = data.get('object') or {}
+    return {'object': {field: stripe_object[field] for field in fields if field in stripe_object}}
@@ -0,0 +1,179 @@
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import transaction
+import copy
+import logging
+import threading
+import time
+
+from . import metrics
+from .cache import get_redis_client
+from .models import SubscriptionPlan
+
+logger = logging.getLogger(__name__)
+
+
+class _Snapshot:
+    """Every plan as loaded at one catalog version, indexed for lookups"""
+
+    def __init__(self, version, plans):
+        self.version = version
+        self.plans = plans
+        self.by_id = {plan.id: plan for plan in plans}
+        self.by_lookup_key = {plan.lookup_key: plan for plan in plans}
+        self.by_price_id = {plan.stripe_price_id: plan for plan in plans}
+
+
+class PlanCatalog:
+    """Process-wide in-memory copy of the SubscriptionPlan table
+
+    The catalog is loaded with one query and then served from memory. Saving
+    or deleting a plan drops the local copy and, after the transaction
+    commits, bumps a version key in Redis; every process compares its copy's
+    version with that key at most once per check_interval seconds and reloads
+    when it changed. Without Redis, or while it is unreachable, copies are
+    reloaded ttl seconds after loading instead. Bulk queryset updates bypass
+    the signals, so call publish_change() after them.
+
+    Lookups return copies, so callers may modify the plans they get without
+    affecting other requests.
+    """
+
+    REDIS_VERSION_KEY = 'subscriptions:plan_catalog:version'
+
+    def __init__(self, redis_url='', ttl=60, check_interval=1.0):
+        self.redis_url = redis_url
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self._snapshot = None
+        self._check_at = 0.0
+        self._load_lock = threading.Lock()
+
+    @property
+    def redis(self):
+        return get_redis_client(self.redis_url)
+
+    def _remote_version(self):
+        """Current catalog version in Redis, or None if it cannot be read"""
+        client = self.redis
+        if client is None:
+            return None
+        try:
+            return int(client.get(self.REDIS_VERSION_KEY) or 0)
+        except Exception as e:
+            logger.warning(f"Plan catalog version lookup failed: {str(e)}")
+            return None
+
+    def _fresh_snapshot(self):
+        """The local copy if it needs no version check yet, without any I/O"""
+        snapshot = self._snapshot
+        if snapshot is not None and time.monotonic() < self._check_at:
+            return snapshot
+        return None
+
+    def snapshot(self):
+        """The current catalog, loading it when missing or out of date"""
+        snapshot = self._fresh_snapshot()
+        if snapshot is not None:
+            return snapshot
+
+        with self._load_lock:
+            snapshot = self._fresh_snapshot()
+            if snapshot is not None:
+                return snapshot
+
+            version = self._remote_version()
+            snapshot = self._snapshot
+            if snapshot is None or version is None or version != snapshot.version:
+                # Read the version before the rows, so a change in between
+                # only leads to one more reload
+                snapshot = _Snapshot(version, list(SubscriptionPlan.objects.all()))
+                metrics.increment('plan_catalog.loads')
+                self._snapshot = snapshot
+            self._check_at = time.monotonic() + (self.check_interval if version is not None else self.ttl)
+            return snapshot
+
+    async def asnapshot(self):
+        """snapshot() for async code, only leaving the event loop when a check or load is due"""
+        snapshot = self._fresh_snapshot()
+        if snapshot is not None:
+            return snapshot
+        return await sync_to_async(self.snapshot)()
+
+    def get(self, plan_id):
+        """Plan by primary key, reloading the catalog once if it lacks the plan"""
+        snapshot = self.snapshot()
+        if plan_id not in snapshot.by_id:
+            snapshot = self._reload_for_missing(plan_id)
+        return self._find(snapshot.by_id, plan_id, id=plan_id)
+
+    def get_by_lookup_key(self, lookup_key, active_only=True):
+        """Plan by lookup key, by default only if it is active"""
+        return self._find(self.snapshot().by_lookup_key, lookup_key, active_only, lookup_key=lookup_key)
+
+    def get_by_price_id(self, price_id, active_only=False):
+        """Plan by Stripe price id"""
+        return self._find(self.snapshot().by_price_id, price_id, active_only, stripe_price_id=price_id)
+
+    async def aget(self, plan_id):
+        snapshot = await self.asnapshot()
+        if plan_id not in snapshot.by_id:
+            snapshot = await sync_to_async(self._reload_for_missing)(plan_id)
+        return self._find(snapshot.by_id, plan_id, id=plan_id)
+
+    async def aget_by_lookup_key(self, lookup_key, active_only=True):
+        return self._find(
+            (await self.asnapshot()).by_lookup_key, lookup_key, active_only, lookup_key=lookup_key
+        )
+
+    def _reload_for_missing(self, plan_id):
+        """A fresh snapshot, for an id that a row references but the local copy lacks
+
+        Plan ids come from foreign keys, so a miss means the plan was added
+        after the copy was loaded and its change has not reached this process
+        yet. Lookup keys and price ids come from requests and never reload.
+        """
+        logger.info(f"Plan {plan_id} is not in the catalog, reloading it")
+        self.invalidate()
+        return self.snapshot()
+
+    def active_plans(self):
+        """Active plans in the model's default order"""
+        return [copy.copy(plan) for plan in self.snapshot().plans if plan.is_active]
+
+    def _find(self, index, key, active_only=False, **lookup):
+        plan = index.get(key)
+        if plan is None or (active_only and not plan.is_active):
+            metrics.increment('plan_catalog.misses')
+            raise SubscriptionPlan.DoesNotExist(f"SubscriptionPlan matching {lookup} does not exist")
+        metrics.increment('plan_catalog.hits')
+        return copy.copy(plan)
+
+    def invalidate(self):
+        """Drop the local copy so the next lookup reloads it"""
+        with self._load_lock:
+            self._snapshot = None
+            self._check_at = 0.0
+
+    def publish_change(self):
+        """Tell every process the plans changed"""
+        self.invalidate()
+        client = self.redis
+        if client is not None:
+            try:
+                client.incr(self.REDIS_VERSION_KEY)
+            except Exception as e:
+                logger.warning(f"Plan catalog version bump failed: {str(e)}")
+        metrics.increment('plan_catalog.invalidations')
+
+    def plans_changed(self):
+        """Invalidate now, and everywhere once the current transaction commits"""
+        self.invalidate()
+        # Other processes must not reload before the change is visible to them
+        transaction.on_commit(self.publish_change)
+
+
+plan_catalog = PlanCatalog(
+    redis_url=settings.PLAN_CATALOG_REDIS_URL,
+    ttl=settings.PLAN_CATALOG_TTL,
+)
@@ -0,0 +1,106 @@
+"""Background creation of Stripe customers for newly registered users
+
+With STRIPE_PREPROVISION_CUSTOMERS enabled every new user gets a
+CustomerProvisioningJob from a post_save handler, and the registration view
+creates the user inside transaction.atomic() so no user is left without
+one. Users created elsewhere get their job in the same transaction only
+when the caller opens one. `manage.py provision_stripe_customers` creates
+their Stripe customers off the request path. Checkout and trial creation
+then find the customer id in StripeCustomer instead of calling Stripe on
+the first click. Failed jobs are retried with exponential backoff.
+"""
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+from datetime import timedelta
+import logging
+import random
+
+from . import metrics
+from .models import CustomerProvisioningJob
+from .services import CustomerService
+
+logger = logging.getLogger(__name__)
+
+# Jobs that failed this many times are left for an operator to look at
+MAX_ATTEMPTS = 8
+
+
+def enqueue_customer_provisioning(user):
+    """Queue creation of the user's Stripe customer"""
+    job, _ = CustomerProvisioningJob.objects.get_or_create(user=user)
+    return job
+
+
+def pending_provisioning_jobs(max_attempts=None):
+    """Queryset of jobs whose customer has not been created yet"""
+    jobs = CustomerProvisioningJob.objects.filter(provisioned_at__isnull=True)
+    if max_attempts is not None:
+        jobs = jobs.filter(attempts__lt=max_attempts)
+    return jobs.order_by('created_at', 'id')
+
+
+def claim_provisioning_jobs(worker_id, batch_size=100, lease_seconds=60, max_attempts=MAX_ATTEMPTS):
+    """Lease a batch of due provisioning jobs to a worker
+
+    Uses SELECT ... FOR UPDATE SKIP LOCKED like the webhook worker, so several
+    provisioning workers can run side by side.
+    """
+    now = timezone.now()
+    with transaction.atomic():
+        job_ids = list(
+            pending_provisioning_jobs(max_attempts)
+            .filter(Q(locked_until__isnull=True) | Q(locked_until__lte=now), next_attempt_at__lte=now)
+            .select_for_update(skip_locked=True)
+            .values_list('id', flat=True)[:batch_size]
+        )
+        CustomerProvisioningJob.objects.filter(id__in=job_ids).update(
+            locked_by=worker_id,
+            locked_until=now + timedelta(seconds=lease_seconds),
+        )
+
+    return list(CustomerProvisioningJob.objects.filter(id__in=job_ids).select_related('user').order_by('created_at', 'id'))
+
+
+def retry_delay(attempts):
+    """Seconds to wait before the next attempt: exponential with jitter, capped at an hour"""
+    return min(2 ** attempts, 3600) * random.uniform(0.5, 1.0)
+
+
+def provision_customer(job):
+    """Create (or find) the job's Stripe customer and mark the job done"""
+    job.attempts += 1
+    job.locked_by = ''
+    job.locked_until = None
+    try:
+        CustomerService.get_or_create_customer_id(job.user)
+    except Exception as e:
+        logger.error(f"Error provisioning Stripe customer for user {job.user_id} (attempt {job.attempts}): {str(e)}")
+        job.last_error = str(e)
+        job.next_attempt_at = timezone.now() + timedelta(seconds=retry_delay(job.attempts))
+        job.save(update_fields=['attempts', 'last_error', 'next_attempt_at', 'locked_by', 'locked_until'])
+        metrics.increment('customer_provisioning.errors')
+        raise
+
+    job.provisioned_at = timezone.now()
+    job.last_error = ''
+    job.save(update_fields=['attempts', 'provisioned_at', 'last_error', 'locked_by', 'locked_until'])
+    metrics.increment('customer_provisioning.provisioned')
+    metrics.increment('customer_provisioning.lag_ms', round(provisioning_lag(job) * 1000))
+    return job
+
+
+def provisioning_lag(job):
+    """Seconds between the user registering and their customer being ready"""
+    return (job.provisioned_at - job.created_at).total_seconds()
+
+
+def provisioning_status(max_attempts=MAX_ATTEMPTS):
+    """Queue depth and age of the oldest waiting job, for the metrics endpoint"""
+    pending = pending_provisioning_jobs(max_attempts)
+    oldest = pending.values_list('created_at', flat=True).first()
+    return {
+        'pending': pending.count(),
+        'failed': pending_provisioning_jobs().filter(attempts__gte=max_attempts).count(),
+        'oldest_pending_seconds': round((timezone.now() - oldest).total_seconds(), 1) if oldest else 0,
+    }
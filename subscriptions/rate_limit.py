@@ -0,0 +1,179 @@
+"""Cluster-wide token bucket throttling outbound Stripe calls by priority
+
+Stripe rate-limits the whole account, so web workers, the webhook processor
+and management commands draw from one bucket kept in Redis. Every request made
+through PooledRequestsClient takes a token first. Each priority class may only
+take a token while the bucket holds more than its reserve, so batch jobs back
+off first and leave headroom for webhooks, which in turn leave headroom for
+interactive requests. Batch callers wait as long as it takes, so a bulk job
+slows down instead of erroring; interactive requests give up quickly with
+StripeUnavailable. Without Redis, or while it is unreachable, each process
+falls back to a local bucket with the same rate.
+"""
+from contextlib import contextmanager
+from contextvars import ContextVar
+from django.conf import settings
+import logging
+import math
+import random
+import threading
+import time
+
+from . import metrics
+from .cache import get_redis_client
+from .resilience import StripeUnavailable
+
+logger = logging.getLogger(__name__)
+
+INTERACTIVE = 'interactive'
+WEBHOOK = 'webhook'
+BATCH = 'batch'
+
+# Highest priority first
+PRIORITIES = [INTERACTIVE, WEBHOOK, BATCH]
+
+# Fraction of the bucket a class must leave untouched for higher classes
+PRIORITY_RESERVES = {
+    INTERACTIVE: 0.0,
+    WEBHOOK: 0.2,
+    BATCH: 0.5,
+}
+
+_priority = ContextVar('stripe_priority', default=INTERACTIVE)
+
+
+def current_priority():
+    """Priority class of Stripe calls made in the current context"""
+    return _priority.get()
+
+
+@contextmanager
+def stripe_priority(priority):
+    """Run Stripe calls in the block at priority, or lower if already lower
+
+    A block can lower its calls' priority but never raise it, so webhook
+    handlers dispatched by a batch replay still run at batch priority.
+    """
+    if priority not in PRIORITIES:
+        raise ValueError(f"Unknown Stripe priority: {priority}")
+    effective = max(priority, current_priority(), key=PRIORITIES.index)
+    token = _priority.set(effective)
+    try:
+        yield effective
+    finally:
+        _priority.reset(token)
+
+
+class LocalTokenBucket:
+    """In-process token bucket, used when Redis is not available"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self._lock = threading.Lock()
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def take(self, reserve):
+        """Take a token if more than reserve remain; return seconds to wait otherwise"""
+        with self._lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens - 1 >= reserve:
+                self.tokens -= 1
+                return 0.0
+            return (reserve + 1 - self.tokens) / self.rate
+
+
+# Refill and take atomically, timed by the Redis server's clock so every
+# process agrees. Floats are returned as strings, since Redis would truncate
+# Lua numbers to integers.
+TAKE_SCRIPT = """
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local reserve = tonumber(ARGV[3])
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) + tonumber(clock[2]) / 1000000
+local state = redis.call('HMGET', KEYS[1], 'tokens', 'updated_at')
+local tokens = tonumber(state[1]) or capacity
+local updated_at = tonumber(state[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - updated_at) * rate)
+local wait = 0
+if tokens - 1 >= reserve then
+    tokens = tokens - 1
+else
+    wait = (reserve + 1 - tokens) / rate
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'updated_at', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return tostring(wait)
+"""
+
+
+class StripeRateLimiter:
+    """Priority-aware token bucket shared through Redis when configured"""
+
+    REDIS_KEY = 'stripe:rate_limit'
+
+    def __init__(self, rate, burst=None, redis_url='', max_waits=None):
+        self.rate = rate
+        self.capacity = burst or rate
+        self.redis_url = redis_url
+        # Longest a caller of each class waits for a token; None waits forever
+        self.max_waits = max_waits or {INTERACTIVE: 2.0, WEBHOOK: 30.0, BATCH: None}
+        self.local = LocalTokenBucket(rate, self.capacity) if rate else None
+        self._script = None
+
+    @property
+    def redis(self):
+        return get_redis_client(self.redis_url)
+
+    def take(self, priority):
+        """Try to take a token at priority, returning seconds to wait if none is free"""
+        reserve = self.capacity * PRIORITY_RESERVES[priority]
+        client = self.redis
+        if client is not None:
+            try:
+                if self._script is None:
+                    self._script = client.register_script(TAKE_SCRIPT)
+                return float(self._script(keys=[self.REDIS_KEY], args=[self.rate, self.capacity, reserve]))
+            except Exception as e:
+                logger.warning(f"Stripe rate limiter Redis call failed, using local bucket: {str(e)}")
+                metrics.increment('stripe.rate_limit_fallbacks')
+        return self.local.take(reserve)
+
+    def acquire(self, priority=None):
+        """Block until a token is free, raising StripeUnavailable if that takes too long"""
+        if not self.rate:
+            return
+        priority = priority or current_priority()
+        max_wait = self.max_waits.get(priority)
+        waited = 0.0
+        while True:
+            wait = self.take(priority)
+            if wait <= 0:
+                if waited:
+                    metrics.increment(f'stripe.rate_limit_wait_ms.{priority}', round(waited * 1000))
+                return
+            if max_wait is not None and waited + wait > max_wait:
+                metrics.increment(f'stripe.rate_limit_rejections.{priority}')
+                raise StripeUnavailable(
+                    f"Stripe rate limit reached for {priority} calls", 'rate_limited', retry_after=math.ceil(wait)
+                )
+            # Jitter keeps waiters from retrying in lockstep
+            delay = wait * random.uniform(1.0, 1.2)
+            time.sleep(delay)
+            waited += delay
+
+
+rate_limiter = StripeRateLimiter(
+    rate=settings.STRIPE_RATE_LIMIT,
+    burst=settings.STRIPE_RATE_LIMIT_BURST,
+    redis_url=settings.STRIPE_RATE_LIMIT_REDIS_URL,
+    max_waits={
+        INTERACTIVE: settings.STRIPE_RATE_LIMIT_INTERACTIVE_WAIT,
+        WEBHOOK: settings.STRIPE_RATE_LIMIT_WEBHOOK_WAIT,
+        BATCH: None,
+    },
+)
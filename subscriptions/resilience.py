@@ -0,0 +1,161 @@
+"""Bulkhead and circuit breaker guarding outbound Stripe calls
+
+Every Stripe request passes through PooledRequestsClient, which takes a slot
+from the process's bulkhead and asks the circuit breaker for permission
+before sending. When Stripe is slow the bulkhead caps how many threads can be
+stuck waiting on it; when it keeps failing the breaker opens and calls fail
+immediately with StripeUnavailable until a half-open probe succeeds. Views
+turn StripeUnavailable into a fast 503 instead of tying up workers.
+"""
+from django.conf import settings
+from django.http import JsonResponse
+import logging
+import math
+import stripe
+import threading
+import time
+
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class StripeUnavailable(stripe.error.APIConnectionError):
+    """Raised instead of calling Stripe while it is considered unavailable"""
+
+    def __init__(self, message, reason, retry_after=None):
+        super().__init__(message, should_retry=False)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Bulkhead:
+    """Caps the number of concurrent in-flight calls in this process"""
+
+    def __init__(self, max_concurrent, acquire_timeout=0.0):
+        self.max_concurrent = max_concurrent
+        self.acquire_timeout = acquire_timeout
+        self._semaphore = threading.BoundedSemaphore(max_concurrent)
+        self._lock = threading.Lock()
+        self.in_flight = 0
+
+    def __enter__(self):
+        if not self._semaphore.acquire(timeout=self.acquire_timeout):
+            metrics.increment('stripe.bulkhead_rejections')
+            raise StripeUnavailable(
+                f"Too many concurrent Stripe calls (limit {self.max_concurrent})", 'bulkhead_full', retry_after=1
+            )
+        with self._lock:
+            self.in_flight += 1
+        return self
+
+    def __exit__(self, *exc_info):
+        with self._lock:
+            self.in_flight -= 1
+        self._semaphore.release()
+        return False
+
+
+class CircuitBreaker:
+    """Fails fast after consecutive failures, probing again after a cool-down
+
+    closed: calls pass; failure_threshold consecutive failures open the circuit.
+    open: calls are rejected until reset_timeout has passed.
+    half_open: a single probe call is let through; success closes the circuit,
+    failure opens it again.
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """Close the circuit and forget past failures"""
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+            self.opened_at = None
+            self._probe_in_flight = False
+
+    def before_call(self):
+        """Raise StripeUnavailable unless a call may proceed now"""
+        with self._lock:
+            if self.state == self.OPEN:
+                remaining = self.opened_at + self.reset_timeout - time.monotonic()
+                if remaining > 0:
+                    metrics.increment('stripe.circuit_rejections')
+                    raise StripeUnavailable(
+                        "Stripe circuit breaker is open", 'circuit_open', retry_after=math.ceil(remaining)
+                    )
+                self._transition(self.HALF_OPEN)
+
+            if self.state == self.HALF_OPEN:
+                if self._probe_in_flight:
+                    metrics.increment('stripe.circuit_rejections')
+                    raise StripeUnavailable(
+                        "Stripe circuit breaker is probing", 'circuit_open', retry_after=1
+                    )
+                self._probe_in_flight = True
+
+    def record_success(self):
+        """Note a call that succeeded"""
+        with self._lock:
+            self.failures = 0
+            self._probe_in_flight = False
+            if self.state != self.CLOSED:
+                self._transition(self.CLOSED)
+
+    def record_failure(self):
+        """Note a call that timed out or failed on Stripe's side"""
+        with self._lock:
+            self.failures += 1
+            self._probe_in_flight = False
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    metrics.increment('stripe.circuit_opened')
+                    logger.warning(f"Stripe circuit breaker opened after {self.failures} consecutive failures")
+                self.opened_at = time.monotonic()
+                self._transition(self.OPEN)
+
+    def _transition(self, state):
+        if state != self.state:
+            logger.info(f"Stripe circuit breaker {self.state} -> {state}")
+        self.state = state
+
+
+bulkhead = Bulkhead(
+    max_concurrent=settings.STRIPE_MAX_CONCURRENT_CALLS,
+    acquire_timeout=settings.STRIPE_BULKHEAD_TIMEOUT,
+)
+
+circuit_breaker = CircuitBreaker(
+    failure_threshold=settings.STRIPE_CIRCUIT_FAILURE_THRESHOLD,
+    reset_timeout=settings.STRIPE_CIRCUIT_RESET_TIMEOUT,
+)
+
+
+def stripe_status():
+    """Current bulkhead and circuit breaker state, for the metrics endpoint"""
+    return {
+        'circuit_state': circuit_breaker.state,
+        'consecutive_failures': circuit_breaker.failures,
+        'in_flight': bulkhead.in_flight,
+        'max_concurrent': bulkhead.max_concurrent,
+    }
+
+
+def unavailable_response(error):
+    """A fast 503 telling the client when to retry"""
+    response = JsonResponse(
+        {'error': 'Payment provider temporarily unavailable, please retry shortly', 'reason': error.reason},
+        status=503,
+    )
+    if error.retry_after:
+        response['Retry-After'] = str(error.retry_after)
+    return response
@@ -1,6 +1,7 @@
 from rest_framework import serializers
 from django.contrib.auth.models import User
 from .models import SubscriptionPlan, UserSubscription, SubscriptionHistory
+from .plan_catalog import plan_catalog
 
 
 class SubscriptionPlanSerializer(serializers.ModelSerializer):
@@ -54,7 +55,7 @@ class CreateSubscriptionSerializer(serializers.Serializer):
     def validate_plan_lookup_key(self, value):
         """Validate that the plan exists and is active"""
         try:
-            plan = SubscriptionPlan.objects.get(lookup_key=value, is_active=True)
+            plan = plan_catalog.get_by_lookup_key(value)
             return value
         except SubscriptionPlan.DoesNotExist:
             raise serializers.ValidationError("Invalid or inactive plan")
@@ -67,7 +68,7 @@ class ChangePlanSerializer(serializers.Serializer):
     def validate_new_plan_lookup_key(self, value):
         """Validate that the new plan exists and is active"""
         try:
-            plan = SubscriptionPlan.objects.get(lookup_key=value, is_active=True)
+            plan = plan_catalog.get_by_lookup_key(value)
             return value
         except SubscriptionPlan.DoesNotExist:
             raise serializers.ValidationError("Invalid or inactive plan")
@@ -1,21 +1,70 @@
 import stripe
+from asgiref.sync import sync_to_async
+from concurrent.futures import ThreadPoolExecutor
 from django.conf import settings
-from django.contrib.auth.models import User
-from .models import SubscriptionPlan, UserSubscription, SubscriptionHistory
-from datetime import datetime, timedelta
+from django.db import IntegrityError, transaction
+from .models import UserSubscription, StripeCustomer, CustomerCreationKey, CheckoutSession, SubscriptionHistory
+from .batching import batch_changes
+from .instrumentation import instrument
+from .plan_catalog import plan_catalog
+from .state_machine import transition
+from .stripe_cache import subscription_cache
+from .stripe_client import configure_stripe
+from . import metrics
+from django.utils import timezone
+from datetime import datetime, timedelta, timezone as dt_timezone
 import logging
 
 logger = logging.getLogger(__name__)
 
-# Configure Stripe
-stripe.api_key = settings.STRIPE_SECRET_KEY
+# Configure Stripe with the pooled keep-alive HTTP client
+configure_stripe()
+
+# Map of Stripe subscription statuses to local statuses
+STATUS_MAPPING = {
+    'trialing': 'trial',
+    'active': 'active',
+    'past_due': 'past_due',
+    'canceled': 'canceled',
+    'unpaid': 'unpaid',
+}
+
+# Open checkout sessions this close to expiry are replaced instead of reused,
+# so a customer is never sent to a page that expires while they fill it in
+CHECKOUT_SESSION_REUSE_MARGIN = timedelta(minutes=10)
+
+# Subscription fields needed to apply a Stripe subscription without fetching it
+STRIPE_SUBSCRIPTION_FIELDS = ['id', 'status', 'current_period_start', 'current_period_end']
+
+
+def from_stripe_timestamp(timestamp):
+    """Convert a Stripe unix timestamp to an aware datetime"""
+    return datetime.fromtimestamp(timestamp, tz=dt_timezone.utc)
+
+
+def iterate_pages(list_page, *args):
+    """Objects of every page list_page(*args, starting_after) returns, following has_more"""
+    starting_after = None
+    while True:
+        page = list_page(*args, starting_after)
+        yield from page.data
+        if not page.has_more or not page.data:
+            return
+        starting_after = page.data[-1].id
+
+
+def subscription_item_id(stripe_subscription):
+    """Id of the item holding a Stripe subscription's price, if the object includes it"""
+    items = (stripe_subscription.get('items') or {}).get('data') or []
+    return items[0]['id'] if items else None
 
 
 class StripeService:
     """Service class for Stripe operations"""
     
     @staticmethod
-    def create_customer(user):
+    @instrument('customer.create')
+    def create_customer(user, idempotency_key=None):
         """Create a Stripe customer for a user"""
         try:
             customer = stripe.Customer.create(
@@ -24,7 +73,8 @@ class StripeService:
                 metadata={
                     'user_id': user.id,
                     'username': user.username,
-                }
+                },
+                idempotency_key=idempotency_key,
             )
             return customer
         except stripe.error.StripeError as e:
@@ -32,6 +82,25 @@ class StripeService:
             raise
     
     @staticmethod
+    def list_customers(page_size=100):
+        """Iterate over the account's customers, fetching a page of page_size per request"""
+        return iterate_pages(StripeService.list_customers_page, page_size)
+    
+    @staticmethod
+    @instrument('customer.list')
+    def list_customers_page(limit=100, starting_after=None):
+        """Fetch one page of the account's customers"""
+        params = {'limit': limit}
+        if starting_after:
+            params['starting_after'] = starting_after
+        try:
+            return stripe.Customer.list(**params)
+        except stripe.error.StripeError as e:
+            logger.error(f"Error listing Stripe customers after {starting_after}: {str(e)}")
+            raise
+    
+    @staticmethod
+    @instrument('subscription.create')
     def create_subscription(customer_id, price_id, trial_period_days=14):
         """Create a Stripe subscription with trial period"""
         try:
@@ -43,12 +112,14 @@ class StripeService:
                 payment_settings={'save_default_payment_method': 'on_subscription'},
                 expand=['latest_invoice.payment_intent'],
             )
+            subscription_cache.set(subscription)
             return subscription
         except stripe.error.StripeError as e:
             logger.error(f"Error creating Stripe subscription: {str(e)}")
             raise
     
     @staticmethod
+    @instrument('subscription.cancel')
     def cancel_subscription(subscription_id):
         """Cancel a Stripe subscription"""
         try:
@@ -56,37 +127,280 @@ class StripeService:
                 subscription_id,
                 cancel_at_period_end=True
             )
+            subscription_cache.set(subscription)
             return subscription
         except stripe.error.StripeError as e:
             logger.error(f"Error canceling Stripe subscription {subscription_id}: {str(e)}")
             raise
     
     @staticmethod
-    def update_subscription(subscription_id, new_price_id):
-        """Update a Stripe subscription to a new plan"""
+    @instrument('subscription.update')
+    def update_subscription(subscription_id, new_price_id, item_id=None):
+        """Update a Stripe subscription to a new plan
+        
+        Pass the subscription item id when it is known locally to save the
+        retrieve that would otherwise look it up.
+        """
         try:
-            subscription = stripe.Subscription.retrieve(subscription_id)
-            stripe.Subscription.modify(
+            if item_id is None:
+                item_id = subscription_item_id(StripeService.get_subscription(subscription_id))
+            subscription = stripe.Subscription.modify(
                 subscription_id,
                 items=[{
-                    'id': subscription['items']['data'][0]['id'],
+                    'id': item_id,
                     'price': new_price_id,
                 }],
                 proration_behavior='create_prorations',
             )
+            subscription_cache.set(subscription)
             return subscription
         except stripe.error.StripeError as e:
             logger.error(f"Error updating Stripe subscription {subscription_id}: {str(e)}")
             raise
     
     @staticmethod
-    def get_subscription(subscription_id):
-        """Retrieve a Stripe subscription"""
+    def get_subscription(subscription_id, use_cache=True):
+        """Retrieve a Stripe subscription, from the subscription cache when possible"""
+        if use_cache:
+            subscription = subscription_cache.get(subscription_id)
+            if subscription is not None:
+                return subscription
+        return StripeService.retrieve_subscription(subscription_id)
+    
+    @staticmethod
+    @instrument('subscription.retrieve')
+    def retrieve_subscription(subscription_id):
+        """Retrieve a Stripe subscription from Stripe and refresh its cache entry"""
         try:
-            return stripe.Subscription.retrieve(subscription_id)
+            subscription = stripe.Subscription.retrieve(subscription_id)
+            subscription_cache.set(subscription)
+            return subscription
         except stripe.error.StripeError as e:
             logger.error(f"Error retrieving Stripe subscription {subscription_id}: {str(e)}")
             raise
+    
+    @staticmethod
+    def list_subscriptions(status='all', page_size=100):
+        """Iterate over the account's subscriptions, fetching a page of page_size per request"""
+        return iterate_pages(StripeService.list_subscriptions_page, status, page_size)
+    
+    @staticmethod
+    @instrument('subscription.list')
+    def list_subscriptions_page(status='all', limit=100, starting_after=None):
+        """Fetch one page of the account's subscriptions"""
+        params = {'status': status, 'limit': limit}
+        if starting_after:
+            params['starting_after'] = starting_after
+        try:
+            return stripe.Subscription.list(**params)
+        except stripe.error.StripeError as e:
+            logger.error(f"Error listing Stripe subscriptions after {starting_after}: {str(e)}")
+            raise
+    
+    @staticmethod
+    @instrument('checkout_session.create')
+    def create_checkout_session(customer_id, price_id, success_url, cancel_url, metadata=None, trial_period_days=14):
+        """Create a Stripe checkout session for a subscription"""
+        try:
+            return stripe.checkout.Session.create(
+                customer=customer_id,
+                payment_method_types=['card'],
+                line_items=[{
+                    'price': price_id,
+                    'quantity': 1,
+                }],
+                mode='subscription',
+                success_url=success_url,
+                cancel_url=cancel_url,
+                trial_period_days=trial_period_days,
+                metadata=metadata or {},
+            )
+        except stripe.error.StripeError as e:
+            logger.error(f"Error creating Stripe checkout session for customer {customer_id}: {str(e)}")
+            raise
+    
+    @staticmethod
+    @instrument('checkout_session.expire')
+    def expire_checkout_session(session_id):
+        """Expire an open Stripe checkout session so it can no longer be paid"""
+        try:
+            return stripe.checkout.Session.expire(session_id)
+        except stripe.error.StripeError as e:
+            logger.error(f"Error expiring Stripe checkout session {session_id}: {str(e)}")
+            raise
+
+
+def customer_idempotency_key(user):
+    """Idempotency key making concurrent customer creations for a user return one customer
+    
+    The user's random CustomerCreationKey token, created here if the user
+    has none, keeps the key unique across installs sharing a Stripe account.
+    Call it outside any transaction, so the token is committed and a retry
+    after a failed attempt uses the same key.
+    """
+    key, _ = CustomerCreationKey.objects.get_or_create(user=user)
+    return f'customer-create-user-{user.pk}-{key.token}'
+
+
+class CustomerService:
+    """Service class for the user to Stripe customer mapping"""
+    
+    @staticmethod
+    def get_customer_id(user):
+        """The user's Stripe customer id, or None if none was created yet"""
+        return StripeCustomer.objects.filter(user=user).values_list('stripe_customer_id', flat=True).first()
+    
+    @staticmethod
+    def get_subscription_customer_id(user):
+        """The Stripe customer id stored on the user's subscription, if any"""
+        return UserSubscription.objects.filter(user=user).exclude(stripe_customer_id__isnull=True).exclude(
+            stripe_customer_id=''
+        ).values_list('stripe_customer_id', flat=True).first()
+    
+    @staticmethod
+    def store_customer_id(user, customer_id):
+        """Map the user to their new Stripe customer, raising IntegrityError if they have one already"""
+        # A savepoint, so a conflict leaves the caller's transaction usable
+        with transaction.atomic():
+            StripeCustomer.objects.create(user=user, stripe_customer_id=customer_id)
+    
+    @staticmethod
+    def get_or_create_customer_id(user):
+        """Return the user's Stripe customer id, creating the customer on first need
+        
+        No lock or transaction is held across the Stripe call. Concurrent
+        first requests for a user send the same idempotency key, so Stripe
+        hands them one customer, and the unique mapping stores it once.
+        """
+        customer_id = CustomerService.get_customer_id(user)
+        if customer_id:
+            return customer_id
+        
+        try:
+            # Subscriptions created before the mapping existed carry the customer id
+            customer_id = CustomerService.get_subscription_customer_id(user)
+            if not customer_id:
+                customer_id = StripeService.create_customer(user, idempotency_key=customer_idempotency_key(user)).id
+            try:
+                CustomerService.store_customer_id(user, customer_id)
+            except IntegrityError:
+                # Another request stored the mapping first, and that customer is the user's
+                return CustomerService.get_customer_id(user)
+            return customer_id
+            
+        except Exception as e:
+            logger.error(f"Error getting Stripe customer for user {user.id}: {str(e)}")
+            raise
+
+
+class CheckoutService:
+    """Service class for the registry of open Stripe Checkout Sessions"""
+    
+    @staticmethod
+    def reusable_sessions(user, plan):
+        """Open sessions for a user and plan that are far enough from expiry to hand out again"""
+        return CheckoutSession.objects.filter(
+            user=user,
+            plan=plan,
+            status='open',
+            expires_at__gt=timezone.now() + CHECKOUT_SESSION_REUSE_MARGIN,
+        )
+    
+    @staticmethod
+    def closing_sessions(user, plan):
+        """Open sessions for a user and plan too close to expiry to hand out again"""
+        return CheckoutSession.objects.filter(
+            user=user,
+            plan=plan,
+            status='open',
+            expires_at__lte=timezone.now() + CHECKOUT_SESSION_REUSE_MARGIN,
+        )
+    
+    @staticmethod
+    def register_session(user, plan, stripe_session):
+        """Record a new Stripe session as the user's open one for the plan
+        
+        Raises IntegrityError if another open session that is not close to
+        expiry is registered already.
+        """
+        with transaction.atomic():
+            # Only a session close to expiry makes way; a fresh one
+            # registered by a concurrent request makes the insert conflict
+            CheckoutService.closing_sessions(user, plan).update(status='expired')
+            session = CheckoutSession.objects.create(
+                user=user,
+                plan=plan,
+                stripe_session_id=stripe_session.id,
+                url=stripe_session.url,
+                expires_at=from_stripe_timestamp(stripe_session.expires_at),
+            )
+        metrics.increment('checkout_sessions.created')
+        return session
+    
+    @staticmethod
+    def discard_stripe_session(stripe_session_id):
+        """Expire a Stripe session that lost the race to be the open one, so it is never paid"""
+        try:
+            StripeService.expire_checkout_session(stripe_session_id)
+            metrics.increment('checkout_sessions.discarded')
+        except Exception as e:
+            logger.warning(f"Could not expire surplus checkout session {stripe_session_id}: {str(e)}")
+    
+    @staticmethod
+    def register_or_reuse_session(user, plan, stripe_session):
+        """Register a new Stripe session, or hand out the one a concurrent request registered first
+        
+        The surplus session is then expired in Stripe so it is never paid.
+        """
+        try:
+            return CheckoutService.register_session(user, plan, stripe_session)
+        except IntegrityError:
+            session = CheckoutService.reusable_sessions(user, plan).first()
+            if session is None:
+                # It has closed since, so ours takes its place
+                return CheckoutService.register_session(user, plan, stripe_session)
+            CheckoutService.discard_stripe_session(stripe_session.id)
+            metrics.increment('checkout_sessions.reused')
+            return session
+    
+    @staticmethod
+    def get_or_create_session(user, plan, success_url, cancel_url):
+        """Return the user's open checkout session for a plan, creating one if there is none
+        
+        Repeat clicks and returns from the cancel page get the same session
+        until it completes or expires, which the checkout webhooks record. The
+        Stripe calls run outside any transaction, so a failed session create
+        keeps the customer it made; a double click relies on the one open
+        session constraint, and the session registered second is expired.
+        """
+        try:
+            session = CheckoutService.reusable_sessions(user, plan).first()
+            if session:
+                metrics.increment('checkout_sessions.reused')
+                return session
+            
+            stripe_session = StripeService.create_checkout_session(
+                CustomerService.get_or_create_customer_id(user),
+                plan.stripe_price_id,
+                success_url=success_url,
+                cancel_url=cancel_url,
+                metadata={
+                    'user_id': user.id,
+                    'plan_lookup_key': plan.lookup_key,
+                }
+            )
+            return CheckoutService.register_or_reuse_session(user, plan, stripe_session)
+            
+        except Exception as e:
+            logger.error(f"Error getting checkout session for user {user.id}: {str(e)}")
+            raise
+    
+    @staticmethod
+    def mark_session(stripe_session_id, status):
+        """Record that a checkout session completed or expired"""
+        return CheckoutSession.objects.filter(stripe_session_id=stripe_session_id).exclude(
+            status='complete'
+        ).update(status=status, updated_at=timezone.now())
 
 
 class SubscriptionService:
@@ -97,62 +411,61 @@ class SubscriptionService:
         """Create a trial subscription for a user"""
         try:
             # Get the subscription plan
-            plan = SubscriptionPlan.objects.get(lookup_key=plan_lookup_key, is_active=True)
+            plan = plan_catalog.get_by_lookup_key(plan_lookup_key)
             
             # Check if user already has a subscription
             if hasattr(user, 'subscription'):
                 raise ValueError("User already has a subscription")
             
-            # Create Stripe customer if not exists
-            customer_id = None
-            if not user.subscription or not user.subscription.stripe_customer_id:
-                customer = StripeService.create_customer(user)
-                customer_id = customer.id
+            # Reuse the user's Stripe customer, creating it on first need
+            customer_id = CustomerService.get_or_create_customer_id(user)
             
             # Create Stripe subscription with trial
             subscription = StripeService.create_subscription(
-                customer_id or user.subscription.stripe_customer_id,
+                customer_id,
                 plan.stripe_price_id,
                 trial_period_days=14
             )
             
-            # Create UserSubscription
-            user_subscription = UserSubscription.objects.create(
-                user=user,
-                plan=plan,
-                status='trial',
-                stripe_subscription_id=subscription.id,
-                stripe_customer_id=customer_id or user.subscription.stripe_customer_id,
-                current_period_start=datetime.fromtimestamp(subscription.current_period_start),
-                current_period_end=datetime.fromtimestamp(subscription.current_period_end),
-            )
-            
-            # Log the event
-            SubscriptionHistory.objects.create(
-                subscription=user_subscription,
-                event_type='trial_started',
-                description=f"Started {plan.name} trial",
-                metadata={'stripe_subscription_id': subscription.id}
-            )
-            
-            return user_subscription
+            return SubscriptionService.record_trial(user, plan, customer_id, subscription)
             
         except Exception as e:
             logger.error(f"Error creating trial subscription for user {user.id}: {str(e)}")
             raise
     
+    @staticmethod
+    def record_trial(user, plan, customer_id, subscription):
+        """Store the trial subscription created in Stripe and log it"""
+        user_subscription = UserSubscription.objects.create(
+            user=user,
+            plan=plan,
+            status='trial',
+            stripe_subscription_id=subscription.id,
+            stripe_customer_id=customer_id,
+            stripe_subscription_item_id=subscription_item_id(subscription),
+            current_period_start=from_stripe_timestamp(subscription.current_period_start),
+            current_period_end=from_stripe_timestamp(subscription.current_period_end),
+        )
+        
+        # Log the event
+        SubscriptionHistory.objects.create(
+            subscription=user_subscription,
+            event_type='trial_started',
+            description=f"Started {plan.name} trial",
+            metadata={'stripe_subscription_id': subscription.id}
+        )
+        
+        return user_subscription
+    
     @staticmethod
     def activate_subscription(user_subscription):
         """Activate a subscription after trial ends"""
         try:
-            user_subscription.status = 'active'
-            user_subscription.save()
-            
-            # Log the event
-            SubscriptionHistory.objects.create(
-                subscription=user_subscription,
-                event_type='activated',
-                description=f"Subscription activated after trial",
+            transition(
+                user_subscription,
+                'active',
+                'activated',
+                "Subscription activated after trial",
             )
             
             return user_subscription
@@ -168,98 +481,292 @@ class SubscriptionService:
             if user_subscription.stripe_subscription_id:
                 StripeService.cancel_subscription(user_subscription.stripe_subscription_id)
             
-            user_subscription.status = 'canceled'
-            user_subscription.canceled_at = datetime.now()
-            user_subscription.save()
-            
-            # Log the event
-            SubscriptionHistory.objects.create(
-                subscription=user_subscription,
-                event_type='canceled',
-                description="Subscription canceled by user",
-            )
-            
+            SubscriptionService.record_cancellation(user_subscription)
             return user_subscription
             
         except Exception as e:
             logger.error(f"Error canceling subscription {user_subscription.id}: {str(e)}")
             raise
     
+    @staticmethod
+    def record_cancellation(user_subscription):
+        """Mark a subscription canceled by its user"""
+        return transition(
+            user_subscription,
+            'canceled',
+            'canceled',
+            "Subscription canceled by user",
+            canceled_at=timezone.now(),
+        )
+    
     @staticmethod
     def change_plan(user_subscription, new_plan_lookup_key):
         """Change user's subscription plan"""
         try:
-            new_plan = SubscriptionPlan.objects.get(lookup_key=new_plan_lookup_key, is_active=True)
+            new_plan = plan_catalog.get_by_lookup_key(new_plan_lookup_key)
             
+            old_plan = plan_catalog.get(user_subscription.plan_id)
+            
+            stripe_subscription = None
             if user_subscription.stripe_subscription_id:
-                StripeService.update_subscription(
+                stripe_subscription = StripeService.update_subscription(
                     user_subscription.stripe_subscription_id,
-                    new_plan.stripe_price_id
+                    new_plan.stripe_price_id,
+                    item_id=user_subscription.stripe_subscription_item_id,
                 )
             
-            old_plan = user_subscription.plan
-            user_subscription.plan = new_plan
-            user_subscription.save()
+            return SubscriptionService.record_plan_change(user_subscription, old_plan, new_plan, stripe_subscription)
             
-            # Log the event
-            SubscriptionHistory.objects.create(
-                subscription=user_subscription,
-                event_type='plan_changed',
-                description=f"Plan changed from {old_plan.name} to {new_plan.name}",
-                metadata={
-                    'old_plan': old_plan.lookup_key,
-                    'new_plan': new_plan.lookup_key,
-                }
-            )
+        except Exception as e:
+            logger.error(f"Error changing plan for subscription {user_subscription.id}: {str(e)}")
+            raise
+    
+    @staticmethod
+    def record_plan_change(user_subscription, old_plan, new_plan, stripe_subscription=None):
+        """Store a plan change, with the Stripe subscription it was made on if any, and log it"""
+        if stripe_subscription is not None:
+            user_subscription.stripe_subscription_item_id = subscription_item_id(stripe_subscription)
+        user_subscription.plan = new_plan
+        user_subscription.save()
+        
+        # Log the event
+        SubscriptionHistory.objects.create(
+            subscription=user_subscription,
+            event_type='plan_changed',
+            description=f"Plan changed from {old_plan.name} to {new_plan.name}",
+            metadata={
+                'old_plan': old_plan.lookup_key,
+                'new_plan': new_plan.lookup_key,
+            }
+        )
+        
+        return user_subscription
+    
+    @staticmethod
+    def apply_stripe_subscription(stripe_subscription, event_created=None, fetch_missing=True, batch=None):
+        """Update the local subscription from a Stripe subscription object
+        
+        Used with the subscription object delivered in a webhook so no extra
+        Stripe round trip is needed. Events created before the last applied
+        Stripe state are ignored so an out-of-order delivery never overwrites
+        newer data. If the payload lacks the fields we need the subscription is
+        fetched from Stripe instead. Changes are written through batch when one
+        is given, otherwise immediately.
+        """
+        if any(stripe_subscription.get(field) is None for field in STRIPE_SUBSCRIPTION_FIELDS):
+            if fetch_missing:
+                return SubscriptionService.sync_stripe_subscription(stripe_subscription['id'])
+            raise ValueError(f"Stripe subscription {stripe_subscription['id']} is missing required fields")
+        
+        try:
+            with batch_changes(batch) as changes:
+                user_subscription = changes.get(stripe_subscription['id'])
+                
+                if (event_created and user_subscription.stripe_synced_at
+                        and event_created < user_subscription.stripe_synced_at):
+                    logger.info(
+                        f"Skipping stale update for Stripe subscription {stripe_subscription['id']} "
+                        f"from {event_created.isoformat()}"
+                    )
+                    return user_subscription
+                
+                new_status = STATUS_MAPPING.get(stripe_subscription['status'], 'active')
+                if user_subscription.status != new_status:
+                    changes.transition(
+                        user_subscription,
+                        new_status,
+                        'status_changed',
+                        f"Status changed to {new_status}",
+                        {'stripe_status': stripe_subscription['status']}
+                    )
+                
+                # Update period dates
+                user_subscription.current_period_start = from_stripe_timestamp(
+                    stripe_subscription['current_period_start']
+                )
+                user_subscription.current_period_end = from_stripe_timestamp(
+                    stripe_subscription['current_period_end']
+                )
+                user_subscription.stripe_subscription_item_id = (
+                    subscription_item_id(stripe_subscription) or user_subscription.stripe_subscription_item_id
+                )
+                user_subscription.stripe_synced_at = event_created or timezone.now()
+                
+                changes.save(user_subscription)
             
             return user_subscription
             
         except Exception as e:
-            logger.error(f"Error changing plan for subscription {user_subscription.id}: {str(e)}")
+            logger.error(f"Error applying Stripe subscription {stripe_subscription['id']}: {str(e)}")
             raise
     
     @staticmethod
     def sync_stripe_subscription(stripe_subscription_id):
         """Sync local subscription with Stripe data"""
         try:
-            stripe_subscription = StripeService.get_subscription(stripe_subscription_id)
-            user_subscription = UserSubscription.objects.get(
-                stripe_subscription_id=stripe_subscription_id
+            # Read past the cache, and stamp the state with the time it was
+            # fetched so webhooks sent after that are still applied
+            fetched_at = timezone.now()
+            stripe_subscription = StripeService.get_subscription(stripe_subscription_id, use_cache=False)
+            return SubscriptionService.apply_stripe_subscription(
+                stripe_subscription, event_created=fetched_at, fetch_missing=False
             )
             
-            # Update subscription status based on Stripe status
-            status_mapping = {
-                'trialing': 'trial',
-                'active': 'active',
-                'past_due': 'past_due',
-                'canceled': 'canceled',
-                'unpaid': 'unpaid',
-            }
+        except Exception as e:
+            logger.error(f"Error syncing Stripe subscription {stripe_subscription_id}: {str(e)}")
+            raise
+
+
+# One thread per pooled Stripe connection, so async callers never queue for a
+# thread while a connection is free
+_stripe_executor = ThreadPoolExecutor(max_workers=settings.STRIPE_HTTP_POOL_SIZE, thread_name_prefix='stripe')
+
+
+def _off_event_loop(method):
+    """Wrap a blocking StripeService method so awaiting it runs it on a Stripe worker thread"""
+    return staticmethod(sync_to_async(method, thread_sensitive=False, executor=_stripe_executor))
+
+
+class AsyncStripeService:
+    """Awaitable StripeService for async views
+    
+    The stripe library only offers blocking calls, so each one runs on a
+    worker thread (sharing the pooled HTTP client) while the event loop keeps
+    serving other requests.
+    """
+    
+    create_customer = _off_event_loop(StripeService.create_customer)
+    create_subscription = _off_event_loop(StripeService.create_subscription)
+    cancel_subscription = _off_event_loop(StripeService.cancel_subscription)
+    update_subscription = _off_event_loop(StripeService.update_subscription)
+    get_subscription = _off_event_loop(StripeService.get_subscription)
+    create_checkout_session = _off_event_loop(StripeService.create_checkout_session)
+
+
+class AsyncCustomerService:
+    """CustomerService for async views, with the Stripe call made off the event loop"""
+    
+    @staticmethod
+    async def get_or_create_customer_id(user):
+        """Return the user's Stripe customer id, creating the customer on first need"""
+        try:
+            customer_id = await StripeCustomer.objects.filter(user=user).values_list(
+                'stripe_customer_id', flat=True
+            ).afirst()
+            if customer_id:
+                return customer_id
             
-            new_status = status_mapping.get(stripe_subscription.status, 'active')
-            if user_subscription.status != new_status:
-                user_subscription.status = new_status
-                
-                # Log the status change
-                SubscriptionHistory.objects.create(
-                    subscription=user_subscription,
-                    event_type='status_changed',
-                    description=f"Status changed to {new_status}",
-                    metadata={'stripe_status': stripe_subscription.status}
+            customer_id = await sync_to_async(CustomerService.get_subscription_customer_id)(user)
+            if not customer_id:
+                customer = await AsyncStripeService.create_customer(
+                    user, idempotency_key=await sync_to_async(customer_idempotency_key)(user)
                 )
+                customer_id = customer.id
+            try:
+                await sync_to_async(CustomerService.store_customer_id)(user, customer_id)
+            except IntegrityError:
+                # Another request stored the mapping first, and that customer is the user's
+                return await StripeCustomer.objects.filter(user=user).values_list(
+                    'stripe_customer_id', flat=True
+                ).afirst()
+            return customer_id
+            
+        except Exception as e:
+            logger.error(f"Error getting Stripe customer for user {user.id}: {str(e)}")
+            raise
+
+
+class AsyncCheckoutService:
+    """CheckoutService for async views, with the Stripe calls made off the event loop"""
+    
+    @staticmethod
+    async def get_or_create_session(user, plan, success_url, cancel_url):
+        """Return the user's open checkout session for a plan, creating one if there is none"""
+        try:
+            session = await CheckoutService.reusable_sessions(user, plan).afirst()
+            if session:
+                metrics.increment('checkout_sessions.reused')
+                return session
             
-            # Update period dates
-            user_subscription.current_period_start = datetime.fromtimestamp(
-                stripe_subscription.current_period_start
+            stripe_session = await AsyncStripeService.create_checkout_session(
+                await AsyncCustomerService.get_or_create_customer_id(user),
+                plan.stripe_price_id,
+                success_url=success_url,
+                cancel_url=cancel_url,
+                metadata={
+                    'user_id': user.id,
+                    'plan_lookup_key': plan.lookup_key,
+                }
             )
-            user_subscription.current_period_end = datetime.fromtimestamp(
-                stripe_subscription.current_period_end
+            return await sync_to_async(CheckoutService.register_or_reuse_session)(user, plan, stripe_session)
+            
+        except Exception as e:
+            logger.error(f"Error getting checkout session for user {user.id}: {str(e)}")
+            raise
+
+
+class AsyncSubscriptionService:
+    """SubscriptionService operations for async views
+    
+    Only the Stripe calls differ: they run off the event loop, and the
+    database writes go through the same SubscriptionService helpers.
+    """
+    
+    @staticmethod
+    async def create_trial_subscription(user, plan_lookup_key):
+        """Create a trial subscription for a user"""
+        try:
+            plan = await plan_catalog.aget_by_lookup_key(plan_lookup_key)
+            
+            if await UserSubscription.objects.filter(user=user).aexists():
+                raise ValueError("User already has a subscription")
+            
+            customer_id = await AsyncCustomerService.get_or_create_customer_id(user)
+            subscription = await AsyncStripeService.create_subscription(
+                customer_id,
+                plan.stripe_price_id,
+                trial_period_days=14
             )
             
-            user_subscription.save()
+            return await sync_to_async(SubscriptionService.record_trial)(user, plan, customer_id, subscription)
+            
+        except Exception as e:
+            logger.error(f"Error creating trial subscription for user {user.id}: {str(e)}")
+            raise
+    
+    @staticmethod
+    async def cancel_subscription(user_subscription):
+        """Cancel a user's subscription"""
+        try:
+            if user_subscription.stripe_subscription_id:
+                await AsyncStripeService.cancel_subscription(user_subscription.stripe_subscription_id)
             
+            await sync_to_async(SubscriptionService.record_cancellation)(user_subscription)
             return user_subscription
             
         except Exception as e:
-            logger.error(f"Error syncing Stripe subscription {stripe_subscription_id}: {str(e)}")
-            raise
\ No newline at end of file
+            logger.error(f"Error canceling subscription {user_subscription.id}: {str(e)}")
+            raise
+    
+    @staticmethod
+    async def change_plan(user_subscription, new_plan_lookup_key):
+        """Change user's subscription plan"""
+        try:
+            new_plan = await plan_catalog.aget_by_lookup_key(new_plan_lookup_key)
+            old_plan = await plan_catalog.aget(user_subscription.plan_id)
+            
+            stripe_subscription = None
+            if user_subscription.stripe_subscription_id:
+                stripe_subscription = await AsyncStripeService.update_subscription(
+                    user_subscription.stripe_subscription_id,
+                    new_plan.stripe_price_id,
+                    item_id=user_subscription.stripe_subscription_item_id,
+                )
+            
+            return await sync_to_async(SubscriptionService.record_plan_change)(
+                user_subscription, old_plan, new_plan, stripe_subscription
+            )
+            
+        except Exception as e:
+            logger.error(f"Error changing plan for subscription {user_subscription.id}: {str(e)}")
+            raise
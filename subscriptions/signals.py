@@ -1,45 +1,59 @@
-from django.db.models.signals import post_save, pre_save
+from django.conf import settings
+from django.db.models.signals import post_delete, post_save
 from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.utils import timezone
 from datetime import timedelta
-from .models import UserSubscription, SubscriptionHistory
+from .models import SubscriptionPlan, UserSubscription, SubscriptionHistory
+from .entitlements import ENTITLEMENT_FIELDS, entitlement_cache
+from .plan_catalog import plan_catalog
+from .provisioning import enqueue_customer_provisioning
 import logging
 
 logger = logging.getLogger(__name__)
 
 
 @receiver(post_save, sender=UserSubscription)
-def log_subscription_changes(sender, instance, created, **kwargs):
+def log_subscription_changes(sender, instance, created, update_fields=None, **kwargs):
     """Log subscription changes"""
     if created:
         SubscriptionHistory.objects.create(
             subscription=instance,
             event_type='created',
-            description=f"Subscription created for {instance.plan.name}",
+            description=f"Subscription created for {plan_catalog.get(instance.plan_id).name}",
         )
-    else:
-        # Check if status changed
-        if hasattr(instance, '_old_status') and instance._old_status != instance.status:
+    elif update_fields is None or 'status' in update_fields:
+        # The status loaded with the instance is still remembered until the save returns
+        old_status = instance.loaded_value('status')
+        if old_status is not None and old_status != instance.status:
             SubscriptionHistory.objects.create(
                 subscription=instance,
                 event_type='status_changed',
-                description=f"Status changed from {instance._old_status} to {instance.status}",
+                description=f"Status changed from {old_status} to {instance.status}",
                 metadata={
-                    'old_status': instance._old_status,
+                    'old_status': old_status,
                     'new_status': instance.status,
                 }
             )
 
 
-@receiver(pre_save, sender=UserSubscription)
-def track_status_changes(sender, instance, **kwargs):
-    """Track status changes for logging"""
-    if instance.pk:
-        try:
-            old_instance = UserSubscription.objects.get(pk=instance.pk)
-            instance._old_status = old_instance.status
-        except UserSubscription.DoesNotExist:
-            instance._old_status = None
-    else:
-        instance._old_status = None
\ No newline at end of file
+@receiver(post_save, sender=User)
+def queue_customer_provisioning(sender, instance, created, **kwargs):
+    """Queue creation of a new user's Stripe customer when pre-provisioning is enabled"""
+    if created and settings.STRIPE_PREPROVISION_CUSTOMERS:
+        enqueue_customer_provisioning(instance)
+
+
+@receiver(post_save, sender=UserSubscription)
+@receiver(post_delete, sender=UserSubscription)
+def invalidate_entitlement(sender, instance, update_fields=None, **kwargs):
+    """Drop the cached entitlement of a user whose subscription status, plan or dates changed"""
+    if update_fields is None or ENTITLEMENT_FIELDS.intersection(update_fields):
+        entitlement_cache.subscription_changed(instance.user_id)
+
+
+@receiver(post_save, sender=SubscriptionPlan)
+@receiver(post_delete, sender=SubscriptionPlan)
+def invalidate_plan_catalog(sender, **kwargs):
+    """Reload the plan catalog in every process after a plan changes"""
+    plan_catalog.plans_changed()
@@ -0,0 +1,132 @@
+"""Subscription status transitions
+
+Every status change goes through transition(), which applies it with a single
+UPDATE ... WHERE id = ? AND status IN (statuses allowed to reach the target)
+and writes the history entry in the same transaction. Concurrent writers
+therefore never overwrite each other's status: the loser's UPDATE matches no
+row and it is told so. Moving to the current status is never allowed, so
+repeated events are no-ops that write nothing. restart() replaces the Stripe
+subscription of a row, which is how a canceled user subscribes again.
+"""
+from django.db import transaction
+from django.utils import timezone
+import logging
+
+from .entitlements import entitlement_cache
+from .models import UserSubscription, SubscriptionHistory
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+# Statuses a subscription may move to from each status; canceled is final for
+# a Stripe subscription, and subscribing again goes through restart()
+TRANSITIONS = {
+    'trial': {'active', 'past_due', 'unpaid', 'canceled'},
+    'active': {'past_due', 'unpaid', 'canceled'},
+    'past_due': {'active', 'unpaid', 'canceled'},
+    'unpaid': {'active', 'past_due', 'canceled'},
+    'canceled': set(),
+}
+
+# The same table inverted: statuses each status may be reached from, ready
+# for the WHERE clause
+ALLOWED_FROM = {
+    status: tuple(sorted(source for source, targets in TRANSITIONS.items() if status in targets))
+    for status in TRANSITIONS
+}
+
+
+def can_transition(from_status, to_status):
+    """Whether the table allows moving from one status to another"""
+    return to_status in TRANSITIONS.get(from_status, ())
+
+
+def transition(user_subscription, new_status, event_type, description='', metadata=None, only_from=None,
+               log=True, **fields):
+    """Move a subscription to new_status if its stored status allows it, returning whether it did
+
+    fields are written by the same UPDATE, and only_from narrows the statuses
+    the change may start from. The instance is updated to match: with the new
+    values when the transition was applied, otherwise with the stored status.
+    With log=False no history entry is written, for callers that write their
+    own once the change is applied.
+    """
+    if user_subscription.status == new_status:
+        return False
+
+    sources = ALLOWED_FROM[new_status]
+    if only_from is not None:
+        sources = tuple(status for status in sources if status in only_from)
+
+    now = timezone.now()
+    with transaction.atomic():
+        updated = UserSubscription.objects.filter(pk=user_subscription.pk, status__in=sources).update(
+            status=new_status, updated_at=now, **fields
+        )
+        if updated and log:
+            SubscriptionHistory.objects.create(
+                subscription=user_subscription,
+                event_type=event_type,
+                description=description,
+                metadata=metadata or {},
+            )
+
+    if not updated:
+        current = UserSubscription.objects.filter(pk=user_subscription.pk).values_list('status', flat=True).first()
+        logger.info(
+            f"Subscription {user_subscription.pk} not moved from {current} to {new_status}"
+        )
+        metrics.increment('subscription_transitions.rejected')
+        if current is not None:
+            user_subscription.status = current
+            user_subscription.reset_changes(['status'])
+        return False
+
+    # Queryset updates send no signals, so invalidate here
+    entitlement_cache.subscription_changed(user_subscription.user_id)
+    user_subscription.status = new_status
+    user_subscription.updated_at = now
+    for name, value in fields.items():
+        setattr(user_subscription, name, value)
+    # Already written, so later saves of the instance leave these alone
+    user_subscription.reset_changes(['status', 'updated_at', *fields])
+    metrics.increment(f'subscription_transitions.{new_status}')
+    return True
+
+
+def restart(user_subscription, stripe_subscription_id, new_status, event_type, description='', metadata=None, **fields):
+    """Put a new Stripe subscription on an existing row, whatever its status, returning whether it did
+
+    A user subscribing again, usually after canceling, starts a new Stripe
+    subscription rather than moving the old one, so the table does not
+    apply. The UPDATE only matches while the row still holds the previous
+    Stripe subscription id, so a repeated delivery applies it once.
+    """
+    now = timezone.now()
+    fields = {'stripe_subscription_id': stripe_subscription_id, **fields}
+    with transaction.atomic():
+        updated = UserSubscription.objects.filter(
+            pk=user_subscription.pk, stripe_subscription_id=user_subscription.stripe_subscription_id
+        ).update(status=new_status, updated_at=now, **fields)
+        if updated:
+            SubscriptionHistory.objects.create(
+                subscription=user_subscription,
+                event_type=event_type,
+                description=description,
+                metadata=metadata or {},
+            )
+
+    if not updated:
+        logger.info(f"Subscription {user_subscription.pk} already moved to another Stripe subscription")
+        user_subscription.refresh_from_db()
+        return False
+
+    entitlement_cache.subscription_changed(user_subscription.user_id)
+    user_subscription.status = new_status
+    user_subscription.updated_at = now
+    for name, value in fields.items():
+        setattr(user_subscription, name, value)
+    user_subscription.reset_changes(['status', 'updated_at', *fields])
+    metrics.increment('subscription_transitions.restarted')
+    return True
+
@@ -0,0 +1,97 @@
+from django.conf import settings
+import json
+import logging
+import stripe
+
+from . import metrics
+from .cache import LRUCache, get_redis_client
+
+logger = logging.getLogger(__name__)
+
+
+class StripeSubscriptionCache:
+    """Read-through cache of Stripe subscription objects keyed by subscription id
+
+    Entries live in a per-process LRU and, when configured, in Redis so every
+    worker shares them. Webhooks for a subscription invalidate its entry and
+    mutating Stripe calls write their result through, so the TTL only bounds
+    how long a missed webhook can leave a stale copy. With Redis the local
+    copy is kept for at most local_ttl seconds, since invalidations from other
+    processes only reach Redis.
+    """
+
+    REDIS_KEY_PREFIX = 'stripe:subscription:'
+
+    def __init__(self, maxsize, redis_url='', ttl=300, local_ttl=30):
+        self.ttl = ttl
+        self.redis_url = redis_url
+        self.local = LRUCache(maxsize=maxsize, ttl=min(ttl, local_ttl) if redis_url else ttl)
+
+    @property
+    def redis(self):
+        return get_redis_client(self.redis_url)
+
+    def get(self, subscription_id):
+        """Return the cached subscription, or None on a miss"""
+        if not self.ttl:
+            return None
+
+        data = self.local.get(subscription_id)
+        if data is not None:
+            metrics.increment('stripe_cache.subscription.lru_hits')
+            return self._construct(data)
+
+        client = self.redis
+        if client is not None:
+            try:
+                raw = client.get(self.REDIS_KEY_PREFIX + subscription_id)
+            except Exception as e:
+                logger.warning(f"Subscription cache Redis lookup failed: {str(e)}")
+                raw = None
+            if raw is not None:
+                metrics.increment('stripe_cache.subscription.redis_hits')
+                data = json.loads(raw)
+                self.local.set(subscription_id, data)
+                return self._construct(data)
+
+        metrics.increment('stripe_cache.subscription.misses')
+        return None
+
+    def set(self, subscription):
+        """Store a subscription returned by Stripe"""
+        if not self.ttl:
+            return
+        data = subscription.to_dict_recursive() if hasattr(subscription, 'to_dict_recursive') else dict(subscription)
+        self.local.set(data['id'], data)
+        client = self.redis
+        if client is not None:
+            try:
+                client.set(self.REDIS_KEY_PREFIX + data['id'], json.dumps(data), ex=self.ttl)
+            except Exception as e:
+                logger.warning(f"Subscription cache Redis write failed: {str(e)}")
+
+    def invalidate(self, subscription_id):
+        """Drop a subscription from every cache layer"""
+        self.local.delete(subscription_id)
+        client = self.redis
+        if client is not None:
+            try:
+                client.delete(self.REDIS_KEY_PREFIX + subscription_id)
+            except Exception as e:
+                logger.warning(f"Subscription cache Redis invalidation failed: {str(e)}")
+        metrics.increment('stripe_cache.subscription.invalidations')
+
+    def clear(self):
+        """Forget locally cached subscriptions"""
+        self.local.clear()
+
+    def _construct(self, data):
+        # A fresh StripeObject per hit, so callers never share mutable state
+        return stripe.Subscription.construct_from(data, stripe.api_key)
+
+
+subscription_cache = StripeSubscriptionCache(
+    maxsize=settings.STRIPE_SUBSCRIPTION_CACHE_SIZE,
+    redis_url=settings.STRIPE_SUBSCRIPTION_CACHE_REDIS_URL,
+    ttl=settings.STRIPE_SUBSCRIPTION_CACHE_TTL,
+)
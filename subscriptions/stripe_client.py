@@ -0,0 +1,97 @@
+from django.conf import settings
+from requests.adapters import HTTPAdapter
+from stripe.http_client import RequestsClient
+from urllib.parse import urlsplit
+import logging
+import os
+import requests
+import stripe
+import threading
+import time
+
+from . import metrics
+from .instrumentation import record_http_attempt
+from .rate_limit import rate_limiter
+from .resilience import bulkhead, circuit_breaker
+
+logger = logging.getLogger(__name__)
+
+
+class PooledRequestsClient(RequestsClient):
+    """Stripe HTTP client sharing one keep-alive connection pool per process
+
+    The stripe library's default client opens a session per thread. This one
+    hands every thread the same requests.Session, whose adapter keeps up to
+    pool_size connections to the API alive, so gunicorn threads and task
+    workers reuse TLS connections instead of paying the handshake per call.
+    The session is rebuilt in forked children, since pooled sockets must not
+    be shared across processes.
+    """
+
+    def __init__(self, connect_timeout=5, read_timeout=30, pool_size=10, **kwargs):
+        self.pool_size = pool_size
+        super().__init__(timeout=(connect_timeout, read_timeout), session=self.build_session(), **kwargs)
+        os.register_at_fork(after_in_child=self.reset)
+
+    def build_session(self):
+        """A session whose HTTPS adapter pools connections"""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=False)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def reset(self):
+        """Drop inherited sockets and start a fresh pool"""
+        self._session = self.build_session()
+        self._thread_local = threading.local()
+
+    def request(self, method, url, headers, post_data=None):
+        """Perform the request within the rate limit, bulkhead and circuit breaker, logging its latency"""
+        # Wait for a rate limit token before taking a bulkhead slot, so
+        # throttled batch calls do not crowd out interactive ones
+        rate_limiter.acquire()
+        with bulkhead:
+            circuit_breaker.before_call()
+            record_http_attempt()
+            started = time.perf_counter()
+            status_code = None
+            try:
+                content, status_code, response_headers = super().request(method, url, headers, post_data)
+                return content, status_code, response_headers
+            finally:
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                metrics.increment('stripe.requests')
+                metrics.increment('stripe.request_ms', round(elapsed_ms))
+                # Timeouts, connection errors and 5xx count against Stripe;
+                # client errors and rate limits do not
+                if status_code is None or status_code >= 500:
+                    metrics.increment('stripe.request_errors')
+                    circuit_breaker.record_failure()
+                else:
+                    circuit_breaker.record_success()
+                logger.info(f"Stripe {method.upper()} {urlsplit(url).path} -> {status_code} in {elapsed_ms:.1f}ms")
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_stripe_client():
+    """Return this process's pooled Stripe HTTP client, creating it on first use"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = PooledRequestsClient(
+                connect_timeout=settings.STRIPE_CONNECT_TIMEOUT,
+                read_timeout=settings.STRIPE_READ_TIMEOUT,
+                pool_size=settings.STRIPE_HTTP_POOL_SIZE,
+            )
+        return _client
+
+
+def configure_stripe():
+    """Point the stripe library at our API key, API base and pooled HTTP client"""
+    stripe.api_key = settings.STRIPE_SECRET_KEY
+    stripe.api_base = settings.STRIPE_API_BASE
+    stripe.default_http_client = get_stripe_client()
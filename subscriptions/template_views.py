@@ -3,13 +3,16 @@ from django.contrib.auth import login, authenticate
 from django.contrib.auth.forms import UserCreationForm
 from django.contrib.auth.decorators import login_required
 from django.contrib import messages
+from django.db import transaction
 from django.http import JsonResponse
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_POST
 import json
 
-from .models import SubscriptionPlan, UserSubscription
+from .models import UserSubscription
+from .plan_catalog import plan_catalog
 from .services import SubscriptionService
+from .resilience import StripeUnavailable, unavailable_response
 
 
 def home_view(request):
@@ -19,7 +22,7 @@ def home_view(request):
 
 def subscription_plans_view(request):
     """Subscription plans page view"""
-    plans = SubscriptionPlan.objects.filter(is_active=True).order_by('plan_type', 'billing_period')
+    plans = plan_catalog.active_plans()
     return render(request, 'subscriptions/plans.html', {'plans': plans})
 
 
@@ -93,11 +96,14 @@ def register_view(request):
         
         # Create user
         try:
-            user = User.objects.create_user(
-                username=username,
-                email=email,
-                password=password1
-            )
+            # The post_save handlers' writes, such as the customer provisioning
+            # job, commit or roll back together with the user
+            with transaction.atomic():
+                user = User.objects.create_user(
+                    username=username,
+                    email=email,
+                    password=password1
+                )
             login(request, user)
             messages.success(request, 'Account created successfully!')
             return redirect('dashboard')
@@ -153,6 +159,8 @@ def create_subscription_view(request):
             'subscription_id': subscription.id
         })
         
+    except StripeUnavailable as e:
+        return unavailable_response(e)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
 
@@ -173,6 +181,8 @@ def cancel_subscription_view(request):
         
     except UserSubscription.DoesNotExist:
         return JsonResponse({'error': 'No subscription found'}, status=404)
+    except StripeUnavailable as e:
+        return unavailable_response(e)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
 
@@ -199,5 +209,7 @@ def change_plan_view(request):
         
     except UserSubscription.DoesNotExist:
         return JsonResponse({'error': 'No subscription found'}, status=404)
+    except StripeUnavailable as e:
+        return unavailable_response(e)
     except Exception as e:
         return JsonResponse({'error': str(e)}, status=400)
\ No newline at end of file
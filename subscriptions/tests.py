@@ -1,10 +1,42 @@
-from django.test import TestCase
+from django.test import AsyncRequestFactory, TestCase, override_settings
 from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils import timezone
 from datetime import timedelta
+from io import StringIO
+import asyncio
+import gzip
+import json
+import tempfile
+import threading
+import time
 from unittest.mock import patch, MagicMock
-from .models import SubscriptionPlan, UserSubscription, SubscriptionHistory
-from .services import SubscriptionService, StripeService
+import stripe
+from .models import (
+    SubscriptionPlan, UserSubscription, StripeCustomer, CustomerCreationKey, CustomerProvisioningJob, CheckoutSession,
+    SubscriptionHistory, StripeWebhookEvent,
+)
+from .services import (
+    AsyncCustomerService, AsyncStripeService, CheckoutService, CustomerService, SubscriptionService, StripeService,
+    customer_idempotency_key, from_stripe_timestamp,
+)
+from .webhooks import _in_order_prefixes, claim_webhook_events, dispatch_event, process_webhook_batch
+from .batching import SubscriptionChangeBatch
+from .dedup import webhook_deduplicator
+from .fake_stripe import fake_stripe
+from .entitlements import compute_entitlement, compute_entitlements, entitlement_cache, has_access
+from .plan_catalog import PlanCatalog, plan_catalog
+from .provisioning import claim_provisioning_jobs, enqueue_customer_provisioning, provisioning_status
+from .rate_limit import BATCH, INTERACTIVE, WEBHOOK, StripeRateLimiter, current_priority, stripe_priority
+from .state_machine import can_transition, transition
+from .resilience import Bulkhead, CircuitBreaker, StripeUnavailable, circuit_breaker
+from .stripe_cache import subscription_cache
+from .stripe_client import PooledRequestsClient
+from .management.commands import process_trial_expirations
+from . import async_views, instrumentation, metrics
 
 
 class SubscriptionPlanModelTest(TestCase):
@@ -93,6 +125,7 @@ class SubscriptionServiceTest(TestCase):
             stripe_price_id='price_test',
             lookup_key='monthly-basic',
         )
+        subscription_cache.clear()
     
     @patch('subscriptions.services.StripeService.create_customer')
     @patch('subscriptions.services.StripeService.create_subscription')
@@ -107,6 +140,7 @@ class SubscriptionServiceTest(TestCase):
         mock_subscription.id = 'sub_test123'
         mock_subscription.current_period_start = 1234567890
         mock_subscription.current_period_end = 1234567890 + 30*24*60*60
+        mock_subscription.get.return_value = {'data': [{'id': 'si_test123'}]}
         mock_create_subscription.return_value = mock_subscription
         
         # Create subscription
@@ -120,6 +154,10 @@ class SubscriptionServiceTest(TestCase):
         self.assertEqual(subscription.status, 'trial')
         self.assertEqual(subscription.stripe_customer_id, 'cus_test123')
         self.assertEqual(subscription.stripe_subscription_id, 'sub_test123')
+        self.assertEqual(subscription.stripe_subscription_item_id, 'si_test123')
+        self.assertEqual(self.user.stripe_customer.stripe_customer_id, 'cus_test123')
+        self.assertEqual(subscription.current_period_start, from_stripe_timestamp(1234567890))
+        self.assertTrue(timezone.is_aware(subscription.current_period_start))
         
         # Check that history was created
         history = SubscriptionHistory.objects.filter(subscription=subscription)
@@ -161,6 +199,1328 @@ class SubscriptionServiceTest(TestCase):
             self.assertTrue(history.exists())
             self.assertEqual(history.first().event_type, 'canceled')
 
+    
+    def test_apply_stripe_subscription_uses_payload(self):
+        """Test that a complete webhook payload is applied without fetching from Stripe"""
+        subscription = UserSubscription.objects.create(
+            user=self.user,
+            plan=self.plan,
+            status='trial',
+            stripe_subscription_id='sub_test123',
+        )
+        payload = {
+            'id': 'sub_test123',
+            'status': 'active',
+            'current_period_start': 1700000000,
+            'current_period_end': 1700000000 + 30*24*60*60,
+        }
+        
+        with patch('subscriptions.services.StripeService.get_subscription') as mock_get:
+            SubscriptionService.apply_stripe_subscription(payload, event_created=timezone.now())
+            mock_get.assert_not_called()
+        
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.status, 'active')
+        self.assertEqual(int(subscription.current_period_start.timestamp()), 1700000000)
+        
+        # An event created before the applied state is ignored
+        stale = dict(payload, status='past_due')
+        SubscriptionService.apply_stripe_subscription(stale, event_created=timezone.now() - timedelta(minutes=5))
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.status, 'active')
+    
+    def test_created_event_is_the_baseline_for_later_updates(self):
+        """Test that the created webhook stores aware period dates and its event time for the staleness check"""
+        created_at = timezone.now()
+        payload = {
+            'id': 'sub_test123',
+            'customer': 'cus_test',
+            'status': 'trialing',
+            'metadata': {'user_id': str(self.user.id), 'plan_lookup_key': 'monthly-basic'},
+            'current_period_start': 1700000000,
+            'current_period_end': 1700000000 + 30*24*60*60,
+        }
+        dispatch_event('customer.subscription.created', {'object': payload}, event_created=created_at)
+        
+        subscription = UserSubscription.objects.get()
+        self.assertEqual(subscription.current_period_start, from_stripe_timestamp(1700000000))
+        self.assertEqual(subscription.stripe_synced_at, created_at)
+        
+        # An update sent before the creation arrives after it and is ignored
+        dispatch_event(
+            'customer.subscription.updated', {'object': dict(payload, status='past_due')},
+            event_created=created_at - timedelta(seconds=5),
+        )
+        self.assertEqual(UserSubscription.objects.get().status, 'trial')
+        
+        # A repeated created event older than the applied state changes nothing
+        dispatch_event(
+            'customer.subscription.created', {'object': dict(payload, current_period_end=1700000001)},
+            event_created=created_at - timedelta(seconds=5),
+        )
+        subscription = UserSubscription.objects.get()
+        self.assertEqual(subscription.current_period_end, from_stripe_timestamp(1700000000 + 30*24*60*60))
+        self.assertEqual(subscription.stripe_synced_at, created_at)
+    
+    def test_apply_stripe_subscription_fetches_incomplete_payload(self):
+        """Test that a payload missing fields falls back to retrieving the subscription"""
+        UserSubscription.objects.create(
+            user=self.user,
+            plan=self.plan,
+            status='trial',
+            stripe_subscription_id='sub_test123',
+        )
+        
+        with patch('subscriptions.services.StripeService.get_subscription') as mock_get:
+            mock_get.return_value = {
+                'id': 'sub_test123',
+                'status': 'past_due',
+                'current_period_start': 1700000000,
+                'current_period_end': 1700000000 + 30*24*60*60,
+            }
+            subscription = SubscriptionService.apply_stripe_subscription({'id': 'sub_test123'})
+            mock_get.assert_called_once_with('sub_test123', use_cache=False)
+        
+        self.assertEqual(subscription.status, 'past_due')
+    
+    def test_sync_reads_past_the_cache(self):
+        """Test that a sync fetches fresh state and keeps applying webhooks sent after the fetch"""
+        UserSubscription.objects.create(
+            user=self.user,
+            plan=self.plan,
+            status='trial',
+            stripe_subscription_id='sub_test123',
+        )
+        stale = {
+            'id': 'sub_test123',
+            'status': 'trialing',
+            'current_period_start': 1700000000,
+            'current_period_end': 1700000000 + 30*24*60*60,
+        }
+        subscription_cache.set(stale)
+        
+        with patch('stripe.Subscription.retrieve', return_value=dict(stale, status='active')):
+            subscription = SubscriptionService.sync_stripe_subscription('sub_test123')
+        subscription_cache.clear()
+        self.assertEqual(subscription.status, 'active')
+        
+        SubscriptionService.apply_stripe_subscription(
+            dict(stale, status='past_due'), event_created=timezone.now() + timedelta(seconds=1)
+        )
+        self.assertEqual(UserSubscription.objects.get().status, 'past_due')
+    
+    def test_stripe_calls_share_pooled_session(self):
+        """Test that Stripe calls from different threads reuse one pooled session"""
+        client = stripe.default_http_client
+        self.assertIsInstance(client, PooledRequestsClient)
+        metrics.reset()
+        
+        response = MagicMock(status_code=200, content=b'{"id": "sub_test123", "object": "subscription"}', headers={})
+        with patch('stripe.api_key', 'sk_test'), \
+                patch.object(client._session, 'request', return_value=response) as mock_request:
+            StripeService.get_subscription('sub_test123', use_cache=False)
+            thread = threading.Thread(
+                target=StripeService.get_subscription, args=('sub_test123',), kwargs={'use_cache': False}
+            )
+            thread.start()
+            thread.join()
+        
+        self.assertEqual(mock_request.call_count, 2)
+        self.assertEqual(mock_request.call_args.kwargs['timeout'], (5.0, 30.0))
+        self.assertEqual(metrics.get_counters('stripe.')['stripe.requests'], 2)
+    
+    def test_stripe_service_against_fake_stripe(self):
+        """Test the Stripe calls StripeService makes against the local fake API"""
+        with fake_stripe() as server:
+            customer = StripeService.create_customer(self.user)
+            subscription = StripeService.create_subscription(customer.id, 'price_test')
+            self.assertEqual(subscription.status, 'trialing')
+            
+            StripeService.update_subscription(subscription.id, 'price_pro')
+            StripeService.cancel_subscription(subscription.id)
+            subscription = StripeService.get_subscription(subscription.id)
+            self.assertEqual(subscription['items']['data'][0]['price']['id'], 'price_pro')
+            self.assertTrue(subscription.cancel_at_period_end)
+            # Both retrieves are served from the write-through cache
+            self.assertEqual(len(server.requests), 4)
+    
+    def test_get_subscription_reads_through_cache(self):
+        """Test that retrieves are cached until a webhook invalidates them"""
+        metrics.reset()
+        with fake_stripe() as server:
+            customer = StripeService.create_customer(self.user)
+            subscription_id = StripeService.create_subscription(customer.id, 'price_test').id
+            subscription_cache.clear()
+            
+            StripeService.get_subscription(subscription_id)
+            StripeService.get_subscription(subscription_id)
+            self.assertEqual(server.requests.count(('GET', f'/v1/subscriptions/{subscription_id}')), 1)
+            
+            subscription_cache.invalidate(subscription_id)
+            StripeService.get_subscription(subscription_id)
+            self.assertEqual(server.requests.count(('GET', f'/v1/subscriptions/{subscription_id}')), 2)
+        
+        counters = metrics.get_counters('stripe_cache.subscription.')
+        self.assertEqual(counters['stripe_cache.subscription.lru_hits'], 1)
+        self.assertEqual(counters['stripe_cache.subscription.misses'], 2)
+    
+    def test_change_plan_makes_one_stripe_call(self):
+        """Test that a stored subscription item id saves the retrieve before modify"""
+        pro_plan = SubscriptionPlan.objects.create(
+            name='Pro Monthly',
+            plan_type='pro',
+            billing_period='monthly',
+            price=30.00,
+            stripe_price_id='price_pro',
+            lookup_key='monthly-pro',
+        )
+        with fake_stripe() as server:
+            customer = StripeService.create_customer(self.user)
+            stripe_subscription = StripeService.create_subscription(customer.id, 'price_test')
+            user_subscription = UserSubscription.objects.create(
+                user=self.user,
+                plan=self.plan,
+                status='trial',
+                stripe_subscription_id=stripe_subscription.id,
+                stripe_subscription_item_id=stripe_subscription['items']['data'][0]['id'],
+            )
+            subscription_cache.clear()
+            del server.requests[:]
+            
+            SubscriptionService.change_plan(user_subscription, 'monthly-pro')
+            self.assertEqual(server.requests, [('POST', f'/v1/subscriptions/{stripe_subscription.id}')])
+            self.assertEqual(server.subscriptions[stripe_subscription.id]['items']['data'][0]['price']['id'], 'price_pro')
+        
+        user_subscription.refresh_from_db()
+        self.assertEqual(user_subscription.plan, pro_plan)
+    
+    def test_backfill_subscription_items(self):
+        """Test that the backfill command fills missing item ids from Stripe"""
+        with fake_stripe():
+            customer = StripeService.create_customer(self.user)
+            stripe_subscription = StripeService.create_subscription(customer.id, 'price_test')
+            user_subscription = UserSubscription.objects.create(
+                user=self.user,
+                plan=self.plan,
+                status='trial',
+                stripe_subscription_id=stripe_subscription.id,
+            )
+            out = StringIO()
+            call_command('backfill_subscription_items', stdout=out)
+        
+        user_subscription.refresh_from_db()
+        self.assertEqual(user_subscription.stripe_subscription_item_id, stripe_subscription['items']['data'][0]['id'])
+        self.assertIn('Filled: 1', out.getvalue())
+        self.assertIn('subscription.list: 1 calls', out.getvalue())
+    
+    def test_list_subscriptions_pages_through_the_account(self):
+        """Test that listing follows has_more with one request per page"""
+        with fake_stripe() as server:
+            customer = StripeService.create_customer(self.user)
+            created = [StripeService.create_subscription(customer.id, 'price_test').id for _ in range(5)]
+            listed = [subscription.id for subscription in StripeService.list_subscriptions(page_size=2)]
+            self.assertEqual(server.requests.count(('GET', '/v1/subscriptions')), 3)
+        self.assertEqual(listed, created)
+    
+    def test_fake_stripe_injects_rate_limits(self):
+        """Test that the fake API answers with 429s at the configured rate"""
+        with fake_stripe(rate_limit_rate=1.0):
+            with self.assertRaises(stripe.error.RateLimitError):
+                StripeService.create_customer(self.user)
+
+class StripeResilienceTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        self.plan = SubscriptionPlan.objects.create(
+            name='Basic Monthly',
+            plan_type='basic',
+            billing_period='monthly',
+            price=15.00,
+            stripe_price_id='price_test',
+            lookup_key='monthly-basic',
+        )
+        circuit_breaker.reset()
+        metrics.reset()
+    
+    def tearDown(self):
+        circuit_breaker.reset()
+    
+    def test_circuit_breaker_opens_and_probes(self):
+        """Test that the breaker opens after consecutive failures and closes after a good probe"""
+        breaker = CircuitBreaker(failure_threshold=2, reset_timeout=0.05)
+        breaker.record_failure()
+        breaker.before_call()
+        breaker.record_failure()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        
+        with self.assertRaises(StripeUnavailable):
+            breaker.before_call()
+        
+        time.sleep(0.06)
+        breaker.before_call()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        # Only one probe at a time
+        with self.assertRaises(StripeUnavailable):
+            breaker.before_call()
+        breaker.record_success()
+        self.assertEqual(breaker.state, CircuitBreaker.CLOSED)
+    
+    def test_bulkhead_rejects_calls_over_the_limit(self):
+        """Test that the bulkhead caps concurrent calls"""
+        limited = Bulkhead(max_concurrent=1, acquire_timeout=0.01)
+        with limited:
+            with self.assertRaises(StripeUnavailable):
+                with limited:
+                    pass
+        with limited:
+            self.assertEqual(limited.in_flight, 1)
+        self.assertEqual(metrics.get_counters('stripe.')['stripe.bulkhead_rejections'], 1)
+    
+    def test_views_fail_fast_while_circuit_is_open(self):
+        """Test that once Stripe keeps failing, views answer 503 without calling it"""
+        UserSubscription.objects.create(
+            user=self.user,
+            plan=self.plan,
+            status='active',
+            stripe_subscription_id='sub_test123',
+        )
+        self.client.force_login(self.user)
+        
+        with fake_stripe(error_rate=1.0) as server:
+            for _ in range(circuit_breaker.failure_threshold):
+                with self.assertRaises(stripe.error.APIError):
+                    StripeService.create_customer(self.user)
+            self.assertEqual(circuit_breaker.state, CircuitBreaker.OPEN)
+            
+            requests_before = len(server.requests)
+            response = self.client.post(reverse('cancel-subscription'))
+            self.assertEqual(len(server.requests), requests_before)
+        
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json()['reason'], 'circuit_open')
+        self.assertIn('Retry-After', response)
+        self.assertEqual(UserSubscription.objects.get(user=self.user).status, 'active')
+
+
+class StripeRateLimitTest(TestCase):
+    def setUp(self):
+        metrics.reset()
+    
+    def test_priorities_leave_headroom_for_higher_classes(self):
+        """Test that batch calls stop at their reserve while interactive calls still get tokens"""
+        limiter = StripeRateLimiter(rate=1, burst=10, max_waits={INTERACTIVE: 0, WEBHOOK: 0, BATCH: 0})
+        for _ in range(5):
+            limiter.acquire(BATCH)
+        with self.assertRaises(StripeUnavailable):
+            limiter.acquire(BATCH)
+        for _ in range(3):
+            limiter.acquire(WEBHOOK)
+        with self.assertRaises(StripeUnavailable) as raised:
+            limiter.acquire(WEBHOOK)
+        self.assertEqual(raised.exception.reason, 'rate_limited')
+        limiter.acquire(INTERACTIVE)
+        counters = metrics.get_counters('stripe.')
+        self.assertEqual(counters['stripe.rate_limit_rejections.batch'], 1)
+        self.assertEqual(counters['stripe.rate_limit_rejections.webhook'], 1)
+    
+    def test_batch_calls_wait_for_tokens(self):
+        """Test that batch calls slow down instead of failing"""
+        limiter = StripeRateLimiter(rate=50, burst=2)
+        started = time.monotonic()
+        with stripe_priority(BATCH):
+            for _ in range(4):
+                limiter.acquire()
+        self.assertGreaterEqual(time.monotonic() - started, 0.05)
+        self.assertIn('stripe.rate_limit_wait_ms.batch', metrics.get_counters('stripe.'))
+    
+    def test_priority_can_only_be_lowered(self):
+        """Test that nested blocks never raise the priority of batch work"""
+        self.assertEqual(current_priority(), INTERACTIVE)
+        with stripe_priority(BATCH):
+            with stripe_priority(WEBHOOK):
+                self.assertEqual(current_priority(), BATCH)
+        with stripe_priority(WEBHOOK):
+            self.assertEqual(current_priority(), WEBHOOK)
+        self.assertEqual(current_priority(), INTERACTIVE)
+
+
+class StripeInstrumentationTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        SubscriptionPlan.objects.create(
+            name='Basic Monthly',
+            plan_type='basic',
+            billing_period='monthly',
+            price=15.00,
+            stripe_price_id='price_test',
+            lookup_key='monthly-basic',
+        )
+        circuit_breaker.reset()
+        instrumentation.reset()
+    
+    def tearDown(self):
+        circuit_breaker.reset()
+    
+    def test_histogram_percentiles(self):
+        """Test that percentiles come from the bucket bounds, capped at the largest value"""
+        histogram = metrics.Histogram(bounds=(10, 100, float('inf')))
+        for value in [1] * 90 + [50] * 9 + [400]:
+            histogram.observe(value)
+        snapshot = histogram.snapshot()
+        self.assertEqual(snapshot['count'], 100)
+        self.assertEqual(snapshot['p50'], 10)
+        self.assertEqual(snapshot['p95'], 100)
+        self.assertEqual(snapshot['p99'], 100)
+        self.assertEqual(snapshot['max'], 400)
+        self.assertEqual(snapshot['buckets'], {'10': 90, '100': 9, '+Inf': 1})
+    
+    def test_calls_are_attributed_to_the_view(self):
+        """Test that view calls are counted per operation with latency and exposed on the metrics endpoint"""
+        self.client.force_login(self.user)
+        with fake_stripe(latency_ms=20):
+            response = self.client.post(reverse('create-checkout'), {'plan_lookup_key': 'monthly-basic'})
+        self.assertEqual(response.status_code, 200)
+        
+        by_caller = instrumentation.stripe_call_stats()['by_caller']['view:create-checkout']
+        self.assertEqual(set(by_caller), {'customer.create', 'checkout_session.create'})
+        checkout = by_caller['checkout_session.create']
+        self.assertEqual(checkout['count'], 1)
+        self.assertEqual(checkout['errors'], {})
+        self.assertGreaterEqual(checkout['latency_ms']['max'], 20)
+        
+        self.user.is_staff = True
+        self.user.save()
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response.json()['stripe_calls']['operations']['checkout_session.create']['count'], 1)
+    
+    def test_errors_and_retries_are_recorded(self):
+        """Test that failed calls are counted by error class and resent requests as retries"""
+        with fake_stripe(error_rate=1.0) as server, patch.object(stripe, 'max_network_retries', 1):
+            with self.assertRaises(stripe.error.APIError):
+                StripeService.create_customer(self.user)
+            self.assertEqual(server.requests.count(('POST', '/v1/customers')), 2)
+        
+        stats = instrumentation.stripe_call_stats('unknown')['operations']['customer.create']
+        self.assertEqual(stats['count'], 1)
+        self.assertEqual(stats['errors'], {'APIError': 1})
+        self.assertEqual(stats['retries'], 1)
+    
+    def test_cache_hits_are_not_counted_as_calls(self):
+        """Test that only subscription retrieves that reach Stripe are recorded"""
+        with fake_stripe():
+            customer = StripeService.create_customer(self.user)
+            subscription_id = StripeService.create_subscription(customer.id, 'price_test').id
+            subscription_cache.clear()
+            StripeService.get_subscription(subscription_id)
+            StripeService.get_subscription(subscription_id)
+        
+        stats = instrumentation.stripe_call_stats('unknown')['operations']['subscription.retrieve']
+        self.assertEqual(stats['count'], 1)
+    
+    def test_commands_print_a_summary(self):
+        """Test that a command's calls are tagged with its name and summarised in its output"""
+        out = StringIO()
+        call_command('provision_stripe_customers', '--once', stdout=out)
+        self.assertNotIn('Stripe calls:', out.getvalue())
+        
+        enqueue_customer_provisioning(self.user)
+        with fake_stripe():
+            call_command('provision_stripe_customers', '--once', stdout=out)
+        self.assertIn('Stripe calls:', out.getvalue())
+        self.assertIn('customer.create: 1 calls', out.getvalue())
+        stats = instrumentation.stripe_call_stats('command:provision_stripe_customers')
+        self.assertEqual(stats['operations']['customer.create']['count'], 1)
+
+
+class StripeCustomerMappingTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        self.plan = SubscriptionPlan.objects.create(
+            name='Basic Monthly',
+            plan_type='basic',
+            billing_period='monthly',
+            price=15.00,
+            stripe_price_id='price_test',
+            lookup_key='monthly-basic',
+        )
+    
+    def test_checkout_reuses_the_stripe_customer(self):
+        """Test that repeated checkouts create the Stripe customer only once"""
+        self.client.force_login(self.user)
+        with fake_stripe() as server:
+            for _ in range(3):
+                response = self.client.post(reverse('create-checkout'), {'plan_lookup_key': 'monthly-basic'})
+                self.assertEqual(response.status_code, 200)
+            self.assertEqual(server.requests.count(('POST', '/v1/customers')), 1)
+            self.assertEqual(len(server.customers), 1)
+        
+        self.assertEqual(self.user.stripe_customer.stripe_customer_id, next(iter(server.customers)))
+    
+    def test_trial_subscription_uses_mapped_customer(self):
+        """Test that a trial subscription is created for the customer made at checkout"""
+        with fake_stripe() as server:
+            customer_id = CustomerService.get_or_create_customer_id(self.user)
+            subscription = SubscriptionService.create_trial_subscription(self.user, 'monthly-basic')
+            self.assertEqual(server.requests.count(('POST', '/v1/customers')), 1)
+        
+        self.assertEqual(subscription.stripe_customer_id, customer_id)
+    
+    def test_lost_mapping_gets_the_same_customer_back(self):
+        """Test that the idempotency key makes a repeated creation return the same customer"""
+        with fake_stripe() as server:
+            customer_id = CustomerService.get_or_create_customer_id(self.user)
+            StripeCustomer.objects.filter(user=self.user).delete()
+            self.assertEqual(CustomerService.get_or_create_customer_id(self.user), customer_id)
+            self.assertEqual(len(server.customers), 1)
+    
+    def test_idempotency_key_is_random_per_user(self):
+        """Test that the customer creation key is stable for a user but differs between databases"""
+        key = customer_idempotency_key(self.user)
+        self.assertEqual(customer_idempotency_key(self.user), key)
+        
+        # Another install holding a user with the same id has another token
+        CustomerCreationKey.objects.filter(user=self.user).delete()
+        self.assertNotEqual(customer_idempotency_key(self.user), key)
+    
+    def test_failed_creation_keeps_the_key_out_of_the_provisioning_queue(self):
+        """Test that a failed customer creation keeps its key for the retry and queues no provisioning job"""
+        with fake_stripe(error_rate=1.0):
+            with self.assertRaises(Exception):
+                CustomerService.get_or_create_customer_id(self.user)
+        key = customer_idempotency_key(self.user)
+        
+        with fake_stripe() as server:
+            CustomerService.get_or_create_customer_id(self.user)
+            self.assertEqual(list(server.idempotent_customers), [key])
+        self.assertFalse(CustomerProvisioningJob.objects.filter(user=self.user).exists())
+        self.assertEqual(provisioning_status()['pending'], 0)
+    
+    def test_backfill_stripe_customers(self):
+        """Test that the backfill maps users from subscriptions and Stripe customer metadata"""
+        other = User.objects.create_user(username='other', email='other@example.com')
+        unknown = User.objects.create_user(username='unknown', email='unknown@example.com')
+        UserSubscription.objects.create(
+            user=self.user,
+            plan=self.plan,
+            status='active',
+            stripe_customer_id='cus_from_subscription',
+        )
+        out = StringIO()
+        with fake_stripe():
+            first = StripeService.create_customer(other)
+            StripeService.create_customer(other)
+            call_command('backfill_stripe_customers', stdout=out)
+        
+        self.assertEqual(self.user.stripe_customer.stripe_customer_id, 'cus_from_subscription')
+        self.assertEqual(StripeCustomer.objects.get(user=other).stripe_customer_id, first.id)
+        self.assertFalse(StripeCustomer.objects.filter(user=unknown).exists())
+        self.assertIn('1 users have more than one Stripe customer', out.getvalue())
+        self.assertIn('customer.list: 1 calls', out.getvalue())
+    
+    def test_list_customers_pages_through_the_account(self):
+        """Test that listing customers follows has_more with one request per page"""
+        with fake_stripe() as server:
+            created = [StripeService.create_customer(self.user).id for _ in range(3)]
+            listed = [customer.id for customer in StripeService.list_customers(page_size=2)]
+            self.assertEqual(server.requests.count(('GET', '/v1/customers')), 2)
+        self.assertEqual(listed, created)
+
+
+class CustomerProvisioningTest(TestCase):
+    def setUp(self):
+        SubscriptionPlan.objects.create(
+            name='Basic Monthly',
+            plan_type='basic',
+            billing_period='monthly',
+            price=15.00,
+            stripe_price_id='price_test',
+            lookup_key='monthly-basic',
+        )
+        circuit_breaker.reset()
+    
+    def tearDown(self):
+        circuit_breaker.reset()
+    
+    def register(self, username):
+        self.client.post(reverse('register'), {
+            'username': username,
+            'email': f'{username}@example.com',
+            'password1': 'testpass123',
+            'password2': 'testpass123',
+        })
+        return User.objects.get(username=username)
+    
+    @override_settings(STRIPE_PREPROVISION_CUSTOMERS=True)
+    def test_customer_is_ready_before_checkout(self):
+        """Test that a provisioned customer saves the Stripe call on the first checkout"""
+        user = self.register('newuser')
+        self.assertIsNone(user.customer_provisioning.provisioned_at)
+        
+        with fake_stripe() as server:
+            call_command('provision_stripe_customers', '--once', stdout=StringIO())
+            job = CustomerProvisioningJob.objects.get(user=user)
+            self.assertIsNotNone(job.provisioned_at)
+            self.assertEqual(job.attempts, 1)
+            
+            response = self.client.post(reverse('create-checkout'), {'plan_lookup_key': 'monthly-basic'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(server.requests.count(('POST', '/v1/customers')), 1)
+        
+        self.assertEqual(provisioning_status()['pending'], 0)
+    
+    @override_settings(STRIPE_PREPROVISION_CUSTOMERS=True)
+    def test_user_is_not_created_without_its_job(self):
+        """Test that registration rolls the user back when queueing the job fails"""
+        with patch('subscriptions.signals.enqueue_customer_provisioning', side_effect=RuntimeError('queue down')):
+            self.client.post(reverse('register'), {
+                'username': 'newuser',
+                'email': 'newuser@example.com',
+                'password1': 'testpass123',
+                'password2': 'testpass123',
+            })
+        
+        self.assertFalse(User.objects.filter(username='newuser').exists())
+    
+    def test_provisioning_is_opt_in(self):
+        """Test that no job is queued unless pre-provisioning is enabled"""
+        user = self.register('newuser')
+        self.assertFalse(CustomerProvisioningJob.objects.filter(user=user).exists())
+    
+    @override_settings(STRIPE_PREPROVISION_CUSTOMERS=True)
+    def test_failed_provisioning_is_retried_with_backoff(self):
+        """Test that a failure leaves the job queued for a later attempt"""
+        user = self.register('newuser')
+        with fake_stripe(error_rate=1.0):
+            call_command('provision_stripe_customers', '--once', stdout=StringIO())
+        
+        job = CustomerProvisioningJob.objects.get(user=user)
+        self.assertIsNone(job.provisioned_at)
+        self.assertEqual(job.attempts, 1)
+        self.assertGreater(job.next_attempt_at, timezone.now())
+        self.assertTrue(job.last_error)
+        self.assertEqual(claim_provisioning_jobs('test-worker'), [])
+        self.assertEqual(provisioning_status()['pending'], 1)
+
+
+class CheckoutSessionRegistryTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        self.plan = SubscriptionPlan.objects.create(
+            name='Basic Monthly',
+            plan_type='basic',
+            billing_period='monthly',
+            price=15.00,
+            stripe_price_id='price_test',
+            lookup_key='monthly-basic',
+        )
+        SubscriptionPlan.objects.create(
+            name='Pro Monthly',
+            plan_type='pro',
+            billing_period='monthly',
+            price=30.00,
+            stripe_price_id='price_pro',
+            lookup_key='monthly-pro',
+        )
+        self.client.force_login(self.user)
+    
+    def checkout(self, plan_lookup_key='monthly-basic'):
+        response = self.client.post(reverse('create-checkout'), {'plan_lookup_key': plan_lookup_key})
+        self.assertEqual(response.status_code, 200)
+        return response.json()['session_id']
+    
+    def test_repeat_clicks_reuse_the_open_session(self):
+        """Test that the same plan gets the same session and another plan a new one"""
+        with fake_stripe() as server:
+            session_ids = {self.checkout() for _ in range(3)}
+            self.assertEqual(len(session_ids), 1)
+            self.assertEqual(server.requests.count(('POST', '/v1/checkout/sessions')), 1)
+            
+            self.assertNotIn(self.checkout('monthly-pro'), session_ids)
+            self.assertEqual(server.requests.count(('POST', '/v1/checkout/sessions')), 2)
+    
+    def test_webhooks_close_sessions(self):
+        """Test that completed and expired sessions are no longer handed out"""
+        with fake_stripe() as server:
+            completed = self.checkout()
+            dispatch_event('checkout.session.completed', {'object': {'id': completed, 'status': 'complete'}})
+            expired = self.checkout()
+            self.assertNotEqual(expired, completed)
+            
+            dispatch_event('checkout.session.expired', {'object': {'id': expired, 'status': 'expired'}})
+            self.assertNotIn(self.checkout(), [completed, expired])
+            self.assertEqual(server.requests.count(('POST', '/v1/checkout/sessions')), 3)
+        
+        self.assertEqual(CheckoutSession.objects.get(stripe_session_id=completed).status, 'complete')
+        self.assertEqual(CheckoutSession.objects.get(stripe_session_id=expired).status, 'expired')
+    
+    def test_session_close_to_expiry_is_replaced(self):
+        """Test that a session about to expire is not handed out again"""
+        with fake_stripe():
+            old = self.checkout()
+            CheckoutSession.objects.filter(stripe_session_id=old).update(expires_at=timezone.now() + timedelta(minutes=5))
+            self.assertNotEqual(self.checkout(), old)
+        
+        self.assertEqual(CheckoutSession.objects.get(stripe_session_id=old).status, 'expired')
+        self.assertEqual(CheckoutSession.objects.filter(user=self.user, status='open').count(), 1)
+    
+    def test_failed_session_create_keeps_the_customer(self):
+        """Test that a retry after a failed session create reuses the customer made by the first attempt"""
+        create_session = StripeService.create_checkout_session
+        attempts = []
+        
+        def failing_once(*args, **kwargs):
+            attempts.append(args)
+            if len(attempts) == 1:
+                raise stripe.error.APIError('Injected failure')
+            return create_session(*args, **kwargs)
+        
+        with fake_stripe() as server, patch.object(StripeService, 'create_checkout_session', failing_once):
+            response = self.client.post(reverse('create-checkout'), {'plan_lookup_key': 'monthly-basic'})
+            self.assertNotEqual(response.status_code, 200)
+            self.assertTrue(StripeCustomer.objects.filter(user=self.user).exists())
+            
+            self.checkout()
+            self.assertEqual(len(server.customers), 1)
+            self.assertEqual(server.requests.count(('POST', '/v1/customers')), 1)
+    
+    def test_stripe_calls_hold_no_transaction(self):
+        """Test that no transaction is open while Stripe creates the customer or the session"""
+        # TestCase wraps the test in atomic blocks of its own
+        outside = len(connection.atomic_blocks)
+        in_atomic = []
+        create_customer = StripeService.create_customer
+        create_session = StripeService.create_checkout_session
+        
+        def checking(create):
+            def call(*args, **kwargs):
+                in_atomic.append(len(connection.atomic_blocks))
+                return create(*args, **kwargs)
+            return call
+        
+        with fake_stripe(), patch.object(StripeService, 'create_customer', checking(create_customer)), \
+                patch.object(StripeService, 'create_checkout_session', checking(create_session)):
+            self.checkout()
+        
+        self.assertEqual(in_atomic, [outside, outside])
+    
+    def test_double_click_keeps_the_session_registered_first(self):
+        """Test that a session registered during the Stripe call is handed out and the surplus one expired"""
+        create_session = StripeService.create_checkout_session
+        
+        def racing_create(*args, **kwargs):
+            CheckoutSession.objects.create(
+                user=self.user, plan=self.plan, stripe_session_id='cs_winner',
+                url='https://checkout.example/winner', expires_at=timezone.now() + timedelta(hours=23),
+            )
+            return create_session(*args, **kwargs)
+        
+        with fake_stripe() as server, patch.object(StripeService, 'create_checkout_session', racing_create):
+            self.assertEqual(self.checkout(), 'cs_winner')
+            surplus, = server.checkout_sessions.values()
+        
+        self.assertEqual(surplus['status'], 'expired')
+        self.assertEqual(CheckoutSession.objects.filter(status='open').count(), 1)
+    
+    def test_conflict_with_a_session_gone_meanwhile(self):
+        """Test that when the conflicting session is gone by the time it is looked up the new one is registered"""
+        register_session = CheckoutService.register_session
+        calls = []
+        
+        def racing_register(*args, **kwargs):
+            calls.append(args)
+            if len(calls) > 1:
+                return register_session(*args, **kwargs)
+            CheckoutSession.objects.create(
+                user=self.user, plan=self.plan, stripe_session_id='cs_other',
+                url='https://checkout.example/other', expires_at=timezone.now() + timedelta(hours=23),
+            )
+            try:
+                return register_session(*args, **kwargs)
+            finally:
+                # Completes before the conflicting session is looked up
+                CheckoutSession.objects.filter(stripe_session_id='cs_other').update(status='complete')
+        
+        with fake_stripe() as server, patch.object(CheckoutService, 'register_session', racing_register):
+            session_id = self.checkout()
+            registered, = server.checkout_sessions.values()
+        
+        self.assertEqual(session_id, registered['id'])
+        self.assertEqual(registered['status'], 'open')
+        self.assertEqual(CheckoutSession.objects.get(status='open').stripe_session_id, session_id)
+
+
+class PlanCatalogTest(TestCase):
+    def setUp(self):
+        self.basic = SubscriptionPlan.objects.create(
+            name='Basic Monthly',
+            plan_type='basic',
+            billing_period='monthly',
+            price=15.00,
+            stripe_price_id='price_test',
+            lookup_key='monthly-basic',
+        )
+        SubscriptionPlan.objects.create(
+            name='Pro Monthly',
+            plan_type='pro',
+            billing_period='monthly',
+            price=30.00,
+            stripe_price_id='price_pro',
+            lookup_key='monthly-pro',
+            is_active=False,
+        )
+    
+    def test_lookups_are_served_from_memory(self):
+        """Test that after one load no lookup queries the database"""
+        plan_catalog.active_plans()
+        with self.assertNumQueries(0):
+            self.assertEqual(plan_catalog.get_by_lookup_key('monthly-basic').id, self.basic.id)
+            self.assertEqual(plan_catalog.get_by_price_id('price_pro').lookup_key, 'monthly-pro')
+            self.assertEqual(plan_catalog.get(self.basic.id).name, 'Basic Monthly')
+            self.assertEqual([plan.lookup_key for plan in plan_catalog.active_plans()], ['monthly-basic'])
+            with self.assertRaises(SubscriptionPlan.DoesNotExist):
+                plan_catalog.get_by_lookup_key('monthly-pro')
+            self.assertEqual(plan_catalog.get_by_lookup_key('monthly-pro', active_only=False).name, 'Pro Monthly')
+            response = self.client.get('/api/subscriptions/plans/', HTTP_ACCEPT='application/json')
+            page = self.client.get(reverse('subscription-plans'))
+        self.assertEqual([plan['lookup_key'] for plan in response.json()['results']], ['monthly-basic'])
+        self.assertEqual([plan.lookup_key for plan in page.context['plans']], ['monthly-basic'])
+    
+    def test_lookups_return_copies(self):
+        """Test that changing a returned plan does not change the catalog"""
+        plan = plan_catalog.get_by_lookup_key('monthly-basic')
+        plan.name = 'Changed'
+        self.assertEqual(plan_catalog.get_by_lookup_key('monthly-basic').name, 'Basic Monthly')
+    
+    def test_saving_a_plan_reloads_the_catalog(self):
+        """Test that saved and deleted plans are visible to the next lookup"""
+        plan_catalog.get_by_lookup_key('monthly-basic')
+        self.basic.price = 20
+        self.basic.save()
+        self.assertEqual(plan_catalog.get_by_lookup_key('monthly-basic').price, 20)
+        
+        self.basic.delete()
+        with self.assertRaises(SubscriptionPlan.DoesNotExist):
+            plan_catalog.get_by_lookup_key('monthly-basic')
+    
+    def test_plans_added_elsewhere_are_found_by_id(self):
+        """Test that a plan missing from a stale catalog is loaded instead of failing saves and checks"""
+        plan_catalog.active_plans()
+        # Created by another process, so this process' catalog has not heard of it
+        SubscriptionPlan.objects.bulk_create([SubscriptionPlan(
+            name='Basic Yearly',
+            plan_type='basic',
+            billing_period='yearly',
+            price=150.00,
+            stripe_price_id='price_basic_yearly',
+            lookup_key='yearly-basic',
+        )])
+        yearly = SubscriptionPlan.objects.get(lookup_key='yearly-basic')
+        user = User.objects.create_user(username='yearlyuser', password='testpass123')
+        
+        UserSubscription.objects.create(user=user, plan=yearly, status='trial')
+        self.assertEqual(SubscriptionHistory.objects.get().description, 'Subscription created for Basic Yearly')
+        self.assertEqual(compute_entitlement(user.id)['plan'], 'yearly-basic')
+        with self.assertRaises(SubscriptionPlan.DoesNotExist):
+            plan_catalog.get(yearly.id + 1)
+    
+    def test_other_processes_reload_when_the_version_changes(self):
+        """Test that a catalog reloads once the shared version moves, and only then"""
+        catalog = PlanCatalog(check_interval=0)
+        with patch.object(catalog, '_remote_version', return_value=1):
+            catalog.get_by_lookup_key('monthly-basic')
+            # Written by another process, so this process' signals never fire
+            SubscriptionPlan.objects.filter(pk=self.basic.pk).update(price=25)
+            self.assertEqual(catalog.get_by_lookup_key('monthly-basic').price, 15)
+        with patch.object(catalog, '_remote_version', return_value=2):
+            self.assertEqual(catalog.get_by_lookup_key('monthly-basic').price, 25)
+    
+    def test_webhooks_find_the_plan_by_price(self):
+        """Test that subscriptions created without plan metadata are matched by their price"""
+        user = User.objects.create_user(username='testuser', password='testpass123')
+        dispatch_event('customer.subscription.created', {'object': {
+            'id': 'sub_price',
+            'customer': 'cus_price',
+            'status': 'trialing',
+            'metadata': {'user_id': str(user.id)},
+            'current_period_start': 1234567890,
+            'current_period_end': 1237159890,
+            'items': {'data': [{'id': 'si_price', 'price': {'id': 'price_test'}}]},
+        }})
+        self.assertEqual(UserSubscription.objects.get(user=user).plan, self.basic)
+
+
+class EntitlementTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        self.plan = SubscriptionPlan.objects.create(
+            name='Basic Monthly',
+            plan_type='basic',
+            billing_period='monthly',
+            price=15.00,
+            stripe_price_id='price_test',
+            lookup_key='monthly-basic',
+        )
+        self.subscription = UserSubscription.objects.create(
+            user=self.user,
+            plan=self.plan,
+            status='trial',
+            stripe_subscription_id='sub_test123',
+        )
+        plan_catalog.get(self.plan.id)
+        entitlement_cache.clear()
+        metrics.reset()
+    
+    def test_entitlement_follows_the_subscription(self):
+        """Test that trials and paid periods grant access until they end"""
+        entitlement = compute_entitlement(self.user.id)
+        self.assertTrue(entitlement['active'])
+        self.assertEqual(entitlement['plan'], 'monthly-basic')
+        self.assertEqual(entitlement['expires_at'], self.subscription.trial_end_date.isoformat())
+        
+        period_end = timezone.now() + timedelta(days=30)
+        UserSubscription.objects.filter(pk=self.subscription.pk).update(status='active', current_period_end=period_end)
+        self.assertEqual(compute_entitlement(self.user.id)['expires_at'], period_end.isoformat())
+        
+        UserSubscription.objects.filter(pk=self.subscription.pk).update(status='canceled')
+        self.assertEqual(compute_entitlement(self.user.id)['active'], False)
+        self.assertIsNone(compute_entitlement(self.user.id)['expires_at'])
+        other = User.objects.create_user(username='other', password='testpass123')
+        self.assertEqual(compute_entitlement(other.id)['status'], None)
+    
+    def test_checks_are_cached_until_the_subscription_changes(self):
+        """Test that repeated checks skip the database and relevant changes invalidate them"""
+        self.assertTrue(has_access(self.user.id))
+        with self.assertNumQueries(0):
+            for _ in range(10):
+                self.assertTrue(has_access(self.user.id))
+        
+        # Saves not touching status, plan or dates keep the cached entry
+        self.subscription.stripe_subscription_item_id = 'si_test'
+        self.subscription.save()
+        with self.assertNumQueries(0):
+            has_access(self.user.id)
+        
+        transition(self.subscription, 'canceled', 'canceled')
+        self.assertFalse(has_access(self.user.id))
+        counters = metrics.get_counters('entitlements.')
+        self.assertEqual(counters['entitlements.misses'], 2)
+        self.assertEqual(counters['entitlements.lru_hits'], 11)
+    
+    def test_cached_entitlement_expires_with_access(self):
+        """Test that an entry is never served after its expiry"""
+        UserSubscription.objects.filter(pk=self.subscription.pk).update(
+            trial_end_date=timezone.now() + timedelta(milliseconds=200)
+        )
+        self.assertTrue(has_access(self.user.id))
+        time.sleep(0.25)
+        self.assertFalse(has_access(self.user.id))
+    
+    def test_endpoint_requires_the_service_token(self):
+        """Test that other services get the entitlement with the shared token only"""
+        url = reverse('entitlement', args=[self.user.id])
+        self.assertEqual(self.client.get(url).status_code, 401)
+        with override_settings(ENTITLEMENT_API_TOKEN='service-secret'):
+            self.assertEqual(self.client.get(url, HTTP_AUTHORIZATION='Bearer wrong').status_code, 401)
+            response = self.client.get(url, HTTP_AUTHORIZATION='Bearer service-secret')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.json()['active'], True)
+            with self.assertNumQueries(0):
+                self.client.get(url, HTTP_AUTHORIZATION='Bearer service-secret')
+
+
+@override_settings(ENTITLEMENT_API_TOKEN='service-secret', ENTITLEMENT_BULK_MAX_IDS=5)
+class BulkEntitlementTest(TestCase):
+    def setUp(self):
+        plan = SubscriptionPlan.objects.create(
+            name='Basic Monthly',
+            plan_type='basic',
+            billing_period='monthly',
+            price=15.00,
+            stripe_price_id='price_test',
+            lookup_key='monthly-basic',
+        )
+        self.users = [User.objects.create_user(username=f'user{index}', password='testpass123') for index in range(3)]
+        UserSubscription.objects.create(user=self.users[0], plan=plan, status='trial')
+        UserSubscription.objects.create(user=self.users[1], plan=plan, status='canceled')
+        self.user_ids = [user.id for user in self.users]
+        self.url = reverse('bulk-entitlements')
+    
+    def post(self, data, content_type, token='service-secret'):
+        return self.client.post(self.url, data, content_type=content_type, HTTP_AUTHORIZATION=f'Bearer {token}')
+    
+    def read(self, response):
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        return [json.loads(line) for line in b''.join(response.streaming_content).splitlines()]
+    
+    def test_entitlements_are_resolved_per_chunk(self):
+        """Test that ids are answered in order with one joined query per chunk"""
+        with self.assertNumQueries(2):
+            entitlements = list(compute_entitlements(self.user_ids, chunk_size=2))
+        self.assertEqual([entitlement['user_id'] for entitlement in entitlements], self.user_ids)
+        self.assertEqual([entitlement['active'] for entitlement in entitlements], [True, False, False])
+        self.assertEqual([entitlement['plan'] for entitlement in entitlements], ['monthly-basic', 'monthly-basic', None])
+        self.assertEqual(entitlements[0], compute_entitlement(self.user_ids[0]))
+    
+    def test_json_and_line_delimited_requests_stream_results(self):
+        """Test that both input formats get one JSON line per id"""
+        response = self.post({'user_ids': self.user_ids}, 'application/json')
+        self.assertEqual([line['status'] for line in self.read(response)], ['trial', 'canceled', None])
+        
+        body = '\n'.join(str(user_id) for user_id in reversed(self.user_ids)) + '\n'
+        response = self.post(body, 'application/x-ndjson')
+        self.assertEqual([line['user_id'] for line in self.read(response)], list(reversed(self.user_ids)))
+    
+    async def test_asgi_requests_get_an_async_stream(self):
+        """Test that under ASGI the response streams from an async iterator instead of being buffered"""
+        response = await self.async_client.post(
+            self.url, {'user_ids': self.user_ids}, content_type='application/json',
+            headers={'Authorization': 'Bearer service-secret'},
+        )
+        self.assertTrue(response.is_async)
+        body = b''.join([chunk async for chunk in response.streaming_content])
+        self.assertEqual([json.loads(line)['user_id'] for line in body.splitlines()], self.user_ids)
+    
+    def test_invalid_requests_are_rejected(self):
+        """Test the service token, the id limit and id validation"""
+        self.assertEqual(self.post({'user_ids': self.user_ids}, 'application/json', token='wrong').status_code, 401)
+        self.assertEqual(self.post({'user_ids': list(range(6))}, 'application/json').status_code, 400)
+        self.assertEqual(self.post('\n'.join(['1'] * 6), 'application/x-ndjson').status_code, 400)
+        self.assertEqual(self.post({'user_ids': ['1']}, 'application/json').status_code, 400)
+        self.assertEqual(self.post('1\nabc\n', 'application/x-ndjson').status_code, 400)
+
+
+class AsyncViewsTest(TestCase):
+    def setUp(self):
+        self.plan = SubscriptionPlan.objects.create(
+            name='Basic Monthly',
+            plan_type='basic',
+            billing_period='monthly',
+            price=15.00,
+            stripe_price_id='price_test',
+            lookup_key='monthly-basic',
+        )
+        self.pro_plan = SubscriptionPlan.objects.create(
+            name='Pro Monthly',
+            plan_type='pro',
+            billing_period='monthly',
+            price=30.00,
+            stripe_price_id='price_pro',
+            lookup_key='monthly-pro',
+        )
+        self.users = [
+            User.objects.create_user(username=f'user{i}', email=f'user{i}@example.com', password='testpass123')
+            for i in range(5)
+        ]
+        self.factory = AsyncRequestFactory()
+    
+    def post(self, view, user, data):
+        request = self.factory.post('/', data, content_type='application/json')
+        request.user = user
+        request._dont_enforce_csrf_checks = True
+        return view(request)
+    
+    async def test_async_create_and_change_plan(self):
+        """Test the async views create a trial and change its plan"""
+        with fake_stripe() as server:
+            response = await self.post(async_views.create_subscription, self.users[0], {'plan_lookup_key': 'monthly-basic'})
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(json.loads(response.content)['status'], 'trial')
+            
+            del server.requests[:]
+            response = await self.post(async_views.change_plan, self.users[0], {'new_plan_lookup_key': 'monthly-pro'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.content)['plan']['lookup_key'], 'monthly-pro')
+            self.assertEqual(len(server.requests), 1)
+    
+    async def test_async_views_overlap_stripe_calls(self):
+        """Test that one event loop keeps several Stripe-bound requests in flight"""
+        with fake_stripe() as server:
+            for user in self.users:
+                response = await self.post(async_views.create_subscription, user, {'plan_lookup_key': 'monthly-basic'})
+                self.assertEqual(response.status_code, 201)
+            
+            server.latency_ms = 300
+            started = time.perf_counter()
+            responses = await asyncio.gather(*(
+                self.post(async_views.change_plan, user, {'new_plan_lookup_key': 'monthly-pro'})
+                for user in self.users
+            ))
+            elapsed = time.perf_counter() - started
+        
+        self.assertEqual([response.status_code for response in responses], [200] * 5)
+        # Serially the five modify calls alone would take 1.5s
+        self.assertLess(elapsed, 1.2)
+    
+    async def test_async_checkout_reuses_open_session(self):
+        """Test that the async checkout view hands out the registered open session"""
+        with fake_stripe() as server:
+            first = await self.post(async_views.create_checkout_session, self.users[0], {'plan_lookup_key': 'monthly-basic'})
+            second = await self.post(async_views.create_checkout_session, self.users[0], {'plan_lookup_key': 'monthly-basic'})
+            self.assertEqual(server.requests.count(('POST', '/v1/checkout/sessions')), 1)
+        
+        self.assertEqual(json.loads(first.content)['session_id'], json.loads(second.content)['session_id'])
+    
+    async def test_async_customer_race_returns_the_stored_customer(self):
+        """Test that losing the race to store the customer mapping returns the stored customer"""
+        user = self.users[0]
+        create_customer = AsyncStripeService.create_customer
+        
+        async def racing_create(*args, **kwargs):
+            await StripeCustomer.objects.acreate(user=user, stripe_customer_id='cus_winner')
+            return await create_customer(*args, **kwargs)
+        
+        with fake_stripe(), patch.object(AsyncStripeService, 'create_customer', racing_create):
+            self.assertEqual(await AsyncCustomerService.get_or_create_customer_id(user), 'cus_winner')
+    
+    async def test_async_checkout_keeps_a_session_registered_meanwhile(self):
+        """Test that a session registered during the Stripe call is kept and the surplus one expired"""
+        user = self.users[0]
+        create_session = AsyncStripeService.create_checkout_session
+        
+        async def racing_create(*args, **kwargs):
+            await CheckoutSession.objects.acreate(
+                user=user, plan=self.plan, stripe_session_id='cs_winner',
+                url='https://checkout.example/winner', expires_at=timezone.now() + timedelta(hours=23),
+            )
+            return await create_session(*args, **kwargs)
+        
+        with fake_stripe() as server, patch.object(AsyncStripeService, 'create_checkout_session', racing_create):
+            response = await self.post(async_views.create_checkout_session, user, {'plan_lookup_key': 'monthly-basic'})
+            surplus, = server.checkout_sessions.values()
+        
+        self.assertEqual(json.loads(response.content)['session_id'], 'cs_winner')
+        self.assertEqual(surplus['status'], 'expired')
+        self.assertEqual(await CheckoutSession.objects.filter(status='open').acount(), 1)
+
+
+class SubscriptionChangeTrackingTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        self.plan = SubscriptionPlan.objects.create(
+            name='Basic Monthly',
+            plan_type='basic',
+            billing_period='monthly',
+            price=15.00,
+            stripe_price_id='price_test',
+            lookup_key='monthly-basic',
+        )
+        plan_catalog.get(self.plan.id)
+    
+    def create_subscription(self):
+        UserSubscription.objects.create(user=self.user, plan=self.plan, status='trial')
+        return UserSubscription.objects.get(user=self.user)
+    
+    def test_create_needs_no_extra_queries(self):
+        """Test that creating a subscription is its insert plus its history entry"""
+        with self.assertNumQueries(2):
+            UserSubscription.objects.create(user=self.user, plan_id=self.plan.id, status='trial')
+        self.assertEqual(SubscriptionHistory.objects.get().description, 'Subscription created for Basic Monthly')
+    
+    def test_save_writes_only_changed_fields(self):
+        """Test that a save is one UPDATE of the changed columns, and no query when nothing changed"""
+        subscription = self.create_subscription()
+        self.assertEqual(subscription.changed_fields(), [])
+        subscription.current_period_end = timezone.now() + timedelta(days=30)
+        self.assertEqual(subscription.changed_fields(), ['current_period_end'])
+        
+        with CaptureQueriesContext(connection) as queries:
+            subscription.save()
+        self.assertEqual(len(queries), 1)
+        sql = queries[0]['sql']
+        self.assertIn('"current_period_end"', sql)
+        self.assertIn('"updated_at"', sql)
+        self.assertNotIn('"status"', sql)
+        self.assertNotIn('"plan_id"', sql)
+        
+        self.assertEqual(subscription.changed_fields(), [])
+        with self.assertNumQueries(0):
+            subscription.save()
+    
+    def test_status_change_is_logged_from_the_loaded_value(self):
+        """Test that the history signal learns the old status without reading the row"""
+        subscription = self.create_subscription()
+        SubscriptionHistory.objects.all().delete()
+        subscription.status = 'active'
+        with self.assertNumQueries(2):
+            subscription.save()
+        entry = SubscriptionHistory.objects.get()
+        self.assertEqual(entry.event_type, 'status_changed')
+        self.assertEqual(entry.metadata, {'old_status': 'trial', 'new_status': 'active'})
+        
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.changed_fields(), [])
+
+
+class SubscriptionStateMachineTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        self.plan = SubscriptionPlan.objects.create(
+            name='Basic Monthly',
+            plan_type='basic',
+            billing_period='monthly',
+            price=15.00,
+            stripe_price_id='price_test',
+            lookup_key='monthly-basic',
+        )
+        self.subscription = UserSubscription.objects.create(
+            user=self.user,
+            plan=self.plan,
+            status='trial',
+            stripe_subscription_id='sub_test123',
+        )
+        SubscriptionHistory.objects.all().delete()
+        metrics.reset()
+    
+    def test_transition_is_one_conditional_update(self):
+        """Test that a transition writes status with one UPDATE and its history row, without reading the row"""
+        with CaptureQueriesContext(connection) as queries:
+            self.assertTrue(transition(self.subscription, 'active', 'activated', 'Paid'))
+        statements = [query['sql'] for query in queries.captured_queries]
+        self.assertEqual(len([sql for sql in statements if sql.startswith('UPDATE')]), 1)
+        self.assertFalse([sql for sql in statements if sql.startswith('SELECT')])
+        self.assertEqual(self.subscription.status, 'active')
+        self.assertEqual(UserSubscription.objects.get().status, 'active')
+        self.assertEqual(list(SubscriptionHistory.objects.values_list('event_type', flat=True)), ['activated'])
+    
+    def test_noop_and_disallowed_transitions_write_nothing(self):
+        """Test that repeating the current status is free and leaving canceled is refused"""
+        with self.assertNumQueries(0):
+            self.assertFalse(transition(self.subscription, 'trial', 'created'))
+        
+        self.assertTrue(transition(self.subscription, 'canceled', 'canceled', canceled_at=timezone.now()))
+        self.assertIsNotNone(UserSubscription.objects.get().canceled_at)
+        self.assertFalse(can_transition('canceled', 'active'))
+        self.assertFalse(transition(self.subscription, 'active', 'activated'))
+        self.assertEqual(UserSubscription.objects.get().status, 'canceled')
+        self.assertEqual(SubscriptionHistory.objects.count(), 1)
+    
+    def test_concurrent_transitions_do_not_overwrite_each_other(self):
+        """Test that of two writers holding the same stale status only the first wins"""
+        first = UserSubscription.objects.get()
+        second = UserSubscription.objects.get()
+        self.assertTrue(transition(first, 'canceled', 'canceled'))
+        self.assertFalse(transition(second, 'active', 'activated'))
+        self.assertEqual(second.status, 'canceled')
+        self.assertEqual(UserSubscription.objects.get().status, 'canceled')
+        self.assertEqual(metrics.get_counters('subscription_transitions.')['subscription_transitions.rejected'], 1)
+    
+    def test_webhooks_cannot_revive_canceled_subscriptions(self):
+        """Test that a late payment failure leaves a canceled subscription canceled but is still recorded"""
+        dispatch_event('customer.subscription.deleted', {'object': {'id': 'sub_test123', 'customer': 'cus_test', 'status': 'canceled'}})
+        dispatch_event('invoice.payment_failed', {'object': {'id': 'in_late', 'subscription': 'sub_test123', 'customer': 'cus_test'}})
+        self.assertEqual(UserSubscription.objects.get().status, 'canceled')
+        self.assertEqual(
+            sorted(SubscriptionHistory.objects.values_list('event_type', flat=True)), ['canceled', 'payment_failed']
+        )
+    
+    def test_resubscribing_after_cancel_reopens_the_subscription(self):
+        """Test that a new Stripe subscription for a canceled user makes their subscription active again"""
+        dispatch_event('customer.subscription.deleted', {'object': {'id': 'sub_test123', 'customer': 'cus_test', 'status': 'canceled'}})
+        self.assertEqual(UserSubscription.objects.get().status, 'canceled')
+        
+        new_subscription = {
+            'id': 'sub_new',
+            'customer': 'cus_test',
+            'status': 'active',
+            'metadata': {'user_id': str(self.user.id)},
+            'current_period_start': 1700000000,
+            'current_period_end': 1702592000,
+            'items': {'data': [{'id': 'si_new', 'price': {'id': 'price_test'}}]},
+        }
+        dispatch_event('customer.subscription.created', {'object': new_subscription})
+        dispatch_event('customer.subscription.updated', {'object': new_subscription})
+        # A repeated delivery of the created event does not restart it again
+        dispatch_event('customer.subscription.created', {'object': new_subscription})
+        
+        subscription = UserSubscription.objects.get()
+        self.assertEqual(subscription.status, 'active')
+        self.assertEqual(subscription.stripe_subscription_id, 'sub_new')
+        self.assertIsNone(subscription.canceled_at)
+        self.assertEqual(
+            list(SubscriptionHistory.objects.order_by('id').values_list('event_type', flat=True)),
+            ['canceled', 'created', 'created'],
+        )
+    
+    def test_burst_collapses_to_one_transition(self):
+        """Test that a burst of status changes is written as one UPDATE and one history INSERT"""
+        for number, event_type in enumerate(
+                ['invoice.payment_succeeded', 'invoice.payment_failed', 'invoice.payment_succeeded'], 1):
+            StripeWebhookEvent.objects.create(
+                stripe_event_id=f'evt_{number}',
+                event_type=event_type,
+                data={'object': {'id': f'in_{number}', 'subscription': 'sub_test123'}},
+                stripe_subscription_id='sub_test123',
+            )
+        webhook_events = claim_webhook_events('worker-1')
+        
+        with CaptureQueriesContext(connection) as queries:
+            processed, errors = process_webhook_batch(webhook_events)
+        statements = [query['sql'] for query in queries.captured_queries]
+        
+        self.assertEqual((len(processed), errors), (3, 0))
+        self.assertEqual(len([sql for sql in statements if sql.startswith('UPDATE "subscriptions_usersubscription"')]), 1)
+        self.assertEqual(
+            len([sql for sql in statements if sql.startswith('INSERT INTO "subscriptions_subscriptionhistory"')]), 1
+        )
+        self.assertEqual(UserSubscription.objects.get().status, 'active')
+        self.assertEqual(
+            list(SubscriptionHistory.objects.order_by('id').values_list('event_type', flat=True)),
+            ['activated', 'renewed', 'payment_failed', 'activated', 'renewed'],
+        )
+    
+    def test_batched_transition_loses_to_a_concurrent_change(self):
+        """Test that a status changed since the batch loaded it wins and the batch's status history is dropped"""
+        batch = SubscriptionChangeBatch()
+        dispatch_event('invoice.payment_succeeded', {'object': {'id': 'in_1', 'subscription': 'sub_test123'}}, batch=batch)
+        self.assertEqual(batch.get('sub_test123').status, 'active')
+        
+        UserSubscription.objects.filter(stripe_subscription_id='sub_test123').update(status='canceled')
+        batch.flush()
+        
+        self.assertEqual(UserSubscription.objects.get().status, 'canceled')
+        self.assertEqual(list(SubscriptionHistory.objects.values_list('event_type', flat=True)), ['renewed'])
+    
+    def test_trial_expiry_skips_subscriptions_activated_meanwhile(self):
+        """Test that an expired trial activated after it was loaded is not canceled"""
+        command = process_trial_expirations.Command()
+        stale = UserSubscription.objects.get()
+        UserSubscription.objects.filter(pk=stale.pk).update(status='active')
+        self.assertFalse(command.end_trial(stale))
+        self.assertEqual(UserSubscription.objects.get().status, 'active')
+        
+        UserSubscription.objects.filter(pk=stale.pk).update(status='trial')
+        stale.status = 'trial'
+        self.assertTrue(command.end_trial(stale))
+        self.assertEqual(UserSubscription.objects.get().status, 'canceled')
+
 
 class SubscriptionHistoryModelTest(TestCase):
     def setUp(self):
@@ -195,4 +1555,343 @@ class SubscriptionHistoryModelTest(TestCase):
         self.assertEqual(history.subscription, self.subscription)
         self.assertEqual(history.event_type, 'created')
         self.assertEqual(history.description, 'Test event')
-        self.assertEqual(history.metadata, {'test': 'data'})
\ No newline at end of file
+        self.assertEqual(history.metadata, {'test': 'data'})
+
+    
+    def test_prune_event_log_archives_old_history(self):
+        """Test that history past the retention window is archived by month and deleted"""
+        old = SubscriptionHistory.objects.create(
+            subscription=self.subscription,
+            event_type='renewed',
+            description='Old event',
+        )
+        SubscriptionHistory.objects.filter(pk=old.pk).update(created_at=timezone.now() - timedelta(days=400))
+        
+        with tempfile.TemporaryDirectory() as archive_dir:
+            call_command(
+                'prune_event_log', '--table', 'subscription_history', '--days', '365',
+                '--archive-dir', archive_dir, stdout=StringIO()
+            )
+            
+            month = (timezone.now() - timedelta(days=400)).strftime('%Y-%m')
+            with gzip.open(f'{archive_dir}/subscription_history-{month}.jsonl.gz', 'rt') as archive:
+                records = [json.loads(line) for line in archive]
+        
+        self.assertEqual([record['id'] for record in records], [old.pk])
+        self.assertFalse(SubscriptionHistory.objects.filter(pk=old.pk).exists())
+        # Recent history is kept
+        self.assertTrue(SubscriptionHistory.objects.filter(subscription=self.subscription).exists())
+
+class WebhookIngestionTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(
+            username='testuser',
+            email='test@example.com',
+            password='testpass123'
+        )
+        self.plan = SubscriptionPlan.objects.create(
+            name='Basic Monthly',
+            plan_type='basic',
+            billing_period='monthly',
+            price=15.00,
+            stripe_price_id='price_test',
+            lookup_key='monthly-basic',
+        )
+        self.subscription = UserSubscription.objects.create(
+            user=self.user,
+            plan=self.plan,
+            status='active',
+            stripe_subscription_id='sub_test123',
+        )
+        webhook_deduplicator.clear()
+        metrics.reset()
+        self.event = {
+            'id': 'evt_test123',
+            'type': 'invoice.payment_failed',
+            'created': 1234567890,
+            'data': {'object': {'id': 'in_test123', 'subscription': 'sub_test123'}},
+        }
+    
+    def post_event(self):
+        with patch('subscriptions.views.stripe.Webhook.construct_event', return_value=self.event):
+            return self.client.post(
+                reverse('stripe-webhook'),
+                data='{}',
+                content_type='application/json',
+                HTTP_STRIPE_SIGNATURE='t=1,v1=test',
+            )
+    
+    @override_settings(STRIPE_WEBHOOK_ASYNC=True)
+    def test_async_ingestion_defers_processing(self):
+        """Test that async mode only stores the event and the worker applies it"""
+        response = self.post_event()
+        self.assertEqual(response.json(), {'status': 'queued'})
+        
+        webhook_event = StripeWebhookEvent.objects.get(stripe_event_id='evt_test123')
+        self.assertFalse(webhook_event.processed)
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.subscription.status, 'active')
+        
+        call_command('process_webhook_events', '--once', '--coalesce-window', '0', stdout=StringIO())
+        
+        webhook_event.refresh_from_db()
+        self.assertTrue(webhook_event.processed)
+        self.assertIsNotNone(webhook_event.processed_at)
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.subscription.status, 'past_due')
+    
+    def test_sync_ingestion_processes_inline(self):
+        """Test that the default mode still processes the event in the request"""
+        response = self.post_event()
+        self.assertEqual(response.json(), {'status': 'success'})
+        self.assertTrue(StripeWebhookEvent.objects.get(stripe_event_id='evt_test123').processed)
+        
+        # Retried deliveries are acknowledged without reprocessing
+        response = self.post_event()
+        self.assertEqual(response.json(), {'status': 'already_processed'})
+    
+    @override_settings(STRIPE_WEBHOOK_ASYNC=True)
+    def test_webhook_invalidates_cached_subscription(self):
+        """Test that an incoming event drops its subscription from the Stripe cache"""
+        subscription_cache.set({'id': 'sub_test123', 'object': 'subscription', 'status': 'active'})
+        self.assertIsNotNone(subscription_cache.get('sub_test123'))
+        
+        self.post_event()
+        self.assertIsNone(subscription_cache.get('sub_test123'))
+    
+    @override_settings(STRIPE_WEBHOOK_ASYNC=True, WEBHOOK_PAYLOAD_STORAGE='compressed')
+    def test_compressed_payload_storage(self):
+        """Test that compressed payloads are trimmed, stored as bytes and read back transparently"""
+        self.event['data']['object']['lines'] = {'data': [{'id': 'il_1'}] * 50}
+        self.post_event()
+        
+        webhook_event = StripeWebhookEvent.objects.get(stripe_event_id='evt_test123')
+        self.assertEqual(webhook_event.data, {})
+        self.assertEqual(webhook_event.data_encoding, 'zlib')
+        self.assertEqual(
+            webhook_event.payload,
+            {'object': {'id': 'in_test123', 'subscription': 'sub_test123'}}
+        )
+        
+        call_command('process_webhook_events', '--once', '--coalesce-window', '0', stdout=StringIO())
+        self.subscription.refresh_from_db()
+        self.assertEqual(self.subscription.status, 'past_due')
+    
+    @override_settings(WEBHOOK_PAYLOAD_STORAGE='trimmed')
+    def test_unhandled_event_keeps_no_payload(self):
+        """Test that events without a handler only record id, type and creation time"""
+        self.event['type'] = 'customer.updated'
+        self.post_event()
+        
+        webhook_event = StripeWebhookEvent.objects.get(stripe_event_id='evt_test123')
+        self.assertEqual(webhook_event.event_type, 'customer.updated')
+        self.assertEqual(webhook_event.payload, {})
+        self.assertIsNotNone(webhook_event.stripe_created)
+    
+    def test_duplicate_delivery_skips_database(self):
+        """Test that a retried delivery is answered from the dedup cache"""
+        self.post_event()
+        
+        with self.assertNumQueries(0):
+            response = self.post_event()
+        self.assertEqual(response.json(), {'status': 'already_processed'})
+        self.assertEqual(metrics.get_counters('webhook_dedup.')['webhook_dedup.lru_hits'], 1)
+        
+        # Another worker without the id cached falls through to ON CONFLICT DO NOTHING
+        webhook_deduplicator.clear()
+        response = self.post_event()
+        self.assertEqual(response.json(), {'status': 'already_processed'})
+        self.assertEqual(metrics.get_counters('webhook_dedup.')['webhook_dedup.db_conflicts'], 1)
+        self.assertEqual(StripeWebhookEvent.objects.count(), 1)
+
+    
+    def test_benchmark_webhooks_reports_results(self):
+        """Test that the benchmark signs events the view accepts and writes a result"""
+        # Every generated event finds the fixture's plan
+        with tempfile.NamedTemporaryFile(suffix='.json') as output, \
+                self.assertNoLogs('subscriptions.webhooks', level='WARNING'):
+            call_command(
+                'benchmark_webhooks', events=20, subscriptions=3, force=True,
+                output=output.name, stdout=StringIO(),
+            )
+            result = json.load(open(output.name))
+        
+        self.assertEqual(result['events'], 20)
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['stripe_calls_per_event'], 0)
+        self.assertGreater(result['db_queries_per_event'], 0)
+        self.assertFalse(User.objects.filter(username__startswith='bench-user-').exists())
+        
+        # Tests run with DEBUG off, where the fixtures need an explicit --force
+        with self.assertRaises(CommandError):
+            call_command('benchmark_webhooks', events=1, subscriptions=1, stdout=StringIO())
+
+class WebhookClaimTest(TestCase):
+    def create_event(self, event_id, subscription_id, **kwargs):
+        kwargs.setdefault('data', {'object': {'id': subscription_id}})
+        return StripeWebhookEvent.objects.create(
+            stripe_event_id=event_id,
+            event_type='customer.subscription.updated',
+            stripe_subscription_id=subscription_id,
+            **kwargs
+        )
+    
+    def test_claim_keeps_subscription_order(self):
+        """Test that events wait while an earlier event for the subscription is leased"""
+        self.create_event('evt_1', 'sub_a', locked_by='other', locked_until=timezone.now() + timedelta(minutes=1))
+        self.create_event('evt_2', 'sub_a')
+        self.create_event('evt_3', 'sub_b')
+        
+        claimed = claim_webhook_events('worker-1')
+        self.assertEqual([event.stripe_event_id for event in claimed], ['evt_3'])
+        self.assertEqual(claimed[0].locked_by, 'worker-1')
+    
+    def test_claim_waits_for_events_locked_by_another_worker(self):
+        """Test that a later event is not claimed while an earlier one is locked by an uncommitted claim"""
+        first = self.create_event('evt_1', 'sub_a')
+        second = self.create_event('evt_2', 'sub_a')
+        third = self.create_event('evt_3', 'sub_b')
+        
+        # SKIP LOCKED hid evt_1, whose lease the other worker has not committed yet
+        locked = [(second.id, 'sub_a'), (third.id, 'sub_b')]
+        self.assertEqual(_in_order_prefixes(locked, max_attempts=5), [third.id])
+        
+        locked = [(first.id, 'sub_a'), (second.id, 'sub_a'), (third.id, 'sub_b')]
+        self.assertEqual(_in_order_prefixes(locked, max_attempts=5), [first.id, second.id, third.id])
+    
+    def test_claim_retries_expired_lease(self):
+        """Test that a crashed worker's expired lease is claimed again"""
+        self.create_event('evt_1', 'sub_a', locked_by='crashed', locked_until=timezone.now() - timedelta(seconds=1))
+        self.create_event('evt_2', 'sub_a')
+        
+        claimed = claim_webhook_events('worker-1')
+        self.assertEqual([event.stripe_event_id for event in claimed], ['evt_1', 'evt_2'])
+    
+    def test_pool_threads_keep_the_stripe_caller(self):
+        """Test that partitions processed on pool threads attribute Stripe calls to the caller"""
+        webhook_events = [self.create_event('evt_1', 'sub_a'), self.create_event('evt_2', 'sub_b')]
+        callers = []
+        
+        def record_caller(partition):
+            callers.append(instrumentation.current_caller())
+            return partition, 0
+        
+        with patch('subscriptions.webhooks._process_partition', side_effect=record_caller), \
+                instrumentation.stripe_caller('command:process_webhook_events'):
+            process_webhook_batch(webhook_events, threads=2)
+        self.assertEqual(callers, ['command:process_webhook_events'] * 2)
+    
+    def test_claim_holds_bursts_within_coalesce_window(self):
+        """Test that a subscription receiving events is held back until the burst ends"""
+        self.create_event('evt_1', 'sub_a')
+        StripeWebhookEvent.objects.filter(stripe_event_id='evt_1').update(
+            created_at=timezone.now() - timedelta(seconds=10)
+        )
+        self.create_event('evt_2', 'sub_a')
+        
+        self.assertEqual(claim_webhook_events('worker-1', coalesce_window=1, coalesce_max_delay=30), [])
+        
+        # The oldest event is released once it has waited longer than the cap
+        claimed = claim_webhook_events('worker-1', coalesce_window=1, coalesce_max_delay=5)
+        self.assertEqual([event.stripe_event_id for event in claimed], ['evt_1'])
+    
+    def test_burst_is_applied_as_one_transition(self):
+        """Test that coalesced events save the subscription once and batch history rows"""
+        user = User.objects.create_user(username='burstuser', password='testpass123')
+        plan = SubscriptionPlan.objects.create(
+            name='Basic Monthly',
+            plan_type='basic',
+            billing_period='monthly',
+            price=15.00,
+            stripe_price_id='price_test',
+            lookup_key='monthly-basic',
+        )
+        subscription = UserSubscription.objects.create(
+            user=user,
+            plan=plan,
+            status='trial',
+            stripe_subscription_id='sub_a',
+        )
+        payload = {
+            'id': 'sub_a',
+            'status': 'active',
+            'current_period_start': 1700000000,
+            'current_period_end': 1700000000 + 30*24*60*60,
+        }
+        self.create_event('evt_1', 'sub_a', data={'object': payload})
+        StripeWebhookEvent.objects.create(
+            stripe_event_id='evt_2',
+            event_type='invoice.payment_succeeded',
+            data={'object': {'id': 'in_1', 'subscription': 'sub_a'}},
+            stripe_subscription_id='sub_a',
+        )
+        
+        with patch('subscriptions.models.UserSubscription.save', autospec=True,
+                   side_effect=UserSubscription.save) as mock_save:
+            processed, errors = process_webhook_batch(claim_webhook_events('worker-1'))
+        
+        self.assertEqual((len(processed), errors), (2, 0))
+        self.assertEqual(mock_save.call_count, 1)
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.status, 'active')
+        self.assertTrue(subscription.history.filter(event_type='renewed').exists())
+        self.assertFalse(StripeWebhookEvent.objects.filter(processed=False).exists())
+    
+    def test_replay_dispatches_failed_events_once(self):
+        """Test that replay processes failed events and is safe to run repeatedly"""
+        user = User.objects.create_user(username='replayuser', password='testpass123')
+        plan = SubscriptionPlan.objects.create(
+            name='Basic Monthly',
+            plan_type='basic',
+            billing_period='monthly',
+            price=15.00,
+            stripe_price_id='price_test',
+            lookup_key='monthly-basic',
+        )
+        subscription = UserSubscription.objects.create(
+            user=user,
+            plan=plan,
+            status='active',
+            stripe_subscription_id='sub_a',
+        )
+        webhook_event = StripeWebhookEvent.objects.create(
+            stripe_event_id='evt_1',
+            event_type='invoice.payment_failed',
+            data={'object': {'id': 'in_1', 'subscription': 'sub_a'}},
+            stripe_subscription_id='sub_a',
+            attempts=5,
+            last_error='database unavailable',
+        )
+        
+        out = StringIO()
+        call_command('replay_webhook_events', '--workers', '1', '--failed-only', stdout=out)
+        self.assertIn('Processed: 1', out.getvalue())
+        
+        webhook_event.refresh_from_db()
+        self.assertTrue(webhook_event.processed)
+        subscription.refresh_from_db()
+        self.assertEqual(subscription.status, 'past_due')
+        self.assertEqual(SubscriptionHistory.objects.filter(event_type='payment_failed').count(), 1)
+        
+        out = StringIO()
+        call_command('replay_webhook_events', '--workers', '1', stdout=out)
+        self.assertIn('Found 0 events', out.getvalue())
+        self.assertEqual(SubscriptionHistory.objects.filter(event_type='payment_failed').count(), 1)
+    
+    def test_replay_threads_survive_errors_outside_dispatch(self):
+        """Test that an error while leasing is counted against the event and the replay finishes"""
+        for i in range(6):
+            StripeWebhookEvent.objects.create(
+                stripe_event_id=f'evt_{i}',
+                event_type='invoice.payment_failed',
+                data={'object': {'id': f'in_{i}', 'subscription': f'sub_{i}'}},
+                stripe_subscription_id=f'sub_{i}',
+            )
+        
+        out = StringIO()
+        with patch(
+            'subscriptions.management.commands.replay_webhook_events.lease_webhook_event',
+            side_effect=RuntimeError('connection lost'),
+        ):
+            call_command('replay_webhook_events', '--workers', '2', '--chunk-size', '1', stdout=out)
+        self.assertIn('Processed: 0, Skipped: 0, Errors: 6', out.getvalue())
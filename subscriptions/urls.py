@@ -1,5 +1,9 @@
+from django.conf import settings
 from django.urls import path
-from . import views
+from . import async_views, views
+
+# Stripe-bound endpoints are served by the native async views under ASGI
+stripe_views = async_views if settings.SUBSCRIPTIONS_ASYNC_VIEWS else views
 
 urlpatterns = [
     # Subscription plans
@@ -8,16 +12,23 @@ urlpatterns = [
     # User subscription management
     path('my-subscription/', views.UserSubscriptionView.as_view(), name='my-subscription'),
     path('history/', views.SubscriptionHistoryView.as_view(), name='subscription-history'),
-    path('create/', views.create_subscription, name='create-subscription'),
-    path('cancel/', views.cancel_subscription, name='cancel-subscription'),
-    path('change-plan/', views.change_plan, name='change-plan'),
+    path('create/', stripe_views.create_subscription, name='create-subscription'),
+    path('cancel/', stripe_views.cancel_subscription, name='cancel-subscription'),
+    path('change-plan/', stripe_views.change_plan, name='change-plan'),
     
     # User profile
     path('profile/', views.user_profile, name='user-profile'),
     
     # Stripe checkout
-    path('checkout/', views.create_checkout_session, name='create-checkout'),
+    path('checkout/', stripe_views.create_checkout_session, name='create-checkout'),
     
     # Webhooks
-    path('webhook/', views.stripe_webhook, name='stripe-webhook'),
+    path('webhook/', stripe_views.stripe_webhook, name='stripe-webhook'),
+    
+    # Entitlement checks for other services
+    path('entitlements/<int:user_id>/', views.entitlement_view, name='entitlement'),
+    path('entitlements/bulk/', views.bulk_entitlements_view, name='bulk-entitlements'),
+    
+    # Internal metrics
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
\ No newline at end of file
@@ -1,12 +1,15 @@
 from rest_framework import generics, status
 from rest_framework.decorators import api_view, permission_classes
-from rest_framework.permissions import IsAuthenticated
+from rest_framework.permissions import IsAuthenticated, IsAdminUser
 from rest_framework.response import Response
+from asgiref.sync import sync_to_async
 from django.contrib.auth.models import User
-from django.http import JsonResponse
+from django.core.handlers.asgi import ASGIRequest
+from django.http import JsonResponse, StreamingHttpResponse
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_POST
+from django.views.decorators.http import require_GET, require_POST
 from django.utils.decorators import method_decorator
+import hmac
 import json
 import stripe
 import logging
@@ -19,7 +22,16 @@ from .serializers import (
     SubscriptionHistorySerializer, CreateSubscriptionSerializer,
     ChangePlanSerializer, UserSerializer
 )
-from .services import SubscriptionService, StripeService
+from .services import CheckoutService, SubscriptionService
+from .entitlements import compute_entitlement_chunks, get_entitlement
+from .instrumentation import stripe_call_stats
+from .plan_catalog import plan_catalog
+from .provisioning import provisioning_status
+from .resilience import StripeUnavailable, stripe_status, unavailable_response
+from .dedup import webhook_deduplicator
+from .stripe_cache import subscription_cache
+from . import metrics
+from .webhooks import build_webhook_event, process_webhook_event
 
 # Initialize logger
 logger = logging.getLogger(__name__)
@@ -27,9 +39,11 @@ logger = logging.getLogger(__name__)
 
 class SubscriptionPlanListView(generics.ListAPIView):
     """View to list all active subscription plans"""
-    queryset = SubscriptionPlan.objects.filter(is_active=True)
     serializer_class = SubscriptionPlanSerializer
     permission_classes = []
+    
+    def get_queryset(self):
+        return plan_catalog.active_plans()
 
 
 class UserSubscriptionView(generics.RetrieveAPIView):
@@ -92,6 +106,8 @@ def create_subscription(request):
             response_serializer = UserSubscriptionSerializer(subscription)
             return Response(response_serializer.data, status=status.HTTP_201_CREATED)
             
+        except StripeUnavailable as e:
+            return unavailable_response(e)
         except Exception as e:
             return Response(
                 {'error': str(e)}, 
@@ -117,6 +133,8 @@ def cancel_subscription(request):
             {'error': 'No subscription found'}, 
             status=status.HTTP_404_NOT_FOUND
         )
+    except StripeUnavailable as e:
+        return unavailable_response(e)
     except Exception as e:
         return Response(
             {'error': str(e)}, 
@@ -146,6 +164,8 @@ def change_plan(request):
                 {'error': 'No subscription found'}, 
                 status=status.HTTP_404_NOT_FOUND
             )
+        except StripeUnavailable as e:
+            return unavailable_response(e)
         except Exception as e:
             return Response(
                 {'error': str(e)}, 
@@ -171,40 +191,19 @@ def create_checkout_session(request):
     
     if serializer.is_valid():
         try:
-            plan = SubscriptionPlan.objects.get(
-                lookup_key=serializer.validated_data['plan_lookup_key'],
-                is_active=True
-            )
+            plan = plan_catalog.get_by_lookup_key(serializer.validated_data['plan_lookup_key'])
             
-            # Get or create Stripe customer
-            customer_id = None
-            if hasattr(request.user, 'subscription') and request.user.subscription.stripe_customer_id:
-                customer_id = request.user.subscription.stripe_customer_id
-            else:
-                customer = StripeService.create_customer(request.user)
-                customer_id = customer.id
-            
-            # Create checkout session
-            checkout_session = stripe.checkout.Session.create(
-                customer=customer_id,
-                payment_method_types=['card'],
-                line_items=[{
-                    'price': plan.stripe_price_id,
-                    'quantity': 1,
-                }],
-                mode='subscription',
+            # Reuse the user's open session for this plan, creating one if needed
+            checkout_session = CheckoutService.get_or_create_session(
+                request.user,
+                plan,
                 success_url=f"{request.build_absolute_uri('/checkout/success/')}",
                 cancel_url=f"{request.build_absolute_uri('/checkout/canceled/')}",
-                trial_period_days=14,
-                metadata={
-                    'user_id': request.user.id,
-                    'plan_lookup_key': plan.lookup_key,
-                }
             )
             
             return Response({
                 'checkout_url': checkout_session.url,
-                'session_id': checkout_session.id
+                'session_id': checkout_session.stripe_session_id
             })
             
         except SubscriptionPlan.DoesNotExist:
@@ -212,6 +211,8 @@ def create_checkout_session(request):
                 {'error': 'Invalid plan'}, 
                 status=status.HTTP_400_BAD_REQUEST
             )
+        except StripeUnavailable as e:
+            return unavailable_response(e)
         except Exception as e:
             return Response(
                 {'error': str(e)}, 
@@ -221,187 +222,138 @@ def create_checkout_session(request):
     return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
 
 
+@api_view(['GET'])
+@permission_classes([IsAdminUser])
+def metrics_view(request):
+    """Internal process metrics for operators"""
+    return Response({
+        'counters': metrics.get_counters(),
+        'stripe': stripe_status(),
+        'customer_provisioning': provisioning_status(),
+        'stripe_calls': stripe_call_stats(),
+    })
+
+
+def has_service_token(request):
+    """Whether a request carries ENTITLEMENT_API_TOKEN as its bearer token"""
+    token = settings.ENTITLEMENT_API_TOKEN
+    provided = request.META.get('HTTP_AUTHORIZATION', '')
+    return bool(token) and hmac.compare_digest(provided.encode(), f'Bearer {token}'.encode())
+
+
+@require_GET
+def entitlement_view(request, user_id):
+    """Whether a user has access right now and until when, for other services"""
+    # A plain view without DRF or sessions, since it is called at high rates
+    if not has_service_token(request):
+        return JsonResponse({'error': 'Invalid or missing service token'}, status=401)
+    return JsonResponse(get_entitlement(user_id))
+
+
+def read_user_ids(request, limit):
+    """User ids from a JSON {"user_ids": [...]} body or one id per line, at most limit of them"""
+    if request.content_type == 'application/json':
+        try:
+            user_ids = json.loads(request.body).get('user_ids')
+        except (ValueError, AttributeError):
+            raise ValueError('Body must be a JSON object with a user_ids list')
+        if not isinstance(user_ids, list) or len(user_ids) > limit:
+            raise ValueError(f'user_ids must be a list of at most {limit} ids')
+        if not all(isinstance(user_id, int) and not isinstance(user_id, bool) for user_id in user_ids):
+            raise ValueError('user_ids must be integers')
+        return user_ids
+
+    # Newline-delimited ids are read line by line, never holding the whole body
+    user_ids = []
+    for line in request:
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            user_ids.append(int(line))
+        except ValueError:
+            raise ValueError(f'Invalid user id: {line[:50].decode(errors="replace")}')
+        if len(user_ids) > limit:
+            raise ValueError(f'At most {limit} user ids per request')
+    return user_ids
+
+
+async def iterate_off_event_loop(iterator):
+    """Async iterator over a sync iterator, advancing it in a worker thread"""
+    advance = sync_to_async(next)
+    while True:
+        item = await advance(iterator, None)
+        if item is None:
+            return
+        yield item
+
+
+@csrf_exempt
+@require_POST
+def bulk_entitlements_view(request):
+    """Entitlements of many users for batch jobs, streamed back as one JSON object per line"""
+    if not has_service_token(request):
+        return JsonResponse({'error': 'Invalid or missing service token'}, status=401)
+    try:
+        user_ids = read_user_ids(request, settings.ENTITLEMENT_BULK_MAX_IDS)
+    except ValueError as e:
+        return JsonResponse({'error': str(e)}, status=400)
+
+    chunks = (
+        ''.join(json.dumps(entitlement) + '\n' for entitlement in entitlements)
+        for entitlements in compute_entitlement_chunks(user_ids)
+    )
+    if isinstance(request, ASGIRequest):
+        # Under ASGI Django reads a sync iterator to the end before sending
+        # anything, so hand it an async one to keep the response streaming
+        chunks = iterate_off_event_loop(chunks)
+    return StreamingHttpResponse(chunks, content_type='application/x-ndjson')
+
+
 @csrf_exempt
 @require_POST
 def stripe_webhook(request):
     """Handle Stripe webhook events"""
-    payload = request.body
-    sig_header = request.META.get('HTTP_STRIPE_SIGNATURE')
+    body, status_code = receive_stripe_webhook(request.body, request.META.get('HTTP_STRIPE_SIGNATURE'))
+    return JsonResponse(body, status=status_code)
+
+
+def receive_stripe_webhook(payload, sig_header):
+    """Verify, store and (unless ingestion is async) process a webhook delivery
     
+    Returns the response body and status code; shared by the sync and async
+    webhook views.
+    """
     try:
         event = stripe.Webhook.construct_event(
             payload, sig_header, settings.STRIPE_WEBHOOK_SECRET
         )
     except ValueError:
-        return JsonResponse({'error': 'Invalid payload'}, status=400)
+        return {'error': 'Invalid payload'}, 400
     except stripe.error.SignatureVerificationError:
-        return JsonResponse({'error': 'Invalid signature'}, status=400)
+        return {'error': 'Invalid signature'}, 400
     
-    # Check if we've already processed this event
-    webhook_event, created = StripeWebhookEvent.objects.get_or_create(
-        stripe_event_id=event['id'],
-        defaults={
-            'event_type': event['type'],
-            'data': event['data'],
-        }
-    )
+    # Answer retried deliveries from the dedup cache without touching the database
+    if webhook_deduplicator.is_duplicate(event['id']):
+        return {'status': 'already_processed'}, 200
+    
+    webhook_event = build_webhook_event(event)
+    if not webhook_deduplicator.store(webhook_event):
+        return {'status': 'already_processed'}, 200
+    
+    # The cached Stripe subscription predates this event
+    if webhook_event.stripe_subscription_id:
+        subscription_cache.invalidate(webhook_event.stripe_subscription_id)
     
-    if not created:
-        return JsonResponse({'status': 'already_processed'})
+    # In async ingestion mode the event is only persisted here and a
+    # process_webhook_events worker dispatches it off the request path
+    if settings.STRIPE_WEBHOOK_ASYNC:
+        return {'status': 'queued'}, 200
     
     # Process the event
     try:
-        if event['type'] == 'customer.subscription.created':
-            handle_subscription_created(event['data']['object'])
-        elif event['type'] == 'customer.subscription.updated':
-            handle_subscription_updated(event['data']['object'])
-        elif event['type'] == 'customer.subscription.deleted':
-            handle_subscription_deleted(event['data']['object'])
-        elif event['type'] == 'invoice.payment_succeeded':
-            handle_payment_succeeded(event['data']['object'])
-        elif event['type'] == 'invoice.payment_failed':
-            handle_payment_failed(event['data']['object'])
-        
-        webhook_event.processed = True
-        webhook_event.save()
-        
+        process_webhook_event(webhook_event)
     except Exception as e:
-        return JsonResponse({'error': str(e)}, status=500)
+        return {'error': str(e)}, 500
     
-    return JsonResponse({'status': 'success'})
-
-
-def handle_subscription_created(stripe_subscription):
-    """Handle subscription created webhook"""
-    try:
-        user_id = stripe_subscription['metadata'].get('user_id')
-        if user_id:
-            user = User.objects.get(id=user_id)
-            plan_lookup_key = stripe_subscription['metadata'].get('plan_lookup_key')
-            
-            if plan_lookup_key:
-                plan = SubscriptionPlan.objects.get(lookup_key=plan_lookup_key)
-                
-                # Create or update user subscription
-                user_subscription, created = UserSubscription.objects.get_or_create(
-                    user=user,
-                    defaults={
-                        'plan': plan,
-                        'status': 'trial',
-                        'stripe_subscription_id': stripe_subscription['id'],
-                        'stripe_customer_id': stripe_subscription['customer'],
-                        'current_period_start': datetime.fromtimestamp(stripe_subscription['current_period_start']),
-                        'current_period_end': datetime.fromtimestamp(stripe_subscription['current_period_end']),
-                    }
-                )
-                
-                if not created:
-                    # Update existing subscription
-                    user_subscription.stripe_subscription_id = stripe_subscription['id']
-                    user_subscription.stripe_customer_id = stripe_subscription['customer']
-                    user_subscription.current_period_start = datetime.fromtimestamp(stripe_subscription['current_period_start'])
-                    user_subscription.current_period_end = datetime.fromtimestamp(stripe_subscription['current_period_end'])
-                    user_subscription.save()
-                
-                # Log the event
-                SubscriptionHistory.objects.create(
-                    subscription=user_subscription,
-                    event_type='created',
-                    description=f"Subscription created via Stripe checkout",
-                    metadata={'stripe_subscription_id': stripe_subscription['id']}
-                )
-                
-    except Exception as e:
-        logger.error(f"Error handling subscription created webhook: {str(e)}")
-
-
-def handle_subscription_updated(stripe_subscription):
-    """Handle subscription updated webhook"""
-    try:
-        SubscriptionService.sync_stripe_subscription(stripe_subscription['id'])
-    except Exception as e:
-        logger.error(f"Error handling subscription updated webhook: {str(e)}")
-
-
-def handle_subscription_deleted(stripe_subscription):
-    """Handle subscription deleted webhook"""
-    try:
-        user_subscription = UserSubscription.objects.get(
-            stripe_subscription_id=stripe_subscription['id']
-        )
-        user_subscription.status = 'canceled'
-        user_subscription.canceled_at = datetime.now()
-        user_subscription.save()
-        
-        # Log the event
-        SubscriptionHistory.objects.create(
-            subscription=user_subscription,
-            event_type='canceled',
-            description="Subscription canceled via Stripe",
-            metadata={'stripe_subscription_id': stripe_subscription['id']}
-        )
-        
-    except UserSubscription.DoesNotExist:
-        pass
-    except Exception as e:
-        logger.error(f"Error handling subscription deleted webhook: {str(e)}")
-
-
-def handle_payment_succeeded(invoice):
-    """Handle successful payment webhook"""
-    try:
-        subscription_id = invoice['subscription']
-        if subscription_id:
-            user_subscription = UserSubscription.objects.get(
-                stripe_subscription_id=subscription_id
-            )
-            
-            # Update subscription status to active if it was in trial
-            if user_subscription.status == 'trial':
-                user_subscription.status = 'active'
-                user_subscription.save()
-                
-                # Log the event
-                SubscriptionHistory.objects.create(
-                    subscription=user_subscription,
-                    event_type='activated',
-                    description="Subscription activated after successful payment",
-                )
-            
-            # Log renewal
-            SubscriptionHistory.objects.create(
-                subscription=user_subscription,
-                event_type='renewed',
-                description="Subscription renewed",
-                metadata={'invoice_id': invoice['id']}
-            )
-            
-    except UserSubscription.DoesNotExist:
-        pass
-    except Exception as e:
-        logger.error(f"Error handling payment succeeded webhook: {str(e)}")
-
-
-def handle_payment_failed(invoice):
-    """Handle failed payment webhook"""
-    try:
-        subscription_id = invoice['subscription']
-        if subscription_id:
-            user_subscription = UserSubscription.objects.get(
-                stripe_subscription_id=subscription_id
-            )
-            user_subscription.status = 'past_due'
-            user_subscription.save()
-            
-            # Log the event
-            SubscriptionHistory.objects.create(
-                subscription=user_subscription,
-                event_type='payment_failed',
-                description="Payment failed",
-                metadata={'invoice_id': invoice['id']}
-            )
-            
-    except UserSubscription.DoesNotExist:
-        pass
-    except Exception as e:
-        logger.error(f"Error handling payment failed webhook: {str(e)}")
\ No newline at end of file
+    return {'status': 'success'}, 200
@@ -0,0 +1,549 @@
+from concurrent.futures import ThreadPoolExecutor
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connection, transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+from datetime import timedelta
+import contextvars
+import logging
+
+from .models import SubscriptionPlan, UserSubscription, StripeWebhookEvent
+from .plan_catalog import plan_catalog
+from .services import (
+    STATUS_MAPPING, CheckoutService, SubscriptionService, from_stripe_timestamp, subscription_item_id,
+)
+from .state_machine import restart
+from .payloads import compress_payload, trim_payload
+from .batching import SubscriptionChangeBatch, batch_changes
+from .rate_limit import WEBHOOK, stripe_priority
+from . import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def subscription_plan(stripe_subscription):
+    """Plan of a Stripe subscription, by its plan_lookup_key metadata or else its item's price"""
+    plan_lookup_key = stripe_subscription['metadata'].get('plan_lookup_key')
+    if plan_lookup_key:
+        return plan_catalog.get_by_lookup_key(plan_lookup_key, active_only=False)
+
+    items = (stripe_subscription.get('items') or {}).get('data') or []
+    if items and (items[0].get('price') or {}).get('id'):
+        try:
+            return plan_catalog.get_by_price_id(items[0]['price']['id'])
+        except SubscriptionPlan.DoesNotExist:
+            logger.warning(f"No plan for price {items[0]['price']['id']} of Stripe subscription {stripe_subscription['id']}")
+    return None
+
+
+def handle_subscription_created(stripe_subscription, event_created=None, batch=None):
+    """Handle subscription created webhook"""
+    try:
+        user_id = stripe_subscription['metadata'].get('user_id')
+        if user_id:
+            user = User.objects.get(id=user_id)
+            plan = subscription_plan(stripe_subscription)
+
+            if plan is not None:
+
+                with batch_changes(batch) as changes:
+                    # Create or update user subscription
+                    user_subscription, created = UserSubscription.objects.get_or_create(
+                        user=user,
+                        defaults={
+                            'plan': plan,
+                            'status': 'trial',
+                            'stripe_subscription_id': stripe_subscription['id'],
+                            'stripe_customer_id': stripe_subscription['customer'],
+                            'stripe_subscription_item_id': subscription_item_id(stripe_subscription),
+                            'current_period_start': from_stripe_timestamp(stripe_subscription['current_period_start']),
+                            'current_period_end': from_stripe_timestamp(stripe_subscription['current_period_end']),
+                            'stripe_synced_at': event_created,
+                        }
+                    )
+
+                    if not created and user_subscription.stripe_subscription_id != stripe_subscription['id']:
+                        # The user subscribed again, usually after canceling, so
+                        # the row follows the new Stripe subscription whatever
+                        # its status; restart() writes the history entry
+                        restart(
+                            user_subscription,
+                            stripe_subscription['id'],
+                            STATUS_MAPPING.get(stripe_subscription.get('status'), 'trial'),
+                            'created',
+                            "Subscription created via Stripe checkout",
+                            {
+                                'stripe_subscription_id': stripe_subscription['id'],
+                                'previous_stripe_subscription_id': user_subscription.stripe_subscription_id,
+                            },
+                            plan=plan,
+                            stripe_customer_id=stripe_subscription['customer'],
+                            stripe_subscription_item_id=subscription_item_id(stripe_subscription),
+                            current_period_start=from_stripe_timestamp(stripe_subscription['current_period_start']),
+                            current_period_end=from_stripe_timestamp(stripe_subscription['current_period_end']),
+                            canceled_at=None,
+                            stripe_synced_at=event_created,
+                        )
+                        changes.add(user_subscription)
+                        return
+
+                    stale = (event_created and user_subscription.stripe_synced_at
+                             and event_created < user_subscription.stripe_synced_at)
+                    if not created and not stale:
+                        # Update existing subscription
+                        user_subscription.stripe_subscription_id = stripe_subscription['id']
+                        user_subscription.stripe_customer_id = stripe_subscription['customer']
+                        user_subscription.stripe_subscription_item_id = subscription_item_id(stripe_subscription)
+                        user_subscription.current_period_start = from_stripe_timestamp(stripe_subscription['current_period_start'])
+                        user_subscription.current_period_end = from_stripe_timestamp(stripe_subscription['current_period_end'])
+                        if event_created:
+                            user_subscription.stripe_synced_at = event_created
+                        changes.save(user_subscription)
+                    changes.add(user_subscription)
+
+                    # Log the event
+                    changes.log(
+                        user_subscription,
+                        'created',
+                        f"Subscription created via Stripe checkout",
+                        {'stripe_subscription_id': stripe_subscription['id']}
+                    )
+
+    except Exception as e:
+        logger.error(f"Error handling subscription created webhook: {str(e)}")
+        raise
+
+
+def handle_subscription_updated(stripe_subscription, event_created=None, batch=None):
+    """Handle subscription updated webhook"""
+    try:
+        SubscriptionService.apply_stripe_subscription(
+            stripe_subscription, event_created=event_created, batch=batch
+        )
+    except Exception as e:
+        logger.error(f"Error handling subscription updated webhook: {str(e)}")
+        raise
+
+
+def handle_subscription_deleted(stripe_subscription, event_created=None, batch=None):
+    """Handle subscription deleted webhook"""
+    try:
+        with batch_changes(batch) as changes:
+            user_subscription = changes.get(stripe_subscription['id'])
+            changes.transition(
+                user_subscription,
+                'canceled',
+                'canceled',
+                "Subscription canceled via Stripe",
+                {'stripe_subscription_id': stripe_subscription['id']},
+                canceled_at=timezone.now(),
+            )
+            if event_created:
+                # Deletion is final, so any update created before it is stale
+                user_subscription.stripe_synced_at = event_created
+                changes.save(user_subscription)
+
+    except UserSubscription.DoesNotExist:
+        pass
+    except Exception as e:
+        logger.error(f"Error handling subscription deleted webhook: {str(e)}")
+        raise
+
+
+def handle_payment_succeeded(invoice, event_created=None, batch=None):
+    """Handle successful payment webhook"""
+    try:
+        subscription_id = invoice['subscription']
+        if subscription_id:
+            with batch_changes(batch) as changes:
+                user_subscription = changes.get(subscription_id)
+
+                # A paid invoice activates trials and recovers unpaid subscriptions
+                changes.transition(
+                    user_subscription,
+                    'active',
+                    'activated',
+                    "Subscription activated after successful payment",
+                )
+
+                # Log renewal
+                changes.log(
+                    user_subscription,
+                    'renewed',
+                    "Subscription renewed",
+                    {'invoice_id': invoice['id']}
+                )
+
+    except UserSubscription.DoesNotExist:
+        pass
+    except Exception as e:
+        logger.error(f"Error handling payment succeeded webhook: {str(e)}")
+        raise
+
+
+def handle_payment_failed(invoice, event_created=None, batch=None):
+    """Handle failed payment webhook"""
+    try:
+        subscription_id = invoice['subscription']
+        if subscription_id:
+            with batch_changes(batch) as changes:
+                user_subscription = changes.get(subscription_id)
+                applied = changes.transition(
+                    user_subscription,
+                    'past_due',
+                    'payment_failed',
+                    "Payment failed",
+                    {'invoice_id': invoice['id']}
+                )
+                if not applied:
+                    # Still record every failed invoice
+                    changes.log(
+                        user_subscription,
+                        'payment_failed',
+                        "Payment failed",
+                        {'invoice_id': invoice['id']}
+                    )
+
+    except UserSubscription.DoesNotExist:
+        pass
+    except Exception as e:
+        logger.error(f"Error handling payment failed webhook: {str(e)}")
+        raise
+
+
+def handle_checkout_session_completed(checkout_session, event_created=None, batch=None):
+    """Handle checkout session completed webhook"""
+    try:
+        CheckoutService.mark_session(checkout_session['id'], 'complete')
+    except Exception as e:
+        logger.error(f"Error handling checkout session completed webhook: {str(e)}")
+        raise
+
+
+def handle_checkout_session_expired(checkout_session, event_created=None, batch=None):
+    """Handle checkout session expired webhook"""
+    try:
+        CheckoutService.mark_session(checkout_session['id'], 'expired')
+    except Exception as e:
+        logger.error(f"Error handling checkout session expired webhook: {str(e)}")
+        raise
+
+
+# Map of Stripe event types to their handlers
+WEBHOOK_HANDLERS = {
+    'customer.subscription.created': handle_subscription_created,
+    'customer.subscription.updated': handle_subscription_updated,
+    'customer.subscription.deleted': handle_subscription_deleted,
+    'invoice.payment_succeeded': handle_payment_succeeded,
+    'invoice.payment_failed': handle_payment_failed,
+    'checkout.session.completed': handle_checkout_session_completed,
+    'checkout.session.expired': handle_checkout_session_expired,
+}
+
+
+# Fields of each handled event's data object that the handlers read, kept by
+# the trimmed and compressed storage policies
+WEBHOOK_PAYLOAD_FIELDS = {
+    'customer.subscription.created': [
+        'id', 'customer', 'status', 'metadata', 'current_period_start', 'current_period_end', 'items',
+    ],
+    'customer.subscription.updated': [
+        'id', 'customer', 'status', 'metadata', 'current_period_start', 'current_period_end', 'items',
+    ],
+    'customer.subscription.deleted': ['id', 'customer', 'status'],
+    'invoice.payment_succeeded': ['id', 'subscription', 'customer'],
+    'invoice.payment_failed': ['id', 'subscription', 'customer'],
+    'checkout.session.completed': ['id', 'status', 'subscription'],
+    'checkout.session.expired': ['id', 'status'],
+}
+
+
+def apply_storage_policy(webhook_event, data, policy=None):
+    """Fill a webhook event's payload columns according to the storage policy
+    
+    full: store the event data as received.
+    trimmed: store only the fields the handlers use.
+    compressed: store the trimmed data compressed in data_compressed.
+    Outside the full policy, events without a handler keep no payload at all.
+    """
+    policy = policy or settings.WEBHOOK_PAYLOAD_STORAGE
+    webhook_event.data_compressed = None
+    webhook_event.data_encoding = ''
+
+    if policy == 'full':
+        webhook_event.data = data
+        return webhook_event
+
+    if webhook_event.event_type not in WEBHOOK_HANDLERS:
+        webhook_event.data = {}
+        return webhook_event
+
+    trimmed = trim_payload(data, WEBHOOK_PAYLOAD_FIELDS[webhook_event.event_type])
+    if policy == 'compressed':
+        webhook_event.data = {}
+        webhook_event.data_encoding = settings.WEBHOOK_PAYLOAD_COMPRESSION
+        webhook_event.data_compressed = compress_payload(trimmed, webhook_event.data_encoding)
+    else:
+        webhook_event.data = trimmed
+    return webhook_event
+
+
+def build_webhook_event(event):
+    """Build an unsaved StripeWebhookEvent for a verified Stripe event"""
+    webhook_event = StripeWebhookEvent(
+        stripe_event_id=event['id'],
+        event_type=event['type'],
+        stripe_subscription_id=subscription_id_for_event(event['type'], event['data']),
+        stripe_created=from_stripe_timestamp(event['created']) if event.get('created') else None,
+    )
+    return apply_storage_policy(webhook_event, event['data'])
+
+
+def subscription_id_for_event(event_type, data):
+    """Return the Stripe subscription id an event applies to, or '' if none"""
+    stripe_object = data.get('object') or {}
+    if event_type.startswith('customer.subscription.'):
+        return stripe_object.get('id') or ''
+    if event_type.startswith('invoice.'):
+        return stripe_object.get('subscription') or ''
+    return ''
+
+
+def dispatch_event(event_type, data, event_created=None, batch=None):
+    """Run the handler registered for an event type, if any"""
+    handler = WEBHOOK_HANDLERS.get(event_type)
+    if handler:
+        with stripe_priority(WEBHOOK):
+            handler(data['object'], event_created=event_created, batch=batch)
+
+
+def process_webhook_event(webhook_event):
+    """Dispatch a stored webhook event and mark it as processed"""
+    try:
+        dispatch_event(webhook_event.event_type, webhook_event.payload, webhook_event.stripe_created)
+    except Exception as e:
+        # Keep the event leased for a backoff period so it is retried later
+        # and later events for the same subscription wait behind it
+        webhook_event.attempts += 1
+        webhook_event.last_error = str(e)
+        webhook_event.locked_by = ''
+        webhook_event.locked_until = timezone.now() + timedelta(seconds=min(2 ** webhook_event.attempts, 300))
+        webhook_event.save(update_fields=['attempts', 'last_error', 'locked_by', 'locked_until'])
+        raise
+
+    webhook_event.attempts += 1
+    webhook_event.processed = True
+    webhook_event.processed_at = timezone.now()
+    webhook_event.last_error = ''
+    webhook_event.locked_by = ''
+    webhook_event.locked_until = None
+    webhook_event.save(update_fields=[
+        'attempts', 'processed', 'processed_at', 'last_error', 'locked_by', 'locked_until'
+    ])
+    return webhook_event
+
+
+def pending_webhook_events():
+    """Queryset of stored webhook events still waiting to be processed"""
+    return StripeWebhookEvent.objects.filter(processed=False).order_by('created_at', 'id')
+
+
+def lease_webhook_event(webhook_event, worker_id, lease_seconds=60):
+    """Lease a single pending event, returning False if another worker holds it"""
+    now = timezone.now()
+    leased = StripeWebhookEvent.objects.filter(
+        Q(locked_until__isnull=True) | Q(locked_until__lte=now) | Q(locked_by=''),
+        pk=webhook_event.pk,
+        processed=False,
+    ).update(locked_by=worker_id, locked_until=now + timedelta(seconds=lease_seconds))
+    return leased == 1
+
+
+def claim_webhook_events(worker_id, batch_size=100, lease_seconds=60, max_attempts=5,
+                         coalesce_window=0, coalesce_max_delay=0):
+    """Lease a batch of pending webhook events to a worker
+    
+    Rows are locked with SELECT ... FOR UPDATE SKIP LOCKED so several worker
+    processes can claim concurrently without blocking each other. An event is
+    only claimed together with every earlier pending event of its
+    subscription, so each subscription's events are applied in order even
+    when another worker has locked some of them but not yet committed its
+    lease. Leases expire after lease_seconds, which lets another worker pick
+    up the batch of a worker that crashed.
+    
+    With a coalesce_window, a subscription's events are held back until no new
+    event for it has arrived for that many seconds, so a burst is claimed and
+    applied together. No event is held for longer than coalesce_max_delay.
+    """
+    now = timezone.now()
+    leased = Q(locked_until__isnull=True) | Q(locked_until__lte=now)
+    earlier_in_flight = StripeWebhookEvent.objects.filter(
+        stripe_subscription_id=OuterRef('stripe_subscription_id'),
+        processed=False,
+        attempts__lt=max_attempts,
+        locked_until__gt=now,
+        id__lt=OuterRef('id'),
+    )
+
+    with transaction.atomic():
+        event_ids = list(
+            pending_webhook_events()
+            .filter(leased, attempts__lt=max_attempts)
+            .exclude(Q(Exists(earlier_in_flight)) & ~Q(stripe_subscription_id=''))
+            .exclude(_still_bursting(now, coalesce_window, coalesce_max_delay))
+            .select_for_update(skip_locked=True)
+            .values_list('id', 'stripe_subscription_id')[:batch_size]
+        )
+        event_ids = _in_order_prefixes(event_ids, max_attempts)
+        StripeWebhookEvent.objects.filter(id__in=event_ids).update(
+            locked_by=worker_id,
+            locked_until=now + timedelta(seconds=lease_seconds),
+        )
+
+    return list(StripeWebhookEvent.objects.filter(id__in=event_ids).order_by('created_at', 'id'))
+
+
+def _in_order_prefixes(locked_events, max_attempts):
+    """Ids of the locked events that no unclaimed pending event of their subscription precedes
+
+    locked_events are (id, stripe_subscription_id) pairs. An earlier event
+    missing from them is either leased, locked by a worker that has not
+    committed its lease yet, or beyond the batch size; the subscription's
+    events after it must wait. This plain read sees rows SKIP LOCKED skipped.
+    """
+    locked_ids = {event_id for event_id, subscription_id in locked_events}
+    subscription_ids = {subscription_id for event_id, subscription_id in locked_events if subscription_id}
+    blocked = set()
+    claimable = {event_id for event_id, subscription_id in locked_events if not subscription_id}
+    pending = (
+        pending_webhook_events()
+        .filter(stripe_subscription_id__in=subscription_ids, attempts__lt=max_attempts)
+        .values_list('id', 'stripe_subscription_id')
+    )
+    for event_id, subscription_id in pending:
+        if subscription_id in blocked:
+            continue
+        if event_id in locked_ids:
+            claimable.add(event_id)
+        else:
+            blocked.add(subscription_id)
+    return [event_id for event_id, subscription_id in locked_events if event_id in claimable]
+
+
+def _still_bursting(now, coalesce_window, coalesce_max_delay):
+    """Filter matching events whose subscription received another event within the window"""
+    if not coalesce_window:
+        return Q(pk__in=[])
+    recent_sibling = StripeWebhookEvent.objects.filter(
+        stripe_subscription_id=OuterRef('stripe_subscription_id'),
+        processed=False,
+        created_at__gt=now - timedelta(seconds=coalesce_window),
+    )
+    return (
+        Q(Exists(recent_sibling))
+        & ~Q(stripe_subscription_id='')
+        & Q(created_at__gt=now - timedelta(seconds=max(coalesce_window, coalesce_max_delay)))
+    )
+
+
+def partition_webhook_events(webhook_events):
+    """Group events by Stripe subscription, keeping their order within each group"""
+    partitions = {}
+    for webhook_event in webhook_events:
+        key = webhook_event.stripe_subscription_id or f'event:{webhook_event.id}'
+        partitions.setdefault(key, []).append(webhook_event)
+    return list(partitions.values())
+
+
+def coalesce_webhook_events(webhook_events):
+    """Apply several events for one subscription as a single state transition
+    
+    All handlers write into one SubscriptionChangeBatch, so the subscription is
+    saved once and the history rows are inserted in one statement. Everything,
+    including marking the events processed, happens in one transaction.
+    """
+    batch = SubscriptionChangeBatch()
+    with transaction.atomic():
+        for webhook_event in webhook_events:
+            dispatch_event(
+                webhook_event.event_type, webhook_event.payload, webhook_event.stripe_created, batch=batch
+            )
+        batch.flush()
+
+        now = timezone.now()
+        StripeWebhookEvent.objects.filter(id__in=[event.id for event in webhook_events]).update(
+            processed=True,
+            processed_at=now,
+            attempts=F('attempts') + 1,
+            last_error='',
+            locked_by='',
+            locked_until=None,
+        )
+
+    for webhook_event in webhook_events:
+        webhook_event.processed = True
+        webhook_event.processed_at = now
+    metrics.increment('webhook.coalesced_events', len(webhook_events) - 1)
+    return webhook_events
+
+
+def _process_partition(webhook_events):
+    """Process one subscription's events in order, stopping at the first failure"""
+    if len(webhook_events) > 1:
+        try:
+            return coalesce_webhook_events(webhook_events), 0
+        except Exception as e:
+            # Fall back to one event at a time to find and record the failing event
+            logger.warning(f"Coalesced webhook processing failed, retrying events one by one: {str(e)}")
+
+    processed = []
+    errors = 0
+    for index, webhook_event in enumerate(webhook_events):
+        try:
+            process_webhook_event(webhook_event)
+            processed.append(webhook_event)
+        except Exception as e:
+            errors += 1
+            logger.error(f"Error processing webhook event {webhook_event.stripe_event_id}: {str(e)}")
+            # Release the rest so they are reclaimed after the failed event
+            StripeWebhookEvent.objects.filter(
+                id__in=[later.id for later in webhook_events[index + 1:]]
+            ).update(locked_by='', locked_until=None)
+            break
+    return processed, errors
+
+
+def _process_partition_in_pool(webhook_events):
+    """Process a partition on a pool thread, closing the thread's DB connection afterwards"""
+    try:
+        return _process_partition(webhook_events)
+    finally:
+        connection.close()
+
+
+def process_webhook_batch(webhook_events, threads=1):
+    """Process claimed events, running different subscriptions concurrently
+    
+    Returns a tuple of (processed events, error count).
+    """
+    partitions = partition_webhook_events(webhook_events)
+    processed = []
+    errors = 0
+
+    if threads <= 1 or len(partitions) <= 1:
+        results = map(_process_partition, partitions)
+    else:
+        with ThreadPoolExecutor(max_workers=threads) as executor:
+            # Pool threads start with an empty context; each partition runs in
+            # a copy of ours so its Stripe calls keep the caller and priority
+            futures = [
+                executor.submit(contextvars.copy_context().run, _process_partition_in_pool, partition)
+                for partition in partitions
+            ]
+            results = [future.result() for future in futures]
+
+    for partition_processed, partition_errors in results:
+        processed.extend(partition_processed)
+        errors += partition_errors
+    return processed, errors